@@ -2,21 +2,22 @@ from rest_framework import serializers
 from api.models import CustomUser
 from django.contrib.auth import authenticate
 from django.templatetags.static import static
-from datetime import timedelta
-from django.utils import timezone
-from api.models import SongPlayback, Song
-from django.db.models import Count
+from api.models import Song
+from django.db.models import Sum
 from api.serializers import SongSerializer, ArtistSerializer
 
 class CustomUserSerializer(serializers.ModelSerializer):
     top_listened_songs = serializers.SerializerMethodField()
+    top_listened_artists = serializers.SerializerMethodField()
+    top_genres = serializers.SerializerMethodField()
+    total_minutes = serializers.SerializerMethodField()
     followed_artists = ArtistSerializer(many=True, read_only=True, nested=True)
 
     #get followed artists
 
     class Meta:
         model = CustomUser
-        fields = ['id', 'username', 'email', 'first_name', 'last_name', 'number_of_followed_artists', 'number_of_followers', 'type', 'image', 'followed_artists', 'top_listened_songs']
+        fields = ['id', 'username', 'email', 'first_name', 'last_name', 'number_of_followed_artists', 'number_of_followers', 'type', 'image', 'followed_artists', 'top_listened_songs', 'top_listened_artists', 'top_genres', 'total_minutes']
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
@@ -31,21 +32,48 @@ class CustomUserSerializer(serializers.ModelSerializer):
         return representation
     
 
+    def _listening_profile(self, obj):
+        return getattr(obj, 'listening_profile', None)
+
     def get_top_listened_songs(self, obj):
-        last_month = timezone.now() - timedelta(days=30)
-        songs_ids = SongPlayback.objects.filter(
-            user=obj,
-            played_at__gte=last_month
-        ).values(
-            'song__id'
+        profile = self._listening_profile(obj)
+        if not profile:
+            return []
+
+        song_ids = profile.top_song_ids
+        songs_by_id = Song.objects.filter(id__in=song_ids).select_related(
+            'album__artist'
+        ).prefetch_related(
+            'featured_artists'
         ).annotate(
-            play_count=Count('id')
-        ).order_by('-play_count')[:10]
-
-        songs = Song.objects.filter(id__in=[song['song__id'] for song in songs_ids])
+            total_plays=Sum('daily_plays__plays')
+        ).in_bulk()
+        songs = [songs_by_id[song_id] for song_id in song_ids if song_id in songs_by_id]
         serializer = SongSerializer(songs, many=True, context=self.context, nested=True)
         return serializer.data
 
+    def get_top_listened_artists(self, obj):
+        profile = self._listening_profile(obj)
+        if not profile:
+            return []
+
+        artist_ids = profile.top_artist_ids
+        artists_by_id = CustomUser.objects.in_bulk(artist_ids)
+        artists = [artists_by_id[artist_id] for artist_id in artist_ids if artist_id in artists_by_id]
+        return ArtistSerializer(artists, many=True, nested=True, context=self.context).data
+
+    def get_top_genres(self, obj):
+        profile = self._listening_profile(obj)
+        if not profile:
+            return []
+
+        genre_dict = dict(Song._meta.get_field('genre').choices)
+        return [genre_dict.get(genre, genre) for genre in profile.top_genres]
+
+    def get_total_minutes(self, obj):
+        profile = self._listening_profile(obj)
+        return profile.total_minutes if profile else 0
+
 
 
 
@@ -6,6 +6,7 @@ from rest_framework.response import Response
 from rest_framework import status, generics
 from rest_framework.views import APIView
 from drf_spectacular.utils import extend_schema
+from api.models import CustomUser
 
 # Create your views here.
 class UserRegistrationAPIView(GenericAPIView):
@@ -71,4 +72,4 @@ class CustomUserProfileAPIView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = CustomUserSerializer
     
     def get_object(self):
-        return self.request.user
\ No newline at end of file
+        return CustomUser.objects.select_related('listening_profile').prefetch_related('followed_artists').get(pk=self.request.user.pk)
\ No newline at end of file
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Album, Song, CustomUser, CurrentPlayback, SongPlayback, Playlist, PlaylistSong, Library, LibraryItem, PlaybackHistory
+from .models import Album, Song, CustomUser, CurrentPlayback, SongPlayback, SongDailyPlays, ArtistDailyPlays, GenreDailyPlays, UserSongDailyPlays, ListeningProfile, ChartSnapshot, Playlist, PlaylistSong, Library, LibraryItem, LibraryChange, ObjectChange, PlaybackHistory, MediaJob, SongAnalysis, MediaBlob
 
 from accounts.forms import CustomUserCreationForm, CustomUserChangeForm
 from django.contrib.auth.admin import UserAdmin
@@ -9,11 +9,22 @@ admin.site.register(Album)
 admin.site.register(Song)
 admin.site.register(CurrentPlayback)
 admin.site.register(SongPlayback)
+admin.site.register(SongDailyPlays)
+admin.site.register(ArtistDailyPlays)
+admin.site.register(GenreDailyPlays)
+admin.site.register(UserSongDailyPlays)
+admin.site.register(ListeningProfile)
+admin.site.register(ChartSnapshot)
 admin.site.register(Playlist)
 admin.site.register(PlaylistSong)
 admin.site.register(Library)
 admin.site.register(LibraryItem)
+admin.site.register(LibraryChange)
+admin.site.register(ObjectChange)
 admin.site.register(PlaybackHistory)
+admin.site.register(MediaJob)
+admin.site.register(SongAnalysis)
+admin.site.register(MediaBlob)
 
 # admin.site.register(CustomUser)
 
@@ -0,0 +1,229 @@
+import asyncio
+import random
+import threading
+from functools import lru_cache
+import httpx
+from django.conf import settings
+from .storage import READ_BLOCK_SIZE, TUS_CHUNK_SIZE, TUS_RETRIES, LocalStorage, SupabaseStorage, _as_file, get_storage
+
+# Statuses worth another attempt; anything else in 4xx is the caller's fault.
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+RETRY_BACKOFF = 0.25
+# Supabase accepts at most 1000 names per remove or sign call.
+BATCH_SIZE = 1000
+
+
+async def _gather(coros):
+    # Every operation runs to completion (no half-read file is abandoned
+    # mid-request); the first failure is raised afterwards.
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def _aread_range(file, offset, length, block_size=READ_BLOCK_SIZE):
+    # _read_range with every seek and read in a thread, so a slow disk or
+    # network mount does not stall the other uploads on the loop.
+    await asyncio.to_thread(file.seek, offset)
+    while length > 0:
+        block = await asyncio.to_thread(file.read, min(block_size, length))
+        if not block:
+            return
+        length -= len(block)
+        yield block
+
+
+def _batches(names, size=BATCH_SIZE):
+    names = list(names)
+    return [names[i:i + size] for i in range(0, len(names), size)]
+
+
+class AsyncSupabaseStorage:
+    # One pooled AsyncClient per instance; `concurrency` bounds both the
+    # operations in flight and the connections kept open.
+    def __init__(self, url, key, concurrency=8, retries=TUS_RETRIES, backoff=RETRY_BACKOFF, transport=None):
+        self.storage = SupabaseStorage(url, key)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = transport
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._client = None
+
+    @property
+    def client(self):
+        # Built on first use, inside the event loop that will drive it.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency, keepalive_expiry=30.0),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                transport=self.transport,
+            )
+        return self._client
+
+    async def _backoff(self, attempt):
+        # Exponential with jitter, so a burst of failures does not retry in lockstep.
+        await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.0))
+
+    async def _request(self, method, url, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+            await self._backoff(attempt)
+
+    async def put(self, bucket, name, file, upsert=False, chunk_size=TUS_CHUNK_SIZE):
+        # The TUS upload of SupabaseStorage.stream_put, on the shared pool.
+        async with self.semaphore:
+            # Opening a path and sizing the file touch the disk too.
+            with await asyncio.to_thread(_as_file, file) as file:
+                size = await asyncio.to_thread(lambda: file.size)
+                response = await self._request(
+                    'POST', f"{self.storage.url}/storage/v1/upload/resumable",
+                    headers=self.storage.tus_create_headers(bucket, name, size, upsert),
+                )
+                location = response.headers['Location']
+
+                offset = failures = 0
+                while offset < size:
+                    length = min(chunk_size, size - offset)
+                    try:
+                        response = await self.client.patch(
+                            location, content=_aread_range(file, offset, length),
+                            headers=self.storage.tus_patch_headers(offset, length),
+                        )
+                        response.raise_for_status()
+                        offset = int(response.headers['Upload-Offset'])
+                        failures = 0
+                    except httpx.HTTPError:
+                        failures += 1
+                        if failures > self.retries:
+                            raise
+                        await self._backoff(failures - 1)
+                        # Resume from whatever the server kept.
+                        response = await self._request('HEAD', location, headers=self.storage.tus_headers())
+                        offset = int(response.headers['Upload-Offset'])
+        return f"{bucket}/{name}"
+
+    async def upload_many(self, bucket, items, upsert=False):
+        # `items` are (name, file) pairs, uploaded `concurrency` at a time.
+        return await _gather([self.put(bucket, name, file, upsert) for name, file in items])
+
+    async def url_many(self, bucket, names, signed=False, expires_in=3600):
+        names = list(names)
+        if not signed:
+            return [self.storage.public_url(bucket, name) for name in names]
+
+        async def sign(batch):
+            async with self.semaphore:
+                response = await self._request(
+                    'POST', f"{self.storage.url}/storage/v1/object/sign/{bucket}",
+                    headers=self.storage._headers(), json={'expiresIn': expires_in, 'paths': batch},
+                )
+            return response.json()
+
+        urls = {}
+        for batch in await _gather([sign(batch) for batch in _batches(names)]):
+            for item in batch:
+                if item.get('error'):
+                    raise httpx.HTTPError(f"{bucket}/{item['path']}: {item['error']}")
+                urls[item['path']] = f"{self.storage.url}/storage/v1/{item['signedURL'].lstrip('/')}"
+        return [urls[name] for name in names]
+
+    async def delete_many(self, bucket, names):
+        async def remove(batch):
+            async with self.semaphore:
+                await self._request(
+                    'DELETE', f"{self.storage.url}/storage/v1/object/{bucket}",
+                    headers=self.storage._headers(), json={'prefixes': batch},
+                )
+
+        await _gather([remove(batch) for batch in _batches(names)])
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AsyncLocalStorage:
+    # The same batch API over LocalStorage; disk writes run in threads.
+    def __init__(self, storage, concurrency=8):
+        self.storage = storage
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def put(self, bucket, name, file, upsert=False):
+        async with self.semaphore:
+            return await asyncio.to_thread(self.storage.stream_put, bucket, name, file, upsert)
+
+    async def upload_many(self, bucket, items, upsert=False):
+        return await _gather([self.put(bucket, name, file, upsert) for name, file in items])
+
+    async def url_many(self, bucket, names, signed=False, expires_in=3600):
+        if signed:
+            return [self.storage.signed_url(bucket, name, expires_in) for name in names]
+        return [self.storage.public_url(bucket, name) for name in names]
+
+    async def delete_many(self, bucket, names):
+        await asyncio.to_thread(self.storage.delete, bucket, list(names))
+
+    async def aclose(self):
+        pass
+
+
+class StorageLoop:
+    # A long-lived event loop on a daemon thread, so synchronous code (views,
+    # jobs, commands) shares one connection pool across calls instead of
+    # opening a client per request. Started on first use, so every forked
+    # worker gets its own.
+    def __init__(self):
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def run(self, coro):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='storage-loop', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+storage_loop = StorageLoop()
+
+
+@lru_cache
+def _build_async_storage(backend, local_root, local_url, supabase_url, supabase_key, concurrency):
+    if backend == 'supabase':
+        return AsyncSupabaseStorage(supabase_url, supabase_key, concurrency)
+    storage = get_storage()
+    if isinstance(storage, LocalStorage):
+        return AsyncLocalStorage(storage, concurrency)
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
+
+
+def get_async_storage():
+    # Bound to storage_loop; use the helpers below from synchronous code.
+    return _build_async_storage(
+        settings.STORAGE_BACKEND, str(settings.STORAGE_LOCAL_ROOT), settings.STORAGE_LOCAL_URL,
+        settings.SUPABASE_URL, settings.SUPABASE_KEY, settings.STORAGE_CONCURRENCY,
+    )
+
+
+def upload_many(bucket, items, upsert=False):
+    return storage_loop.run(get_async_storage().upload_many(bucket, list(items), upsert))
+
+
+def url_many(bucket, names, signed=False, expires_in=3600):
+    return storage_loop.run(get_async_storage().url_many(bucket, names, signed, expires_in))
+
+
+def delete_many(bucket, names):
+    return storage_loop.run(get_async_storage().delete_many(bucket, names))
@@ -0,0 +1,157 @@
+import hashlib
+import operator
+import os
+import threading
+from collections import Counter
+from functools import reduce
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+from .models import CustomUser, Album, Song, Playlist, MediaBlob
+from .async_storage import delete_many, upload_many
+from .storage import READ_BLOCK_SIZE
+
+# Every field pointing at a MediaBlob; ref_count is the number of them.
+BLOB_FIELDS = {
+    Song: ['audio_blob'],
+    Album: ['image_blob'],
+    CustomUser: ['image_blob'],
+    Playlist: ['image_blob'],
+}
+# Fields naming a blob's derived_keys; they belong to the old blob, which
+# the collector may delete, once the field points at another one.
+DERIVED_FIELDS = {
+    'audio_blob': ['hls_manifest'],
+    'image_blob': ['image_variants'],
+}
+GC_GRACE = timedelta(days=1)
+GC_BATCH_SIZE = 500
+
+_pending = threading.local()
+
+
+def file_digest(file):
+    # One pass over the file in blocks; the upload then streams it again.
+    digest = hashlib.sha256()
+    size = 0
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as disk_file:
+            return file_digest(disk_file)
+    file.seek(0)
+    while block := file.read(READ_BLOCK_SIZE):
+        digest.update(block)
+        size += len(block)
+    file.seek(0)
+    return digest.hexdigest(), size
+
+
+def store_blob(bucket, file, name):
+    return store_blobs(bucket, [(file, name)])[0]
+
+
+def store_blobs(bucket, files):
+    # One MediaBlob per (file, name) pair. Bytes that are already stored are
+    # never uploaded again, the rest upload concurrently; `name` only
+    # contributes its extension.
+    digests = [file_digest(file) for file, _ in files]
+    blobs = {blob.sha256: blob for blob in MediaBlob.objects.filter(bucket=bucket, sha256__in=[sha256 for sha256, _ in digests])}
+    if blobs:
+        # Keeps unreferenced blobs out of the next collection.
+        MediaBlob.objects.filter(pk__in=[blob.pk for blob in blobs.values()]).update(updated_at=timezone.now())
+
+    uploads = {}
+    for (file, name), (sha256, size) in zip(files, digests):
+        if sha256 not in blobs and sha256 not in uploads:
+            uploads[sha256] = (MediaBlob.key_for(sha256, os.path.splitext(name)[1]), file, size)
+    # Concurrent uploads of the same bytes write the same object.
+    upload_many(bucket, [(key, file) for key, file, _ in uploads.values()], upsert=True)
+    for sha256, (key, _, size) in uploads.items():
+        blobs[sha256], _ = MediaBlob.objects.get_or_create(bucket=bucket, sha256=sha256, defaults={'key': key, 'size': size})
+    return [blobs[sha256] for sha256, _ in digests]
+
+
+def attach_blob(obj, field, blob):
+    previous = getattr(obj, f'{field}_id')
+    if previous == blob.pk:
+        return
+    derived = DERIVED_FIELDS.get(field, [])
+    with transaction.atomic():
+        setattr(obj, field, blob)
+        for name in derived:
+            setattr(obj, name, obj._meta.get_field(name).get_default())
+        obj.save(update_fields=[field, *derived])
+        MediaBlob.acquire(blob.pk)
+        if previous:
+            MediaBlob.release(previous)
+
+
+def schedule_release(instance):
+    # Called from post_delete; the blobs of the whole cascade are released
+    # in one UPDATE once the deleting transaction commits.
+    keys = [key for field in BLOB_FIELDS.get(type(instance), []) if (key := getattr(instance, f'{field}_id'))]
+    if not keys:
+        return
+    pending = getattr(_pending, 'keys', None)
+    if pending is None:
+        pending = _pending.keys = {}
+    pending.setdefault(type(instance), {})[instance.pk] = keys
+    transaction.on_commit(flush_releases)
+
+
+def flush_releases():
+    pending = getattr(_pending, 'keys', None)
+    _pending.keys = None
+    if not pending:
+        return
+
+    released = Counter()
+    for model, keys_by_pk in pending.items():
+        # Rows buffered by a transaction that was rolled back still exist.
+        for pk in set(keys_by_pk) - set(model.objects.filter(pk__in=list(keys_by_pk)).values_list('pk', flat=True)):
+            released.update(keys_by_pk[pk])
+    MediaBlob.release_many(released)
+
+
+def referenced_blobs():
+    return reduce(operator.or_, [
+        Exists(model.objects.filter(**{field: OuterRef('pk')}))
+        for model, fields in BLOB_FIELDS.items() for field in fields
+    ])
+
+
+def recount_references():
+    # Fixes counts that drifted through deletes that bypassed the signals.
+    counts = {}
+    for model, fields in BLOB_FIELDS.items():
+        for field in fields:
+            for key, count in model.objects.exclude(**{f'{field}__isnull': True}).values_list(field).annotate(n=Count('pk')).order_by():
+                counts[key] = counts.get(key, 0) + count
+
+    drifted = [blob for blob in MediaBlob.objects.only('key', 'ref_count') if blob.ref_count != counts.get(blob.key, 0)]
+    for blob in drifted:
+        blob.ref_count = counts.get(blob.key, 0)
+    MediaBlob.objects.bulk_update(drifted, ['ref_count'], batch_size=1000)
+    return len(drifted)
+
+
+def collect_garbage(grace=GC_GRACE, dry_run=False):
+    # Only blobs unreferenced for `grace` are removed, so an upload between
+    # store_blob() and attach_blob() is never collected.
+    orphans = MediaBlob.objects.filter(ref_count=0, updated_at__lt=timezone.now() - grace).exclude(referenced_blobs())
+    if dry_run:
+        return list(orphans)
+
+    collected = []
+    pks = list(orphans.values_list('pk', flat=True))
+    for i in range(0, len(pks), GC_BATCH_SIZE):
+        # Re-checked under a row lock: a blob may have been reused meanwhile.
+        # The objects are removed before the rows commit, so a failed
+        # delete leaves the batch to the next run.
+        with transaction.atomic():
+            batch = list(orphans.filter(pk__in=pks[i:i + GC_BATCH_SIZE]).select_for_update())
+            MediaBlob.objects.filter(pk__in=[blob.pk for blob in batch]).delete()
+            for bucket in {blob.bucket for blob in batch}:
+                delete_many(bucket, [key for blob in batch if blob.bucket == bucket for key in (blob.key, *blob.derived_keys)])
+        collected += batch
+    return collected
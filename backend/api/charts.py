@@ -0,0 +1,57 @@
+import hashlib
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from .models import ChartSnapshot
+from .serializers import SongSerializer
+from .utils import get_top_songs_by_genre
+
+CHART_SIZE = 10
+CHART_SNAPSHOTS_KEPT = 3
+
+
+def build_genre_charts(limit=CHART_SIZE):
+    charts = {}
+    for song in get_top_songs_by_genre(limit):
+        # The chart's own window, not all-time playbacks.
+        song.total_plays = song.play_count
+        song_data = SongSerializer(song).data
+        song_data.pop('lyrics')
+        song_data.pop('genre')
+
+        genre = song.get_genre_display()
+        chart = charts.setdefault(genre, {
+            'genre': genre,
+            'cover': song.album.artist.get_image_url,
+            'songs': [],
+        })
+        chart['songs'].append(song_data)
+
+    return list(charts.values())
+
+
+def with_absolute_urls(charts, request):
+    # Snapshots are built without a request, so covers, streams and
+    # waveforms are stored as paths and made absolute when served.
+    def absolute(url):
+        return request.build_absolute_uri(url) if url else url
+
+    return [
+        {**chart, 'cover': absolute(chart['cover']), **({'songs': [
+            {**song, **{key: absolute(song[key]) for key in ('stream', 'waveform') if key in song}}
+            for song in chart['songs']
+        ]} if 'songs' in chart else {})}
+        for chart in charts
+    ]
+
+
+def build_chart_snapshot(limit=CHART_SIZE):
+    data = json.loads(json.dumps(build_genre_charts(limit), cls=DjangoJSONEncoder))
+    etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    with transaction.atomic():
+        snapshot = ChartSnapshot.objects.create(etag=etag, data=data)
+        stale_ids = ChartSnapshot.objects.order_by('-created_at').values_list('id', flat=True)[CHART_SNAPSHOTS_KEPT:]
+        ChartSnapshot.objects.filter(id__in=list(stale_ids)).delete()
+
+    return snapshot
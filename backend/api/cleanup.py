@@ -0,0 +1,77 @@
+import threading
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from .models import Library, LibraryItem, LibraryChange, PlaybackHistory
+
+_pending = threading.local()
+
+
+def schedule_cleanup(instance):
+    # Called from post_delete; the whole cascade is cleaned up in one pass
+    # once the deleting transaction commits.
+    pending = getattr(_pending, 'ids', None)
+    if pending is None:
+        pending = _pending.ids = {}
+    pending.setdefault(ContentType.objects.get_for_model(instance).id, set()).add(instance.pk)
+    transaction.on_commit(flush_cleanup)
+
+
+def flush_cleanup():
+    pending = getattr(_pending, 'ids', None)
+    _pending.ids = None
+    if not pending:
+        return
+
+    for content_type_id, object_ids in pending.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        # Ids buffered by a transaction that was rolled back still exist.
+        object_ids = object_ids - set(model.objects.filter(pk__in=object_ids).values_list('pk', flat=True))
+        if object_ids:
+            with transaction.atomic():
+                remove_library_items(content_type_id, object_ids)
+                PlaybackHistory.objects.filter(content_type_id=content_type_id, object_id__in=object_ids).delete()
+
+
+def remove_library_items(content_type_id, object_ids):
+    # One DELETE for every library holding any of the objects; the change log
+    # and library versions are written in bulk instead of per-row signals.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {LibraryItem._meta.db_table} WHERE content_type_id = %s AND object_id = ANY(%s) "
+            f"RETURNING id, library_id, object_id",
+            [content_type_id, list(object_ids)],
+        )
+        removed = cursor.fetchall()
+
+    LibraryChange.log(
+        LibraryChange(library_id=library_id, action='remove', item_id=item_id, content_type_id=content_type_id, object_id=object_id)
+        for item_id, library_id, object_id in removed
+    )
+    Library.bump_versions(id__in={library_id for _, library_id, _ in removed})
+    return len(removed)
+
+
+def orphaned_object_ids(queryset, content_type, batch_size):
+    model = content_type.model_class()
+    return list(queryset.filter(content_type=content_type).exclude(
+        Exists(model.objects.filter(pk=OuterRef('object_id')))
+    ).values_list('object_id', flat=True).distinct()[:batch_size])
+
+
+def sweep_orphans(batch_size=1000):
+    # Removes LibraryItem and PlaybackHistory rows pointing at deleted objects,
+    # e.g. from deletes that bypassed the signals (queryset updates, raw SQL).
+    removed = {'library_items': 0, 'playback_history': 0}
+    for queryset, key in [(LibraryItem.objects.all(), 'library_items'), (PlaybackHistory.objects.all(), 'playback_history')]:
+        content_type_ids = queryset.values_list('content_type', flat=True).distinct().order_by()
+        for content_type in ContentType.objects.filter(id__in=list(content_type_ids)):
+            if content_type.model_class() is None:
+                continue
+            while object_ids := orphaned_object_ids(queryset, content_type, batch_size):
+                with transaction.atomic():
+                    if key == 'library_items':
+                        removed[key] += remove_library_items(content_type.id, object_ids)
+                    else:
+                        removed[key] += queryset.filter(content_type=content_type, object_id__in=object_ids).delete()[0]
+    return removed
@@ -0,0 +1,67 @@
+import io
+import os
+import httpx
+from PIL import Image, ImageOps
+from .models import Album, CustomUser, Playlist
+from .async_storage import upload_many
+from .utils import get_image_url
+
+IMAGE_SIZES = (64, 160, 320, 640)
+IMAGE_QUALITY = 80
+
+
+def variant_name(name, size):
+    return f"{os.path.splitext(name)[0]}_{size}.webp"
+
+
+def render_variants(source, sizes=IMAGE_SIZES):
+    # WebP renditions keyed by width, largest side at most `size`. Sizes
+    # above the original are skipped rather than upscaled.
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        variants = {}
+        for size in sorted(sizes):
+            if variants and size > max(image.size):
+                break
+            variant = image.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            variant.save(buffer, 'WEBP', quality=IMAGE_QUALITY, method=4)
+            variants[size] = buffer.getvalue()
+        return variants
+
+
+def image_source(obj):
+    if os.path.isfile(obj.image.path):
+        return obj.image.path
+    response = httpx.get(get_image_url(obj.image_name), timeout=30.0, follow_redirects=True)
+    response.raise_for_status()
+    return io.BytesIO(response.content)
+
+
+def store_variants(obj, variants):
+    names = {str(size): variant_name(obj.image_name, size) for size in variants}
+    upload_many('images', [(names[str(size)], data) for size, data in variants.items()], upsert=True)
+    obj.image_variants = names
+    obj.save(update_fields=['image_variants'])
+    if obj.image_blob_id:
+        obj.image_blob.add_derived(names.values())
+
+
+def shared_variants(obj):
+    # Variants are named after the blob, so any object holding the same
+    # image already points at them.
+    for model in (Album, CustomUser, Playlist):
+        variants = model.objects.filter(image_blob_id=obj.image_blob_id).exclude(image_variants={}).values_list('image_variants', flat=True).first()
+        if variants:
+            return variants
+    return None
+
+
+def image_srcset(obj):
+    # {width: url} for the frontend's srcset/sizes; falls back to nothing
+    # until the variants job has run.
+    if not obj.image:
+        return {}
+    return {size: get_image_url(name) for size, name in obj.image_variants.items()}
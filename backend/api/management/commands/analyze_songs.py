@@ -0,0 +1,59 @@
+import contextlib
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from api.media import save_analysis, song_audio_file
+from api.models import Song
+from api.waveform import analyze_audio
+
+
+class Command(BaseCommand):
+    help = 'Computes waveform peaks, loudness and the decoded duration of songs in a process pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+        parser.add_argument('--all', action='store_true', help='Re-analyse songs that already have an analysis.')
+
+    def handle(self, *args, **options):
+        songs = Song.objects.only('id', 'title', 'file', 'duration', 'album_id').order_by('id')
+        if not options['all']:
+            songs = songs.filter(analysis__isnull=True)
+
+        done = failed = 0
+        # Decoding runs in the pool; downloads (when there is no local copy)
+        # and database writes stay in this process.
+        with ProcessPoolExecutor(options['processes']) as pool:
+            running = {}
+
+            def collect(futures):
+                nonlocal done, failed
+                for future in futures:
+                    song, files = running.pop(future)
+                    try:
+                        save_analysis(song, future.result())
+                        done += 1
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"{song.id} {song.title}: {type(e).__name__}: {e}")
+                    finally:
+                        files.close()
+
+            try:
+                for song in songs.iterator(chunk_size=500):
+                    files = contextlib.ExitStack()
+                    try:
+                        path = files.enter_context(song_audio_file(song))
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"{song.id} {song.title}: {type(e).__name__}: {e}")
+                        continue
+                    running[pool.submit(analyze_audio, path)] = (song, files)
+
+                    if len(running) >= 2 * options['processes']:
+                        collect(wait(running, return_when=FIRST_COMPLETED).done)
+                collect(list(running))
+            finally:
+                for _, files in running.values():
+                    files.close()
+
+        self.stdout.write(self.style.SUCCESS(f"Analysed {done} songs, {failed} failed"))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from api.models import CustomUser
+
+Follow = CustomUser.followed_artists.through
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored followers_count and following_count of every user from the follow table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the users whose counts drifted.')
+
+    def handle(self, *args, **options):
+        def count(field):
+            rows = Follow.objects.filter(**{field: OuterRef('pk')}).values(field).annotate(n=Count('id')).values('n').order_by()
+            return Coalesce(Subquery(rows), Value(0), output_field=IntegerField())
+
+        users = CustomUser.objects.only('id', 'followers_count', 'following_count').annotate(
+            actual_followers=count('to_customuser'),
+            actual_following=count('from_customuser'),
+        )
+
+        drifted = []
+        for user in users.iterator(chunk_size=1000):
+            if (user.followers_count, user.following_count) != (user.actual_followers, user.actual_following):
+                user.followers_count, user.following_count = user.actual_followers, user.actual_following
+                drifted.append(user)
+
+        if not options['dry_run']:
+            CustomUser.objects.bulk_update(drifted, ['followers_count', 'following_count'], batch_size=1000)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(drifted)} users drifted" + (" (dry run, nothing written)" if options['dry_run'] else ", fixed")
+        ))
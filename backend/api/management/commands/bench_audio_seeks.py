@@ -0,0 +1,60 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.views.static import serve
+from api.streaming import ranged_file_response
+
+
+class Command(BaseCommand):
+    help = 'Issues concurrent random seeks (Range requests) against the media dev view and the streaming view and compares latency and bytes read.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=64)
+        parser.add_argument('--seeks', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--range-kb', type=int, default=256, help='Bytes requested per seek.')
+
+    def handle(self, *args, **options):
+        size = options['size_mb'] * 1024 * 1024
+        length = options['range_kb'] * 1024
+        rng = random.Random(0)
+        offsets = [rng.randrange(0, size - length) for _ in range(options['seeks'])]
+        factory = RequestFactory()
+
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'bench.mp3')
+            with open(path, 'wb') as file:
+                for _ in range(options['size_mb']):
+                    file.write(os.urandom(1024 * 1024))
+
+            views = {
+                'static.serve': lambda request: serve(request, 'bench.mp3', document_root=root),
+                'stream': lambda request: ranged_file_response(request, path),
+            }
+            for label, view in views.items():
+                def seek(offset):
+                    request = factory.get('/bench.mp3', HTTP_RANGE=f"bytes={offset}-{offset + length - 1}")
+                    start = time.perf_counter()
+                    response = view(request)
+                    read = sum(len(chunk) for chunk in response.streaming_content)
+                    response.close()
+                    return time.perf_counter() - start, read, response.status_code
+
+                with ThreadPoolExecutor(options['concurrency']) as pool:
+                    start = time.perf_counter()
+                    results = list(pool.map(seek, offsets))
+                    elapsed = time.perf_counter() - start
+
+                latencies = sorted(latency for latency, _, _ in results)
+                read = sum(read for _, read, _ in results)
+                statuses = sorted({status for _, _, status in results})
+                self.stdout.write(
+                    f"{label:<13} status: {statuses}  p50: {statistics.median(latencies) * 1000:>8.2f} ms  "
+                    f"p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:>8.2f} ms  "
+                    f"read: {read / 1024 / 1024:>9.1f} MB  seeks/s: {len(offsets) / elapsed:>8.1f}"
+                )
@@ -0,0 +1,84 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from api.models import CustomUser, Album, Song, Playlist, PlaylistSong
+
+
+class Command(BaseCommand):
+    help = 'Compares dense (shift the tail) and gap-based PlaylistSong ordering. Runs inside a rolled back transaction.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', type=int, default=5000)
+        parser.add_argument('--changes', type=int, default=50, help='Number of removals and of inserts to perform.')
+
+    def handle(self, *args, **options):
+        tracks = options['tracks']
+        changes = options['changes']
+
+        with transaction.atomic():
+            user = CustomUser.objects.create_user(email='bench-ordering@example.com', password=None, username='bench')
+            album = Album.objects.create(title='bench', artist=user)
+            song = Song.objects.create(title='bench', album=album, duration=timedelta(seconds=1), file='songs/bench.mp3', track_number=1)
+
+            dense = Playlist.objects.create(user=user, name='dense')
+            PlaylistSong.objects.bulk_create(
+                [PlaylistSong(playlist=dense, song=song, order=idx) for idx in range(tracks)], batch_size=1000
+            )
+            gapped = Playlist.objects.create(user=user, name='gapped')
+            PlaylistSong.objects.bulk_create(
+                [PlaylistSong(playlist=gapped, song=song, order=(idx + 1) * PlaylistSong.ORDER_GAP) for idx in range(tracks)], batch_size=1000
+            )
+
+            self.report('dense remove', *self.measure(dense, lambda: self.dense_remove(dense, changes)))
+            self.report('gapped remove', *self.measure(gapped, lambda: self.gapped_remove(gapped, changes)))
+            self.report('dense insert', *self.measure(dense, lambda: self.dense_insert(dense, song, changes)))
+            self.report('gapped insert', *self.measure(gapped, lambda: self.gapped_insert(gapped, song, changes)))
+
+            transaction.set_rollback(True)
+
+    def measure(self, playlist, run):
+        before = dict(playlist.playlist_songs.values_list('id', 'order'))
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+        after = dict(playlist.playlist_songs.values_list('id', 'order'))
+
+        # Rows deleted, inserted or renumbered.
+        rows = len(before.keys() - after.keys()) + sum(1 for pk, order in after.items() if before.get(pk) != order)
+        return rows, len(queries), elapsed
+
+    def report(self, label, rows, queries, elapsed):
+        self.stdout.write(f"{label:<14} rows written: {rows:>8}  queries: {queries:>5}  time: {elapsed * 1000:>9.1f} ms")
+
+    def middle_rows(self, playlist, count):
+        total = playlist.playlist_songs.count()
+        return list(playlist.playlist_songs.order_by('order')[total // 2:total // 2 + count])
+
+    def dense_remove(self, playlist, count):
+        for playlist_song in self.middle_rows(playlist, count):
+            removed_order = playlist_song.order
+            playlist_song.delete()
+            PlaylistSong.objects.filter(
+                playlist=playlist, order__gt=removed_order
+            ).update(order=F('order') - 1)
+
+    def gapped_remove(self, playlist, count):
+        for playlist_song in self.middle_rows(playlist, count):
+            playlist_song.delete()
+
+    def dense_insert(self, playlist, song, count):
+        position = playlist.playlist_songs.count() // 2
+        for _ in range(count):
+            PlaylistSong.objects.filter(
+                playlist=playlist, order__gte=position
+            ).update(order=F('order') + 1)
+            PlaylistSong.objects.create(playlist=playlist, song=song, order=position)
+
+    def gapped_insert(self, playlist, song, count):
+        position = playlist.playlist_songs.count() // 2
+        for idx in range(count):
+            playlist.insert_song(song, position + idx)
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+from django.core.management.base import BaseCommand
+from api.async_storage import AsyncSupabaseStorage
+from api.storage import SupabaseStorage
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Just enough of Supabase storage (TUS uploads, batch sign and remove)
+    # to time clients against; every request waits `server.latency`.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, headers=None, body=b''):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == '/storage/v1/upload/resumable':
+            upload = uuid.uuid4().hex
+            self.server.uploads[upload] = 0
+            return self.reply(201, {'Location': f"http://{self.headers['Host']}/upload/{upload}"})
+        paths = json.loads(body)['paths']
+        bucket = self.path.rsplit('/', 1)[1]
+        return self.reply(200, {'Content-Type': 'application/json'}, json.dumps([
+            {'path': path, 'error': None, 'signedURL': f"/object/sign/{bucket}/{path}?token=bench"} for path in paths
+        ]).encode())
+
+    def do_PATCH(self):
+        upload = self.path.rsplit('/', 1)[1]
+        self.server.uploads[upload] += len(self.read_body())
+        self.reply(204, {'Upload-Offset': str(self.server.uploads[upload])})
+
+    def do_HEAD(self):
+        self.reply(200, {'Upload-Offset': str(self.server.uploads[self.path.rsplit('/', 1)[1]])})
+
+    def do_DELETE(self):
+        self.read_body()
+        self.reply(200, {'Content-Type': 'application/json'}, b'[]')
+
+
+class StandInServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops concurrent connects into a 1s SYN retry.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class Command(BaseCommand):
+    help = 'Uploads a batch of files to a local stand-in for Supabase storage serially and through the async client, and compares wall time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=15)
+        parser.add_argument('--size-kb', type=int, default=512)
+        parser.add_argument('--latency-ms', type=int, default=50, help='Added to every request by the stand-in server.')
+        parser.add_argument('--concurrency', type=int, default=8)
+
+    def handle(self, *args, **options):
+        server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        server.latency = options['latency_ms'] / 1000
+        server.uploads = {}
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        try:
+            with tempfile.TemporaryDirectory() as root:
+                items = []
+                for i in range(options['files']):
+                    path = os.path.join(root, f'track_{i:02d}.mp3')
+                    with open(path, 'wb') as file:
+                        file.write(os.urandom(options['size_kb'] * 1024))
+                    items.append((f'bench/track_{i:02d}.mp3', path))
+                names = [name for name, _ in items]
+
+                storage = SupabaseStorage(url, 'bench')
+                self.report('serial, client per upload', lambda: [storage.stream_put('audio', name, path) for name, path in items])
+                with httpx.Client() as client:
+                    self.report('serial, pooled client', lambda: [storage.stream_put('audio', name, path, client=client) for name, path in items])
+
+                async def batch():
+                    async_storage = AsyncSupabaseStorage(url, 'bench', options['concurrency'])
+                    try:
+                        start = time.perf_counter()
+                        await async_storage.upload_many('audio', items)
+                        uploaded = time.perf_counter() - start
+                        start = time.perf_counter()
+                        await async_storage.url_many('audio', names, signed=True)
+                        signed = time.perf_counter() - start
+                        start = time.perf_counter()
+                        await async_storage.delete_many('audio', names)
+                        deleted = time.perf_counter() - start
+                    finally:
+                        await async_storage.aclose()
+                    return uploaded, signed, deleted
+
+                uploaded, signed, deleted = asyncio.run(batch())
+                self.write(f"upload_many, concurrency {options['concurrency']}", uploaded)
+                self.write('url_many (signed)', signed)
+                self.write('delete_many', deleted)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def report(self, label, run):
+        start = time.perf_counter()
+        run()
+        self.write(label, time.perf_counter() - start)
+
+    def write(self, label, elapsed):
+        self.stdout.write(f"{label:<28} {elapsed * 1000:>9.1f} ms")
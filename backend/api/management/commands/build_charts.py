@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from api.charts import build_chart_snapshot, CHART_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Computes the per-genre top songs charts into a new ChartSnapshot. Meant to be run on a schedule (e.g. cron every 15 minutes).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=CHART_SIZE, help='Songs per genre chart.')
+
+    def handle(self, *args, **options):
+        snapshot = build_chart_snapshot(options['limit'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Built charts snapshot {snapshot.id} with {len(snapshot.data)} genres (etag {snapshot.etag})"
+        ))
@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from api.images import image_source, render_variants, store_variants
+from api.models import Album, CustomUser, Playlist
+
+
+class Command(BaseCommand):
+    help = 'Generates the WebP size variants of album covers, artist images and playlist collages in a process pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+        parser.add_argument('--all', action='store_true', help='Rebuild images that already have variants.')
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        # Resizing and encoding run in the pool; downloads, uploads and
+        # database writes stay in this process.
+        with ProcessPoolExecutor(options['processes']) as pool:
+            running = {}
+
+            def collect(futures):
+                nonlocal done, failed
+                for future in futures:
+                    obj = running.pop(future)
+                    try:
+                        store_variants(obj, future.result())
+                        done += 1
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"{obj._meta.model_name} {obj.pk}: {type(e).__name__}: {e}")
+
+            for model in (Album, CustomUser, Playlist):
+                objects = model.objects.exclude(image='').exclude(image__isnull=True).order_by('pk')
+                if not options['all']:
+                    objects = objects.filter(image_variants={})
+                for obj in objects.iterator(chunk_size=500):
+                    try:
+                        source = image_source(obj)
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"{model._meta.model_name} {obj.pk}: {type(e).__name__}: {e}")
+                        continue
+                    running[pool.submit(render_variants, source)] = obj
+
+                    if len(running) >= 2 * options['processes']:
+                        collect(wait(running, return_when=FIRST_COMPLETED).done)
+            collect(list(running))
+
+        self.stdout.write(self.style.SUCCESS(f"Built variants for {done} images, {failed} failed"))
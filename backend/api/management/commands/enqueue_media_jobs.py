@@ -0,0 +1,26 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from api.media import BACKFILLS
+from api.models import MediaJob
+
+
+class Command(BaseCommand):
+    help = 'Queues a media job for every object still missing its output, e.g. songs without an HLS manifest.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(BACKFILLS))
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        queryset = BACKFILLS[options['kind']]()
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        ids = list(queryset.values_list('pk', flat=True))
+
+        # Objects that already have a pending job are skipped by its unique constraint.
+        MediaJob.objects.bulk_create([
+            MediaJob(kind=options['kind'], content_type=content_type, object_id=object_id) for object_id in ids
+        ], batch_size=options['batch_size'], ignore_conflicts=True)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(ids)} {queryset.model._meta.verbose_name_plural} missing {options['kind']}, queued the ones without a pending job"
+        ))
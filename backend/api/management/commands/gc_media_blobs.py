@@ -0,0 +1,22 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from api.blobs import GC_GRACE, collect_garbage, recount_references
+
+
+class Command(BaseCommand):
+    help = 'Recounts MediaBlob references and deletes blobs (and their derived files) that nothing has referenced for the grace period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=GC_GRACE.total_seconds() / 3600)
+        parser.add_argument('--dry-run', action='store_true', help='Only list the blobs that would be deleted.')
+
+    def handle(self, *args, **options):
+        drifted = 0 if options['dry_run'] else recount_references()
+        blobs = collect_garbage(timedelta(hours=options['grace_hours']), dry_run=options['dry_run'])
+        for blob in blobs:
+            self.stdout.write(f"{blob.bucket}/{blob.key} ({blob.size} bytes, {len(blob.derived_keys)} derived)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{drifted} reference counts fixed, {len(blobs)} blobs "
+            + ("would be deleted (dry run)" if options['dry_run'] else "deleted")
+        ))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from api.provisioning import read_users, provision_users
+
+
+class Command(BaseCommand):
+    help = ('Creates users in bulk from a CSV or NDJSON file (email, username, password, first_name, last_name, type), '
+            'with their playback state, Liked Songs playlist and library. Passwords must be pre-hashed; '
+            'users whose email already exists are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default=None, help='Defaults to the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users created per transaction.')
+
+    def handle(self, *args, **options):
+        created, skipped, errors = provision_users(read_users(options['path'], options['format']), options['chunk_size'])
+
+        for line, error in errors:
+            self.stderr.write(f"line {line}: {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {created} users, skipped {skipped} existing, {len(errors)} invalid rows"
+        ))
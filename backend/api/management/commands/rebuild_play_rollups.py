@@ -0,0 +1,22 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.rollups import rebuild_daily_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the song, artist and genre daily play rollups from raw SongPlayback rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Only rebuild the last N days (default: full history).')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['days'] is not None:
+            since = timezone.localdate() - timedelta(days=options['days'])
+
+        rebuild_daily_rollups(since)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt daily play rollups since {since}" if since else "Rebuilt daily play rollups"
+        ))
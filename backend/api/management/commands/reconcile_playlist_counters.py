@@ -0,0 +1,40 @@
+from datetime import timedelta
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from api.models import Playlist, PlaylistSong, LibraryItem
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored songs_count, total_duration and savings of every playlist and fixes the ones that drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the playlists that drifted.')
+
+    def handle(self, *args, **options):
+        tracks = PlaylistSong.objects.filter(playlist=OuterRef('pk')).values('playlist').order_by()
+        # Saves by other users; the owner's own library entry is not counted.
+        saves = LibraryItem.objects.filter(
+            content_type=ContentType.objects.get_for_model(Playlist), object_id=OuterRef('pk')
+        ).exclude(library__user=OuterRef('user')).values('content_type').order_by()
+
+        playlists = Playlist.objects.only('id', 'user', 'songs_count', 'total_duration', 'savings').annotate(
+            actual_count=Coalesce(Subquery(tracks.annotate(n=Count('id')).values('n')), Value(0), output_field=IntegerField()),
+            actual_duration=Subquery(tracks.annotate(d=Sum('song__duration')).values('d')),
+            actual_savings=Coalesce(Subquery(saves.annotate(n=Count('id')).values('n')), Value(0), output_field=IntegerField()),
+        )
+
+        drifted = []
+        for playlist in playlists.iterator(chunk_size=1000):
+            actual = (playlist.actual_count, playlist.actual_duration or timedelta(0), playlist.actual_savings)
+            if (playlist.songs_count, playlist.total_duration, playlist.savings) != actual:
+                playlist.songs_count, playlist.total_duration, playlist.savings = actual
+                drifted.append(playlist)
+
+        if not options['dry_run']:
+            Playlist.objects.bulk_update(drifted, ['songs_count', 'total_duration', 'savings'], batch_size=1000)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(drifted)} playlists drifted" + (" (dry run, nothing written)" if options['dry_run'] else ", fixed")
+        ))
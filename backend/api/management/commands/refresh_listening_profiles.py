@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from api.rollups import rebuild_listening_profiles
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily listening rows from the last 30 days of SongPlayback, drops older rows and stores each profile\'s top songs, artists, genres and listening time. Meant to be run nightly.'
+
+    def handle(self, *args, **options):
+        count = rebuild_listening_profiles()
+        self.stdout.write(self.style.SUCCESS(f"Refreshed {count} listening profiles"))
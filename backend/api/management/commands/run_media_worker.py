@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api.media import HANDLERS, ffmpeg_available, run_job
+from api.models import MediaJob
+
+
+class Command(BaseCommand):
+    help = 'Processes queued media jobs (HLS packaging, ...). Several workers can run side by side.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', choices=sorted(HANDLERS), help='Only run jobs of this kind (repeatable).')
+        parser.add_argument('--batch-size', type=int, default=5)
+        parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Exit once no job is runnable.')
+
+    def handle(self, *args, **options):
+        if not ffmpeg_available():
+            self.stderr.write(self.style.WARNING("ffmpeg was not found; jobs that need it will fail and be retried."))
+
+        while True:
+            jobs = MediaJob.claim(options['batch_size'], options['kind'])
+            for job in jobs:
+                start = time.perf_counter()
+                result = run_job(job)
+                elapsed = time.perf_counter() - start
+                if result == 'done':
+                    self.stdout.write(f"{job} done in {elapsed:.1f}s")
+                elif result == 'failed':
+                    self.stderr.write(f"{job} attempt {job.attempts}: {job.last_error}")
+                else:
+                    self.stderr.write(f"{job} lease lost after {elapsed:.1f}s; another worker owns it now")
+
+            if not jobs:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                close_old_connections()
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from api.cleanup import sweep_orphans
+
+
+class Command(BaseCommand):
+    help = 'Deletes LibraryItem and PlaybackHistory rows whose object no longer exists, in batches. Meant to be run on a schedule (e.g. nightly cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Objects cleaned up per transaction.')
+
+    def handle(self, *args, **options):
+        removed = sweep_orphans(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Removed {removed['library_items']} orphaned library items and {removed['playback_history']} playback history rows"
+        ))
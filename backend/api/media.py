@@ -0,0 +1,205 @@
+import contextlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import httpx
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from .async_storage import upload_many
+from .images import image_source, render_variants, shared_variants, store_variants
+from .models import Song, SongAnalysis
+from .storage import LocalStorage, get_storage
+from .utils import get_audio_url
+from .waveform import analyze_audio
+
+HANDLERS = {}
+BACKFILLS = {}
+FFMPEG_TIMEOUT = 15 * 60
+
+
+def media_job(kind, backfill=None):
+    # Registers the handler run_media_worker calls for jobs of `kind`, and
+    # the queryset enqueue_media_jobs uses to find objects still missing it.
+    def register(func):
+        HANDLERS[kind] = func
+        if backfill is not None:
+            BACKFILLS[kind] = backfill
+        return func
+    return register
+
+
+@contextlib.contextmanager
+def keep_lease(job):
+    # Renews the job's lease from a thread while the handler runs, so a
+    # slow ffmpeg call never lets a second worker claim the job.
+    stop = threading.Event()
+
+    def renew():
+        try:
+            while not stop.wait(job.LEASE_RENEWAL.total_seconds()):
+                if not job.renew():
+                    return
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=renew, name=f'media-job-{job.pk}-lease', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(job):
+    # 'done', 'failed' or 'lost' (another worker holds the job now).
+    # Jobs of a batch wait for the ones before them, so the lease taken at
+    # claim time is renewed first.
+    if not job.renew():
+        return 'lost'
+    obj = job.content_object
+    if obj is None:
+        # Deleted after it was enqueued.
+        return 'done' if job.finish() else 'lost'
+    try:
+        with keep_lease(job):
+            HANDLERS[job.kind](obj)
+    except Exception as e:
+        return 'failed' if job.fail(f"{type(e).__name__}: {e}") else 'lost'
+    return 'done' if job.finish() else 'lost'
+
+
+def song_audio_path(song):
+    storage = get_storage()
+    if isinstance(storage, LocalStorage) and storage.exists('audio', song.audio_name):
+        return storage.path('audio', song.audio_name)
+    if song.file and os.path.isfile(song.file.path):
+        return song.file.path
+    return None
+
+
+@contextlib.contextmanager
+def song_audio_file(song):
+    # A local path to the song's audio, downloaded from storage when this
+    # machine has no copy (e.g. a worker separate from the web server).
+    path = song_audio_path(song)
+    if path is not None:
+        yield path
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(song.audio_name)[1]) as file:
+        with httpx.stream('GET', get_audio_url(song.audio_name), timeout=60.0, follow_redirects=True) as response:
+            response.raise_for_status()
+            for block in response.iter_bytes():
+                file.write(block)
+        file.flush()
+        yield file.name
+
+
+def run_ffmpeg(*args):
+    try:
+        subprocess.run(
+            [settings.FFMPEG_BINARY, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', *args],
+            check=True, capture_output=True, timeout=FFMPEG_TIMEOUT,
+        )
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(e.stderr.decode(errors='replace')[-1000:]) from None
+
+
+def hls_master_playlist(bitrates):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for bitrate in bitrates:
+        lines += [f'#EXT-X-STREAM-INF:BANDWIDTH={bitrate * 1000},CODECS="mp4a.40.2"', f'{bitrate}k/index.m3u8']
+    return '\n'.join(lines) + '\n'
+
+
+@media_job('hls', backfill=lambda: Song.objects.filter(hls_manifest=''))
+def package_hls(song):
+    # Fixed-length AAC segments per bitrate plus a master playlist, stored
+    # under audio/hls/<song id>/. Players fetch only the segments around
+    # the playhead, so start-up and seeks no longer depend on file size.
+    if song.audio_blob_id:
+        # Songs uploaded with the same bytes share one packaging.
+        packaged = Song.objects.filter(audio_blob_id=song.audio_blob_id).exclude(hls_manifest='').exclude(pk=song.pk)
+        if manifest := packaged.values_list('hls_manifest', flat=True).first():
+            song.hls_manifest = manifest
+            song.save(update_fields=['hls_manifest'])
+            return
+
+    prefix = f"hls/{song.audio_blob.sha256}" if song.audio_blob_id else f"hls/{song.id}"
+    bitrates = sorted(settings.HLS_BITRATES)
+
+    with song_audio_file(song) as source, tempfile.TemporaryDirectory() as workdir:
+        for bitrate in bitrates:
+            variant = os.path.join(workdir, f'{bitrate}k')
+            os.makedirs(variant)
+            run_ffmpeg(
+                '-i', source, '-map', '0:a:0', '-vn', '-c:a', 'aac', '-b:a', f'{bitrate}k',
+                '-f', 'hls', '-hls_time', str(settings.HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                '-hls_segment_filename', os.path.join(variant, 'segment_%05d.ts'), os.path.join(variant, 'index.m3u8'),
+            )
+        with open(os.path.join(workdir, 'master.m3u8'), 'w') as file:
+            file.write(hls_master_playlist(bitrates))
+
+        # Playlists go up after their segments and the master playlist last,
+        # so a client never loads a playlist pointing at missing files. Each
+        # stage uploads concurrently.
+        files = [
+            os.path.relpath(os.path.join(root, name), workdir)
+            for root, _, names in os.walk(workdir) for name in names
+        ]
+        for stage in (
+            [name for name in files if not name.endswith('.m3u8')],
+            [name for name in files if name.endswith('.m3u8') and name != 'master.m3u8'],
+            ['master.m3u8'],
+        ):
+            upload_many('audio', [(f"{prefix}/{name}", os.path.join(workdir, name)) for name in sorted(stage)], upsert=True)
+        if song.audio_blob_id:
+            song.audio_blob.add_derived([f"{prefix}/{name}" for name in files])
+
+    song.hls_manifest = f"{prefix}/master.m3u8"
+    song.save(update_fields=['hls_manifest'])
+
+
+def save_analysis(song, result):
+    with transaction.atomic():
+        SongAnalysis.objects.update_or_create(song=song, defaults={
+            'peaks': result['peaks'], 'points': result['points'], 'loudness': result['loudness'],
+        })
+        song.set_duration(result['duration'])
+        song.waveform_version = F('waveform_version') + 1
+        song.save(update_fields=['waveform_version'])
+        song.refresh_from_db(fields=['waveform_version'])
+
+
+@media_job('waveform', backfill=lambda: Song.objects.filter(analysis__isnull=True))
+def analyze_song(song):
+    analysed = None
+    if song.audio_blob_id:
+        # Same bytes as an analysed song: nothing to decode.
+        analysed = SongAnalysis.objects.filter(song__audio_blob_id=song.audio_blob_id).exclude(song=song).select_related('song').first()
+    if analysed is not None:
+        result = {'peaks': analysed.peaks, 'points': analysed.points, 'loudness': analysed.loudness, 'duration': analysed.song.duration}
+    else:
+        with song_audio_file(song) as path:
+            result = analyze_audio(path)
+    save_analysis(song, result)
+
+
+@media_job('images')
+def build_image_variants(obj):
+    # Album covers, artist images and playlist collages.
+    if not obj.image:
+        return
+    if obj.image_blob_id and (variants := shared_variants(obj)):
+        obj.image_variants = variants
+        obj.save(update_fields=['image_variants'])
+        return
+    store_variants(obj, render_variants(image_source(obj)))
+
+
+def ffmpeg_available():
+    return shutil.which(settings.FFMPEG_BINARY) is not None
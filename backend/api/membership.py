@@ -0,0 +1,77 @@
+from array import array
+from bisect import bisect_left
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from .models import CustomUser, Album, Playlist, PlaylistSong, Library, LibraryItem
+
+LIKED_SONGS = "Liked Songs"
+MEMBERSHIP_CACHE_TIMEOUT = 60 * 60
+MAX_MEMBERSHIP_IDS = 1000
+
+
+class Membership:
+    # Sorted id arrays of what a user has saved: songs in Liked Songs, albums
+    # and playlists in the library and followed artists. Cached under the
+    # library and Liked Songs versions, so any mutation invalidates it.
+    KINDS = ('song', 'album', 'playlist', 'artist')
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    @classmethod
+    def empty(cls):
+        return cls({kind: array('q') for kind in cls.KINDS})
+
+    @classmethod
+    def for_user(cls, user):
+        if not user.is_authenticated:
+            return cls.empty()
+
+        library = Library.objects.filter(user=user).values_list('id', 'version').first()
+        liked = Playlist.objects.filter(user=user, name=LIKED_SONGS).order_by('id').values_list('id', 'version').first()
+        if library is None:
+            return cls.empty()
+
+        key = f"membership:{user.id}:{library[1]}:{liked[1] if liked else 0}"
+        ids = cache.get(key)
+        if ids is None:
+            ids = cls.build(user, library[0], liked[0] if liked else None)
+            cache.set(key, ids, MEMBERSHIP_CACHE_TIMEOUT)
+        return cls(ids)
+
+    @classmethod
+    def for_request(cls, request):
+        # Shared by every serializer rendering the same request.
+        if not hasattr(request, '_membership'):
+            request._membership = cls.for_user(request.user)
+        return request._membership
+
+    @classmethod
+    def build(cls, user, library_id, liked_id):
+        items = LibraryItem.objects.filter(
+            library_id=library_id,
+            content_type__in=[ContentType.objects.get_for_model(Album), ContentType.objects.get_for_model(Playlist)],
+        ).values_list('content_type', 'object_id')
+
+        album_type = ContentType.objects.get_for_model(Album).id
+        albums, playlists = [], []
+        for content_type, object_id in items:
+            (albums if content_type == album_type else playlists).append(object_id)
+
+        songs = PlaylistSong.objects.filter(playlist_id=liked_id).values_list('song_id', flat=True) if liked_id else []
+        artists = CustomUser.objects.filter(followers=user).values_list('id', flat=True)
+
+        return {
+            'song': array('q', sorted(set(songs))),
+            'album': array('q', sorted(albums)),
+            'playlist': array('q', sorted(playlists)),
+            'artist': array('q', sorted(artists)),
+        }
+
+    def contains(self, kind, object_id):
+        ids = self.ids[kind]
+        idx = bisect_left(ids, object_id)
+        return idx < len(ids) and ids[idx] == object_id
+
+    def lookup(self, kind, object_ids):
+        return [self.contains(kind, object_id) for object_id in object_ids]
@@ -0,0 +1,100 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    SongPlayback = apps.get_model('api', 'SongPlayback')
+    playbacks = SongPlayback.objects.annotate(day=TruncDate('played_at')).order_by()
+
+    for model_name, key_field, group_field in [
+        ('SongDailyPlays', 'song_id', 'song_id'),
+        ('ArtistDailyPlays', 'artist_id', 'song__album__artist_id'),
+        ('GenreDailyPlays', 'genre', 'song__genre'),
+    ]:
+        model = apps.get_model('api', model_name)
+        rows = playbacks.values(group_field, 'day').annotate(
+            plays=Count('id'), listeners=Count('user', distinct=True)
+        )
+        model.objects.bulk_create(
+            [model(**{key_field: row[group_field]}, day=row['day'], plays=row['plays'], distinct_listeners=row['listeners'])
+             for row in rows],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_remove_song_plays'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtistDailyPlays',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('plays', models.PositiveIntegerField(default=0)),
+                ('distinct_listeners', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GenreDailyPlays',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('genre', models.CharField(choices=[('pop', 'Pop'), ('rock', 'Rock'), ('hip-hop', 'Hip-Hop'), ('jazz', 'Jazz'), ('blues', 'Blues'), ('country', 'Country'), ('electronic', 'Electronic'), ('reggae', 'Reggae'), ('rap', 'Rap'), ('r&b', 'R&B'), ('classical', 'Classical'), ('other', 'Other')], max_length=50)),
+                ('day', models.DateField()),
+                ('plays', models.PositiveIntegerField(default=0)),
+                ('distinct_listeners', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SongDailyPlays',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('plays', models.PositiveIntegerField(default=0)),
+                ('distinct_listeners', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='songplayback',
+            index=models.Index(fields=['user', 'played_at'], name='api_songpla_user_id_98d9df_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='songplayback',
+            index=models.Index(fields=['played_at'], name='api_songpla_played__a4f41b_idx'),
+        ),
+        migrations.AddField(
+            model_name='artistdailyplays',
+            name='artist',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_plays', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='genredailyplays',
+            constraint=models.UniqueConstraint(fields=('genre', 'day'), name='unique_genre_daily_plays'),
+        ),
+        migrations.AddField(
+            model_name='songdailyplays',
+            name='song',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_plays', to='api.song'),
+        ),
+        migrations.AddConstraint(
+            model_name='artistdailyplays',
+            constraint=models.UniqueConstraint(fields=('artist', 'day'), name='unique_artist_daily_plays'),
+        ),
+        migrations.AddIndex(
+            model_name='songdailyplays',
+            index=models.Index(fields=['day', 'song'], name='api_songdai_day_b7a957_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='songdailyplays',
+            constraint=models.UniqueConstraint(fields=('song', 'day'), name='unique_song_daily_plays'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_daily_play_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChartSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('etag', models.CharField(max_length=64)),
+                ('data', models.JSONField(default=list)),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:39
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Max
+
+RECENTLY_PLAYED_LIMIT = 50
+
+
+def dedupe_playback_history(apps, schema_editor):
+    PlaybackHistory = apps.get_model('api', 'PlaybackHistory')
+
+    latest_ids = PlaybackHistory.objects.values('user', 'content_type', 'object_id').annotate(latest=Max('id')).values('latest')
+    PlaybackHistory.objects.exclude(id__in=latest_ids).delete()
+
+    for user_id in PlaybackHistory.objects.values_list('user', flat=True).distinct():
+        stale_ids = PlaybackHistory.objects.filter(user_id=user_id).order_by('-played_at').values_list('id', flat=True)[RECENTLY_PLAYED_LIMIT:]
+        PlaybackHistory.objects.filter(id__in=list(stale_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_chartsnapshot'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='playbackhistory',
+            name='played_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(dedupe_playback_history, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='playbackhistory',
+            index=models.Index(fields=['user', '-played_at'], name='api_playbac_user_id_925b5e_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='playbackhistory',
+            constraint=models.UniqueConstraint(fields=('user', 'content_type', 'object_id'), name='unique_playback_history_item'),
+        ),
+    ]
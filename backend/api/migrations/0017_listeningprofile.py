@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_recently_played_dedupe'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListeningProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('song_plays', models.JSONField(default=dict)),
+                ('artist_plays', models.JSONField(default=dict)),
+                ('genre_plays', models.JSONField(default=dict)),
+                ('total_seconds', models.PositiveIntegerField(default=0)),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='listening_profile', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
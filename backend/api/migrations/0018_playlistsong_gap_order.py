@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:41
+
+from django.db import migrations, models
+
+ORDER_GAP = 1024
+
+
+def spread_orders(apps, schema_editor):
+    PlaylistSong = apps.get_model('api', 'PlaylistSong')
+
+    playlist_ids = PlaylistSong.objects.values_list('playlist_id', flat=True).distinct()
+    for playlist_id in playlist_ids:
+        playlist_songs = list(PlaylistSong.objects.filter(playlist_id=playlist_id).order_by('order', 'id').only('id', 'order'))
+        for idx, playlist_song in enumerate(playlist_songs):
+            playlist_song.order = (idx + 1) * ORDER_GAP
+        PlaylistSong.objects.bulk_update(playlist_songs, ['order'], batch_size=1000)
+
+
+def compact_orders(apps, schema_editor):
+    PlaylistSong = apps.get_model('api', 'PlaylistSong')
+
+    playlist_ids = PlaylistSong.objects.values_list('playlist_id', flat=True).distinct()
+    for playlist_id in playlist_ids:
+        playlist_songs = list(PlaylistSong.objects.filter(playlist_id=playlist_id).order_by('order', 'id').only('id', 'order'))
+        for idx, playlist_song in enumerate(playlist_songs):
+            playlist_song.order = idx
+        PlaylistSong.objects.bulk_update(playlist_songs, ['order'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_listeningprofile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='playlistsong',
+            name='order',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.RunPython(spread_orders, compact_orders),
+        migrations.AddIndex(
+            model_name='playlistsong',
+            index=models.Index(fields=['playlist', 'order'], name='api_playlis_playlis_92226a_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:49
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_playlistsong_gap_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playlistsong',
+            name='added_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
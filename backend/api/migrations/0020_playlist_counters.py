@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:51
+
+import datetime
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_counters(apps, schema_editor):
+    Playlist = apps.get_model('api', 'Playlist')
+    playlists = list(Playlist.objects.annotate(
+        counted=Count('playlist_songs'), duration=Sum('playlist_songs__song__duration')
+    ))
+    for playlist in playlists:
+        playlist.songs_count = playlist.counted
+        playlist.total_duration = playlist.duration or datetime.timedelta(0)
+    Playlist.objects.bulk_update(playlists, ['songs_count', 'total_duration'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_playlistsong_added_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playlist',
+            name='songs_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='playlist',
+            name='total_duration',
+            field=models.DurationField(default=datetime.timedelta(0)),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
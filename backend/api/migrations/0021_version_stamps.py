@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_playlist_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='library',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='playlist',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1),
+        ),
+    ]
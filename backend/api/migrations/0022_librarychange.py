@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_version_stamps'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LibraryChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('add', 'Add'), ('remove', 'Remove'), ('pin', 'Pin'), ('unpin', 'Unpin'), ('update', 'Update')], max_length=10)),
+                ('item_id', models.PositiveBigIntegerField()),
+                ('object_id', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('library', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='api.library')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['library', 'id'], name='api_library_library_2ef46b_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:02
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_follow_counts(apps, schema_editor):
+    CustomUser = apps.get_model('api', 'CustomUser')
+    Follow = CustomUser._meta.get_field('followed_artists').remote_field.through
+
+    following = dict(Follow.objects.values_list('from_customuser').annotate(n=Count('id')).order_by())
+    followers = dict(Follow.objects.values_list('to_customuser').annotate(n=Count('id')).order_by())
+    users = list(CustomUser.objects.filter(id__in=following.keys() | followers.keys()))
+    for user in users:
+        user.following_count = following.get(user.id, 0)
+        user.followers_count = followers.get(user.id, 0)
+    CustomUser.objects.bulk_update(users, ['following_count', 'followers_count'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_librarychange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='followers_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_follow_counts, migrations.RunPython.noop),
+    ]
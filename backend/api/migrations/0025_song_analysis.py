@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_media_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongAnalysis',
+            fields=[
+                ('song', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='analysis', serialize=False, to='api.song')),
+                ('peaks', models.BinaryField()),
+                ('points', models.PositiveIntegerField()),
+                ('loudness', models.FloatField(blank=True, null=True)),
+                ('analyzed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='mediajob',
+            name='kind',
+            field=models.CharField(choices=[('hls', 'HLS packaging'), ('waveform', 'Waveform analysis')], max_length=20),
+        ),
+    ]
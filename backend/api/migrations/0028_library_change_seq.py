@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:10
+
+from django.db import migrations, models
+from django.db.models import F, Max, OuterRef, Subquery
+
+
+def backfill_change_seq(apps, schema_editor):
+    # Existing ids are increasing within each library, so they carry over as
+    # seqs and cursors clients already hold stay valid.
+    Library = apps.get_model('api', 'Library')
+    LibraryChange = apps.get_model('api', 'LibraryChange')
+    LibraryChange.objects.update(seq=F('id'))
+    Library.objects.update(change_seq=Subquery(
+        LibraryChange.objects.filter(library=OuterRef('pk')).order_by().values('library').annotate(last=Max('seq')).values('last')
+    ))
+    Library.objects.filter(change_seq__isnull=True).update(change_seq=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0027_media_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='library',
+            name='change_seq',
+            field=models.PositiveBigIntegerField(null=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='librarychange',
+            name='seq',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_change_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='library',
+            name='change_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='librarychange',
+            name='seq',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.AlterModelOptions(
+            name='librarychange',
+            options={'ordering': ['library', 'seq']},
+        ),
+        migrations.RemoveIndex(
+            model_name='librarychange',
+            name='api_library_library_2ef46b_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='librarychange',
+            constraint=models.UniqueConstraint(fields=('library', 'seq'), name='unique_library_change_seq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0028_library_change_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='waveform_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:04
+
+import django.db.models.deletion
+from django.conf import settings
+from datetime import timedelta
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+def backfill_user_song_daily_plays(apps, schema_editor):
+    # The last 30 days (ListeningProfile.WINDOW_DAYS), which is all the
+    # profiles read.
+    SongPlayback = apps.get_model('api', 'SongPlayback')
+    UserSongDailyPlays = apps.get_model('api', 'UserSongDailyPlays')
+    since = timezone.now() - timedelta(days=31)
+    rows = SongPlayback.objects.filter(played_at__gte=since).annotate(day=TruncDate('played_at')).order_by().values(
+        'user_id', 'song_id', 'day'
+    ).annotate(plays=Count('id'))
+    UserSongDailyPlays.objects.bulk_create(
+        [UserSongDailyPlays(user_id=row['user_id'], song_id=row['song_id'], day=row['day'], plays=row['plays']) for row in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0029_song_waveform_version'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='listeningprofile',
+            name='artist_plays',
+        ),
+        migrations.RemoveField(
+            model_name='listeningprofile',
+            name='genre_plays',
+        ),
+        migrations.RemoveField(
+            model_name='listeningprofile',
+            name='refreshed_at',
+        ),
+        migrations.RemoveField(
+            model_name='listeningprofile',
+            name='song_plays',
+        ),
+        migrations.RemoveField(
+            model_name='listeningprofile',
+            name='total_seconds',
+        ),
+        migrations.CreateModel(
+            name='UserSongDailyPlays',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('plays', models.PositiveIntegerField(default=0)),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_daily_plays', to='api.song')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='song_daily_plays', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'day'], name='api_userson_user_id_f81be3_idx'), models.Index(fields=['day'], name='api_userson_day_e1e846_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'song', 'day'), name='unique_user_song_daily_plays')],
+            },
+        ),
+        migrations.RunPython(backfill_user_song_daily_plays, migrations.RunPython.noop),
+    ]
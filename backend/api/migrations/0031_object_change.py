@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0030_user_song_daily_plays'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='library',
+            name='updates_txid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ObjectChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('txid', models.BigIntegerField(db_default=models.Func(function='txid_current', output_field=models.BigIntegerField()))),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['content_type', 'object_id', 'txid'], name='api_objectc_content_9fff4f_idx'), models.Index(fields=['txid'], name='api_objectc_txid_fc937f_idx')],
+            },
+        ),
+    ]
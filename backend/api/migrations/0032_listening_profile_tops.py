@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:21
+
+from datetime import timedelta
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_listening_profiles(apps, schema_editor):
+    # Same as ListeningProfile.refresh, so profiles aren't empty until the
+    # next refresh_listening_profiles run.
+    ListeningProfile = apps.get_model('api', 'ListeningProfile')
+    UserSongDailyPlays = apps.get_model('api', 'UserSongDailyPlays')
+    since = timezone.localdate() - timedelta(days=30)
+    for profile in ListeningProfile.objects.all():
+        plays = UserSongDailyPlays.objects.filter(user_id=profile.user_id, day__gte=since)
+        top = lambda field: list(
+            plays.values(field).annotate(total=models.Sum('plays')).order_by('-total', field).values_list(field, flat=True)[:10]
+        )
+        profile.top_song_ids = top('song_id')
+        profile.top_artist_ids = top('song__album__artist_id')
+        profile.top_genres = top('song__genre')
+        total = plays.aggregate(total=models.Sum(
+            models.ExpressionWrapper(models.F('plays') * models.F('song__duration'), output_field=models.DurationField())
+        ))['total']
+        profile.total_seconds = int(total.total_seconds()) if total else 0
+        profile.refreshed_at = timezone.now()
+        profile.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0031_object_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listeningprofile',
+            name='refreshed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='listeningprofile',
+            name='top_artist_ids',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='listeningprofile',
+            name='top_genres',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='listeningprofile',
+            name='top_song_ids',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='listeningprofile',
+            name='total_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_listening_profiles, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,37 @@
+import os
+from datetime import timedelta
 from django.utils import timezone
-from django.db import models
+from django.utils.text import slugify
+from django.db import connection, models, transaction
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 
 # Create your models here.
+class Versioned(models.Model):
+    # Monotonic stamp used as the ETag of the rendered object. save() bumps
+    # it; paths that write with update() call bump_versions() themselves.
+    version = models.PositiveBigIntegerField(default=1)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        bumped = not self._state.adding
+        if bumped:
+            self.version = models.F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+        if bumped:
+            self.refresh_from_db(fields=['version'])
+
+    @classmethod
+    def bump_versions(cls, *args, **lookup):
+        return cls.objects.filter(*args, **lookup).update(version=models.F('version') + 1)
+
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
         if not email:
@@ -36,8 +63,12 @@ class CustomUser(AbstractUser):
     objects = CustomUserManager()
 
     image = models.ImageField(upload_to='users/', blank=True, null=True)
+    image_blob = models.ForeignKey('MediaBlob', related_name='+', on_delete=models.PROTECT, blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True)
     type = models.CharField(max_length=50, choices=[('artist', 'Artist'), ('listener', 'Listener')], default='listener')
     followed_artists = models.ManyToManyField('self', symmetrical=False, related_name='followers', blank=True)
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
     
     def __str__(self):
         return self.username
@@ -47,47 +78,76 @@ class CustomUser(AbstractUser):
         if self.image:
             return self.image.url
         return ""
+
+    @property
+    def image_name(self):
+        # Object name of the uploaded image in the 'images' bucket; images
+        # uploaded before MediaBlob keep their slug-based name.
+        return self.image_blob_id or f"artists/{slugify(self.username)}_{self.id}{os.path.splitext(self.image.name)[1]}"
     
     @property
     def number_of_followed_artists(self):
-        return self.followed_artists.count()
+        return self.following_count
     
     @property
     def number_of_followers(self):
-        return self.followers.count()
+        return self.followers_count
+
+    def _change_follow_counts(self, artist, delta):
+        CustomUser.objects.filter(pk=self.pk).update(following_count=models.F('following_count') + delta)
+        CustomUser.objects.filter(pk=artist.pk).update(followers_count=models.F('followers_count') + delta)
     
     def follow(self, artist):
-        library = Library.objects.get(user=self)
-        if artist == self:
+        # Toggles the follow; returns whether the user follows the artist now.
+        if artist.pk == self.pk:
             raise ValueError("You cannot follow yourself.")
-        
-        if artist in self.followed_artists.all():
-            self.followed_artists.remove(artist)
-            library_item = LibraryItem.objects.get(library=library, content_type=ContentType.objects.get_for_model(artist), object_id=artist.id)
-            library_item.delete()
-        else:
-            self.followed_artists.add(artist)
-            library_item = LibraryItem.objects.create(library=library, content_type=ContentType.objects.get_for_model(artist), object_id=artist.id)
-            library_item.save()
+
+        Follow = CustomUser.followed_artists.through
+        content_type = ContentType.objects.get_for_model(CustomUser)
+        with transaction.atomic():
+            if Follow.objects.filter(from_customuser_id=self.pk, to_customuser_id=artist.pk).delete()[0]:
+                LibraryItem.objects.filter(library__user=self, content_type=content_type, object_id=artist.pk).delete()
+                self._change_follow_counts(artist, -1)
+                return False
+
+            _, created = Follow.objects.get_or_create(from_customuser_id=self.pk, to_customuser_id=artist.pk)
+            if created:
+                LibraryItem.objects.create(
+                    library_id=Library.objects.values_list('id', flat=True).get(user=self),
+                    content_type=content_type, object_id=artist.pk,
+                )
+                self._change_follow_counts(artist, 1)
+            return True
 
 
     
-class Album(models.Model):
+class Album(Versioned):
     title = models.CharField(max_length=255)
     artist = models.ForeignKey(CustomUser, related_name='albums', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='albums/', blank=True, null=True)
+    image_blob = models.ForeignKey('MediaBlob', related_name='+', on_delete=models.PROTECT, blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True)
     release_date = models.DateField(default="2023-01-01")
     album_type = models.CharField(max_length=50, choices=[('single', 'Single'), ('album', 'Album'), ('ep', 'EP')], default='album')
     theme = models.CharField(max_length=50, blank=True, null=True)
 
     def __str__(self):
         return self.title
+
+    @property
+    def image_name(self):
+        return self.image_blob_id or f"albums/{slugify(self.title)}_{self.id}{os.path.splitext(self.image.name)[1]}"
     
 class Song(models.Model):
     title = models.CharField(max_length=255)
     album = models.ForeignKey(Album, related_name='songs', on_delete=models.CASCADE)
     duration = models.DurationField()
     file = models.FileField(upload_to='songs/')
+    audio_blob = models.ForeignKey('MediaBlob', related_name='+', on_delete=models.PROTECT, blank=True, null=True)
+    hls_manifest = models.CharField(max_length=255, blank=True, default='')
+    # Bumped by every saved analysis; versions the waveform URL so it can be
+    # cached for long.
+    waveform_version = models.PositiveIntegerField(default=0)
     lyrics = models.JSONField(blank=True, default=dict, null=False)
     track_number = models.PositiveIntegerField()
     featured_artists = models.ManyToManyField(CustomUser, related_name='featured_songs', blank=True)
@@ -102,11 +162,45 @@ class Song(models.Model):
 
     def __str__(self):
         return self.title
+
+    @property
+    def audio_name(self):
+        # Object name of the uploaded audio in the 'audio' bucket.
+        return self.audio_blob_id or f"audio/{slugify(self.title)}_{self.id}{os.path.splitext(self.file.name)[1]}"
+
+    def set_duration(self, duration):
+        # Playlists store the sum of their songs' durations, so they move by
+        # the difference once per occurrence of the song.
+        delta = duration - self.duration
+        if not delta:
+            return
+        with transaction.atomic():
+            self.duration = duration
+            self.save(update_fields=['duration'])
+            occurrences = {}
+            for playlist_id, count in PlaylistSong.objects.filter(song=self).values('playlist').annotate(
+                count=models.Count('id')
+            ).values_list('playlist', 'count').order_by():
+                occurrences.setdefault(count, []).append(playlist_id)
+            for count, playlist_ids in occurrences.items():
+                Playlist.objects.filter(id__in=playlist_ids).update(total_duration=models.F('total_duration') + delta * count)
     
 
 
 
 
+class SongAnalysis(models.Model):
+    # Written by api.media.analyze_song from one decode of the audio.
+    song = models.OneToOneField(Song, related_name='analysis', on_delete=models.CASCADE, primary_key=True)
+    peaks = models.BinaryField()
+    points = models.PositiveIntegerField()
+    loudness = models.FloatField(null=True, blank=True)
+    analyzed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.song_id} ({self.points} points, {self.loudness} LUFS)"
+
+
 class CurrentPlayback(models.Model):
     user = models.OneToOneField(CustomUser, related_name='current_playback', on_delete=models.CASCADE)
     song = models.ForeignKey(Song, related_name='current_playback_song', blank=True, null=True, on_delete=models.SET_NULL)
@@ -184,40 +278,376 @@ class SongPlayback(models.Model):
     song = models.ForeignKey(Song, related_name='playbacks', on_delete=models.CASCADE)
     played_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'played_at']),
+            models.Index(fields=['played_at']),
+        ]
+
     def __str__(self):
         return f"{self.user.username} played {self.song.title}"
-    
+
+
+# Daily rollups of SongPlayback, kept up to date by the post_save signal on
+# SongPlayback and rebuildable with `manage.py rebuild_play_rollups`.
+class SongDailyPlays(models.Model):
+    song = models.ForeignKey(Song, related_name='daily_plays', on_delete=models.CASCADE)
+    day = models.DateField()
+    plays = models.PositiveIntegerField(default=0)
+    distinct_listeners = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['song', 'day'], name='unique_song_daily_plays'),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'song']),
+        ]
+
+    def __str__(self):
+        return f"{self.song.title} - {self.day} ({self.plays})"
+
+
+class ArtistDailyPlays(models.Model):
+    artist = models.ForeignKey(CustomUser, related_name='daily_plays', on_delete=models.CASCADE)
+    day = models.DateField()
+    plays = models.PositiveIntegerField(default=0)
+    distinct_listeners = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['artist', 'day'], name='unique_artist_daily_plays'),
+        ]
+
+    def __str__(self):
+        return f"{self.artist.username} - {self.day} ({self.plays})"
+
+
+class GenreDailyPlays(models.Model):
+    genre = models.CharField(max_length=50, choices=Song._meta.get_field('genre').choices)
+    day = models.DateField()
+    plays = models.PositiveIntegerField(default=0)
+    distinct_listeners = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['genre', 'day'], name='unique_genre_daily_plays'),
+        ]
+
+    def __str__(self):
+        return f"{self.genre} - {self.day} ({self.plays})"
+
+
+
+class UserSongDailyPlays(models.Model):
+    user = models.ForeignKey(CustomUser, related_name='song_daily_plays', on_delete=models.CASCADE)
+    song = models.ForeignKey(Song, related_name='user_daily_plays', on_delete=models.CASCADE)
+    day = models.DateField()
+    plays = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'song', 'day'], name='unique_user_song_daily_plays'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'day']),
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.song.title} - {self.day} ({self.plays})"
+
+
+# Per-user listening stats over the last WINDOW_DAYS days, read from the
+# user's UserSongDailyPlays rows, so days leave the window on their own.
+# `manage.py refresh_listening_profiles` rebuilds the rows from SongPlayback
+# and drops the ones past the window; it is meant to run nightly.
+class ListeningProfile(models.Model):
+    WINDOW_DAYS = 30
+    TOP_LIMIT = 10
+
+    user = models.OneToOneField(CustomUser, related_name='listening_profile', on_delete=models.CASCADE)
+    # Written by `manage.py refresh_listening_profiles` from the
+    # UserSongDailyPlays rows in the window, so reading a profile is one row.
+    top_song_ids = models.JSONField(default=list, blank=True)
+    top_artist_ids = models.JSONField(default=list, blank=True)
+    top_genres = models.JSONField(default=list, blank=True)
+    total_seconds = models.PositiveIntegerField(default=0)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.user.username}'s listening profile"
+
+    @classmethod
+    def window_start(cls):
+        return timezone.localdate() - timedelta(days=cls.WINDOW_DAYS)
+
+    def daily_plays(self):
+        return UserSongDailyPlays.objects.filter(user_id=self.user_id, day__gte=self.window_start())
+
+    def _top(self, field):
+        return list(
+            self.daily_plays().values(field).annotate(total=models.Sum('plays'))
+            .order_by('-total', field).values_list(field, flat=True)[:self.TOP_LIMIT]
+        )
+
+    def refresh(self):
+        self.top_song_ids = self._top('song_id')
+        self.top_artist_ids = self._top('song__album__artist_id')
+        self.top_genres = self._top('song__genre')
+        total = self.daily_plays().aggregate(total=models.Sum(
+            models.ExpressionWrapper(models.F('plays') * models.F('song__duration'), output_field=models.DurationField())
+        ))['total']
+        self.total_seconds = int(total.total_seconds()) if total else 0
+        self.refreshed_at = timezone.now()
+        self.save()
+
+    @property
+    def total_minutes(self):
+        return self.total_seconds // 60
+
+
+# Precomputed genre charts served by TopSongsAPIView, written by
+# `manage.py build_charts`.
+class ChartSnapshot(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    etag = models.CharField(max_length=64)
+    data = models.JSONField(default=list)
+
+    def __str__(self):
+        return f"Charts snapshot {self.created_at:%Y-%m-%d %H:%M}"
 
 
 
 
-class Playlist(models.Model):
+
+class Playlist(Versioned):
     user = models.ForeignKey(CustomUser, related_name='playlists', on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='playlists/', blank=True, null=True)
+    image_blob = models.ForeignKey('MediaBlob', related_name='+', on_delete=models.PROTECT, blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True)
     is_public = models.BooleanField(default=False)
     has_image = models.BooleanField(default=False)
     savings = models.PositiveIntegerField(default=0)
+    songs_count = models.PositiveIntegerField(default=0)
+    total_duration = models.DurationField(default=timedelta(0))
 
     songs = models.ManyToManyField(Song, through='PlaylistSong', related_name='playlists', blank=True)
     
     def __str__(self):
         return f"{self.user} - {self.name}"
+
+    @property
+    def image_name(self):
+        return self.image_blob_id or f"playlists/{slugify(self.name)}_{self.id}{os.path.splitext(self.image.name)[1]}"
+
+    def _change_counters(self, count=0, duration=timedelta(0)):
+        # Every track mutation goes through here so songs_count,
+        # total_duration and version stay in step; `manage.py
+        # reconcile_playlist_counters` fixes drift from catalog edits.
+        Playlist.objects.filter(pk=self.pk).update(
+            songs_count=models.F('songs_count') + count,
+            total_duration=models.F('total_duration') + duration,
+            version=models.F('version') + 1,
+        )
+        ObjectChange.record(Playlist, [self.pk])
+        self.refresh_from_db(fields=['songs_count', 'total_duration', 'version'])
+
+    @classmethod
+    def change_savings(cls, playlist_id, delta):
+        # savings is rendered with the playlist, so a save or unsave moves
+        # its version like any other mutation.
+        with transaction.atomic():
+            if cls.objects.filter(pk=playlist_id, savings__gte=max(-delta, 0)).update(
+                savings=models.F('savings') + delta, version=models.F('version') + 1,
+            ):
+                ObjectChange.record(Playlist, [playlist_id])
+
+    def _removed_totals(self, playlist_songs):
+        totals = playlist_songs.aggregate(count=models.Count('id'), duration=models.Sum('song__duration'))
+        return totals['count'], totals['duration'] or timedelta(0)
     
-    def add_song(self, song):
+    def next_order(self):
         max_order = self.playlist_songs.aggregate(models.Max('order'))['order__max'] or 0
-        new_order = max_order + 1
-        PlaylistSong.objects.create(playlist=self, song=song, order=new_order)
+        return max_order + PlaylistSong.ORDER_GAP
+
+    def add_song(self, song):
+        with transaction.atomic():
+            PlaylistSong.objects.create(playlist=self, song=song, order=self.next_order())
+            self._change_counters(1, song.duration)
+
+    def insert_song(self, song, position):
+        with transaction.atomic():
+            order = self.free_orders(position)[0]
+            playlist_song = PlaylistSong.objects.create(playlist=self, song=song, order=order)
+            self._change_counters(1, song.duration)
+            return playlist_song
+
+    def remove_song(self, song):
+        return self.remove_songs([song.id])
+
+    def _existing_songs(self, song_ids):
+        durations = dict(Song.objects.filter(id__in=song_ids).values_list('id', 'duration'))
+        song_ids = [song_id for song_id in song_ids if song_id in durations]
+        return song_ids, durations
+
+    def add_songs(self, song_ids, skip_existing=False):
+        with transaction.atomic():
+            song_ids, durations = self._existing_songs(song_ids)
+            if skip_existing:
+                present = set(self.playlist_songs.filter(song_id__in=song_ids).values_list('song_id', flat=True))
+                song_ids = [song_id for song_id in dict.fromkeys(song_ids) if song_id not in present]
+
+            start = self.next_order()
+            playlist_songs = PlaylistSong.objects.bulk_create([
+                PlaylistSong(playlist=self, song_id=song_id, order=start + idx * PlaylistSong.ORDER_GAP)
+                for idx, song_id in enumerate(song_ids)
+            ])
+            self._change_counters(len(song_ids), sum((durations[song_id] for song_id in song_ids), timedelta(0)))
+            return playlist_songs
+
+    def remove_songs(self, song_ids):
+        with transaction.atomic():
+            removed = self.playlist_songs.filter(song_id__in=song_ids)
+            count, duration = self._removed_totals(removed)
+            removed.delete()
+            self._change_counters(-count, -duration)
+            return count
+
+    def replace_songs(self, song_ids):
+        with transaction.atomic():
+            Playlist.objects.select_for_update().filter(pk=self.pk).exists()
+            song_ids, durations = self._existing_songs(song_ids)
+            self.playlist_songs.all().delete()
+            playlist_songs = PlaylistSong.objects.bulk_create([
+                PlaylistSong(playlist=self, song_id=song_id, order=(idx + 1) * PlaylistSong.ORDER_GAP)
+                for idx, song_id in enumerate(song_ids)
+            ])
+
+            self.songs_count = len(song_ids)
+            self.total_duration = sum((durations[song_id] for song_id in song_ids), timedelta(0))
+            self.save(update_fields=['songs_count', 'total_duration'])
+            return playlist_songs
+
+    def dedupe_songs(self):
+        # Keeps the first occurrence of every song.
+        earlier = PlaylistSong.objects.filter(
+            playlist=self, song=models.OuterRef('song'), order__lt=models.OuterRef('order')
+        )
+        with transaction.atomic():
+            duplicates = self.playlist_songs.filter(models.Exists(earlier))
+            count, duration = self._removed_totals(duplicates)
+            duplicates.delete()
+            self._change_counters(-count, -duration)
+            return count
+
+    def _ordered_songs(self, exclude_ids=()):
+        return self.playlist_songs.exclude(id__in=exclude_ids).order_by('order', 'id')
+
+    def _neighbour_orders(self, position, exclude_ids=()):
+        orders = list(self._ordered_songs(exclude_ids).values_list('order', flat=True)[max(position - 1, 0):position + 1])
+        if position == 0:
+            return 0, orders[0] if orders else None
+        if not orders:
+            return self._ordered_songs(exclude_ids).aggregate(models.Max('order'))['order__max'] or 0, None
+        return orders[0], orders[1] if len(orders) > 1 else None
+
+    def free_orders(self, position, count=1, exclude_ids=()):
+        # Orders for `count` new rows in front of the row at `position`. Takes
+        # evenly spaced values from the gap there, so no other row is written
+        # unless the gap is exhausted and the neighbourhood has to be respaced.
+        before, after = self._neighbour_orders(position, exclude_ids)
+        if after is None:
+            return [before + (idx + 1) * PlaylistSong.ORDER_GAP for idx in range(count)]
+
+        step = (after - before) // (count + 1)
+        if step < 1:
+            self._respace(position, count, exclude_ids)
+            return self.free_orders(position, count, exclude_ids)
+        return [before + (idx + 1) * step for idx in range(count)]
+
+    def _respace(self, position, count, exclude_ids=()):
+        # Respaces the rows around `position`, doubling the window until the
+        # surrounding orders leave at least ORDER_GAP // 8 between rows.
+        window = max(count, 8)
+        while True:
+            start = max(position - window, 0)
+            rows = list(self._ordered_songs(exclude_ids).only('id', 'playlist', 'order')[max(start - 1, 0):position + window + 1])
+
+            low = rows.pop(0).order if start > 0 and rows else 0
+            high = rows.pop().order if len(rows) > position + window - start else None
+
+            step = PlaylistSong.ORDER_GAP if high is None else (high - low) // (len(rows) + count + 1)
+            if step >= PlaylistSong.ORDER_GAP // 8:
+                break
+            window *= 2
+
+        for idx, playlist_song in enumerate(rows):
+            slot = idx + 1 if start + idx < position else idx + 1 + count
+            playlist_song.order = low + slot * step
+        PlaylistSong.objects.bulk_update(rows, ['order'], batch_size=1000)
+
+    def move_songs(self, to_position, from_position=None, count=1, song_ids=None):
+        # Moves a range of rows (or every row of `song_ids`) so the first one
+        # ends up at `to_position`. Only the moved rows get new orders.
+        if not song_ids:
+            if count < 1:
+                raise ValueError("count must be at least 1")
+            if not 0 <= from_position <= self.songs_count - count:
+                raise ValueError(f"from_position must be between 0 and {self.songs_count - count} to move {count} of {self.songs_count} tracks")
+        with transaction.atomic():
+            moved = self._ordered_songs().only('id', 'playlist', 'order')
+            if song_ids:
+                moved = list(moved.filter(song_id__in=song_ids))
+            else:
+                moved = list(moved[from_position:from_position + count])
+            if not moved:
+                return []
+            if not 0 <= to_position <= self.songs_count - len(moved):
+                raise ValueError(f"to_position must be between 0 and {self.songs_count - len(moved)} to move {len(moved)} of {self.songs_count} tracks")
+
+            moved_ids = [playlist_song.id for playlist_song in moved]
+            orders = self.free_orders(to_position, len(moved), exclude_ids=moved_ids)
+            for playlist_song, order in zip(moved, orders):
+                playlist_song.order = order
+            PlaylistSong.objects.bulk_update(moved, ['order'])
+            self._change_counters()
+            return moved
+
+    def collage_images(self, limit=4):
+        images = []
+        album_images = self.playlist_songs.order_by('order').exclude(song__album__image='').values_list('song__album__image', flat=True)
+        for image in album_images[:limit * 10]:
+            if image and image not in images:
+                images.append(image)
+            if len(images) == limit:
+                break
+        return images
+
+    def rebalance(self):
+        playlist_songs = list(self._ordered_songs().only('id', 'playlist', 'order'))
+        for idx, playlist_song in enumerate(playlist_songs):
+            playlist_song.order = (idx + 1) * PlaylistSong.ORDER_GAP
+        PlaylistSong.objects.bulk_update(playlist_songs, ['order'], batch_size=1000)
     
 
 class PlaylistSong(models.Model):
+    # Orders are spaced ORDER_GAP apart so inserts and moves can take a
+    # midpoint and removals leave the rest of the playlist untouched.
+    ORDER_GAP = 1024
+
     playlist = models.ForeignKey(Playlist, related_name='playlist_songs', on_delete=models.CASCADE)
     song = models.ForeignKey(Song, related_name='playlist_songs', on_delete=models.CASCADE)
-    order = models.PositiveIntegerField()
+    order = models.PositiveBigIntegerField()
+    added_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ['playlist', 'order']
+        indexes = [
+            models.Index(fields=['playlist', 'order']),
+        ]
 
     def __str__(self):
         return f"{self.playlist.name} - {self.song.title} ({self.order})"
@@ -225,8 +655,12 @@ class PlaylistSong(models.Model):
 
 
 
-class Library(models.Model):
+class Library(Versioned):
     user = models.OneToOneField(CustomUser, related_name='library', on_delete=models.CASCADE)
+    # Last LibraryChange.seq handed out for this library.
+    change_seq = models.PositiveBigIntegerField(default=0)
+    # Where the last ObjectChange pull stopped; see LibraryChange.pull_updates.
+    updates_txid = models.BigIntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.username}'s Library"
@@ -249,14 +683,294 @@ class LibraryItem(models.Model):
         ordering = ['-added_at']
 
 
+class LibraryChange(models.Model):
+    # Append-only log the sidebar syncs from; `seq` is the sync cursor.
+    ACTIONS = [('add', 'Add'), ('remove', 'Remove'), ('pin', 'Pin'), ('unpin', 'Unpin'), ('update', 'Update')]
+
+    library = models.ForeignKey(Library, related_name='changes', on_delete=models.CASCADE)
+    seq = models.PositiveBigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    item_id = models.PositiveBigIntegerField()
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['library', 'seq']
+        constraints = [
+            models.UniqueConstraint(fields=['library', 'seq'], name='unique_library_change_seq'),
+        ]
+
+    def __str__(self):
+        return f"{self.library_id} #{self.seq} {self.action} {self.content_type_id}:{self.object_id}"
+
+    @classmethod
+    def log(cls, changes):
+        # Numbers unsaved changes per library while holding the library row
+        # until commit, so a library's changes commit in seq order and a
+        # client past some seq can never miss a lower one (ids are handed out
+        # at insert and commit in any order).
+        changes = list(changes)
+        if not changes:
+            return []
+        with transaction.atomic():
+            libraries = {
+                library.id: library
+                for library in Library.objects.select_for_update().filter(id__in={change.library_id for change in changes}).order_by('id').only('id', 'change_seq')
+            }
+            # Libraries deleted meanwhile have nothing left to sync.
+            changes = [change for change in changes if change.library_id in libraries]
+            for change in changes:
+                library = libraries[change.library_id]
+                library.change_seq += 1
+                change.seq = library.change_seq
+            Library.objects.bulk_update(libraries.values(), ['change_seq'], batch_size=1000)
+            return cls.objects.bulk_create(changes, batch_size=1000)
+
+    @classmethod
+    def record(cls, item, action):
+        changes = cls.log([cls(
+            library_id=item.library_id, action=action, item_id=item.id,
+            content_type_id=item.content_type_id, object_id=item.object_id,
+        )])
+        return changes[0] if changes else None
+
+    @classmethod
+    def pull_updates(cls, library_id):
+        # Logs 'update' for the library's items changed since the last pull.
+        # Only transactions older than every running one are read (the
+        # snapshot's xmin), so a change can never commit behind the stored
+        # horizon. The cost follows this library's items, not how many
+        # libraries hold a changed object.
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            horizon = cursor.fetchone()[0]
+        since = Library.objects.filter(pk=library_id).values_list('updates_txid', flat=True).first()
+        if since is None or since >= horizon:
+            return []
+
+        items = list(LibraryItem.objects.filter(library_id=library_id).filter(Exists(ObjectChange.objects.filter(
+            content_type=OuterRef('content_type'), object_id=OuterRef('object_id'), txid__gte=since, txid__lt=horizon,
+        ))).values_list('id', 'content_type_id', 'object_id'))
+        if not items:
+            # Left in place: the lookup above probes the library's own items,
+            # so a wider range next time costs the same.
+            return []
+        with transaction.atomic():
+            # A concurrent pull that moved the horizon first logged these.
+            if not Library.objects.filter(pk=library_id, updates_txid=since).update(updates_txid=horizon):
+                return []
+            changes = cls.log(
+                cls(library_id=library_id, action='update', item_id=item_id, content_type_id=content_type_id, object_id=object_id)
+                for item_id, content_type_id, object_id in items
+            )
+            if changes:
+                Library.bump_versions(pk=library_id)
+        return changes
+
+
+class ObjectChange(models.Model):
+    # One row per change to a library card (title, cover, track count...),
+    # however many libraries hold the object; LibraryChange.pull_updates
+    # fans it out lazily to the libraries that sync. `txid` is the writing
+    # transaction.
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    txid = models.BigIntegerField(db_default=models.Func(function='txid_current', output_field=models.BigIntegerField()))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_type', 'object_id', 'txid']),
+            models.Index(fields=['txid']),
+        ]
+
+    def __str__(self):
+        return f"{self.content_type_id}:{self.object_id} @ {self.txid}"
+
+    @classmethod
+    def record(cls, model, object_ids):
+        content_type = ContentType.objects.get_for_model(model)
+        cls.objects.bulk_create([cls(content_type=content_type, object_id=object_id) for object_id in set(object_ids)], batch_size=1000)
+
+
 
 class PlaybackHistory(models.Model):
+    RECENTLY_PLAYED_LIMIT = 50
+
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
-    played_at = models.DateTimeField(auto_now_add=True)
+    played_at = models.DateTimeField(default=timezone.now)
 
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
 
     class Meta:
-        ordering = ['-played_at']
\ No newline at end of file
+        ordering = ['-played_at']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'content_type', 'object_id'], name='unique_playback_history_item'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-played_at']),
+        ]
+
+    @classmethod
+    def record(cls, user, content_type, object_id):
+        entry, created = cls.objects.update_or_create(
+            user=user,
+            content_type=content_type,
+            object_id=object_id,
+            defaults={'played_at': timezone.now()},
+        )
+
+        if created:
+            stale_ids = cls.objects.filter(user=user).values_list('id', flat=True)[cls.RECENTLY_PLAYED_LIMIT:]
+            cls.objects.filter(id__in=list(stale_ids)).delete()
+
+        return entry
+
+
+
+class MediaJob(models.Model):
+    # Postgres-backed work queue for media processing (see api.media and the
+    # run_media_worker command). A claimed job keeps status 'running' with
+    # run_after pushed LEASE ahead, so jobs of a crashed worker are picked up
+    # again once the lease runs out. The worker renews the lease while the
+    # job runs, and run_after identifies the lease: finish() and fail() only
+    # apply while the worker still holds the one it claimed.
+    KINDS = [('hls', 'HLS packaging'), ('waveform', 'Waveform analysis'), ('images', 'Image variants')]
+    STATUSES = [('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')]
+    MAX_ATTEMPTS = 3
+    LEASE = timedelta(minutes=15)
+    LEASE_RENEWAL = LEASE / 3
+
+    kind = models.CharField(max_length=20, choices=KINDS)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    status = models.CharField(max_length=10, choices=STATUSES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['run_after'], condition=models.Q(status__in=['pending', 'running']), name='mediajob_runnable'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'content_type', 'object_id'], condition=models.Q(status='pending'), name='unique_pending_media_job',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.content_type_id}:{self.object_id} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, kind, obj):
+        # At most one pending job per object; re-enqueueing a pending one is a no-op.
+        job, _ = cls.objects.get_or_create(
+            kind=kind, content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk, status='pending',
+        )
+        return job
+
+    @classmethod
+    def claim(cls, limit=1, kinds=None):
+        now = timezone.now()
+        with transaction.atomic():
+            jobs = cls.objects.select_for_update(skip_locked=True).filter(
+                status__in=['pending', 'running'], run_after__lte=now,
+            )
+            if kinds:
+                jobs = jobs.filter(kind__in=kinds)
+            jobs = list(jobs.order_by('run_after', 'id')[:limit])
+            cls.objects.filter(id__in=[job.id for job in jobs]).update(
+                status='running', run_after=now + cls.LEASE, attempts=models.F('attempts') + 1, updated_at=now,
+            )
+        for job in jobs:
+            job.status, job.run_after, job.attempts = 'running', now + cls.LEASE, job.attempts + 1
+        return jobs
+
+    def _update_leased(self, **fields):
+        # False once the lease ran out and another worker claimed the job.
+        updated = type(self).objects.filter(pk=self.pk, status='running', run_after=self.run_after).update(
+            updated_at=timezone.now(), **fields,
+        )
+        if updated:
+            for name, value in fields.items():
+                setattr(self, name, value)
+        return bool(updated)
+
+    def renew(self):
+        return self._update_leased(run_after=timezone.now() + self.LEASE)
+
+    def finish(self):
+        return self._update_leased(status='done', last_error='')
+
+    def fail(self, error):
+        # Retried with exponential backoff until MAX_ATTEMPTS.
+        superseded = type(self).objects.filter(
+            kind=self.kind, content_type_id=self.content_type_id, object_id=self.object_id, status='pending',
+        ).exists()
+        if self.attempts >= self.MAX_ATTEMPTS or superseded:
+            return self._update_leased(status='failed', last_error=error)
+        return self._update_leased(status='pending', last_error=error, run_after=timezone.now() + timedelta(minutes=2 ** self.attempts))
+
+
+
+class MediaBlob(models.Model):
+    # An uploaded file stored once under a key derived from its SHA-256 and
+    # shared by every object that uploads the same bytes (see api.blobs).
+    # The key is the primary key, so `<obj>.image_blob_id` is the storage
+    # name without a join. Blobs nobody references are removed by
+    # `manage.py gc_media_blobs` together with their derived_keys
+    # (image variants, HLS segments).
+    key = models.CharField(max_length=255, primary_key=True)
+    bucket = models.CharField(max_length=50)
+    sha256 = models.CharField(max_length=64)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    derived_keys = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'sha256'], name='unique_media_blob_content'),
+        ]
+        indexes = [
+            models.Index(fields=['updated_at'], condition=models.Q(ref_count=0), name='mediablob_unreferenced'),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket}/{self.key} ({self.ref_count} refs)"
+
+    @staticmethod
+    def key_for(sha256, extension):
+        return f"blobs/{sha256[:2]}/{sha256}{extension.lower()}"
+
+    @classmethod
+    def acquire(cls, key):
+        cls.objects.filter(pk=key).update(ref_count=models.F('ref_count') + 1, updated_at=timezone.now())
+
+    @classmethod
+    def release(cls, key):
+        cls.objects.filter(pk=key, ref_count__gt=0).update(ref_count=models.F('ref_count') - 1, updated_at=timezone.now())
+
+    @classmethod
+    def release_many(cls, counts):
+        # {key: references dropped}, in one UPDATE.
+        if counts:
+            dropped = models.Case(*[models.When(pk=key, then=count) for key, count in counts.items()], output_field=models.IntegerField())
+            cls.objects.filter(pk__in=list(counts), ref_count__gt=0).update(
+                ref_count=Greatest(models.F('ref_count') - dropped, 0), updated_at=timezone.now(),
+            )
+
+    def add_derived(self, keys):
+        with transaction.atomic():
+            derived = MediaBlob.objects.select_for_update().values_list('derived_keys', flat=True).get(pk=self.pk)
+            self.derived_keys = sorted(set(derived) | set(keys))
+            MediaBlob.objects.filter(pk=self.pk).update(derived_keys=self.derived_keys)
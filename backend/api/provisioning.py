@@ -0,0 +1,89 @@
+import csv
+import json
+from itertools import islice
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from .models import CustomUser, CurrentPlayback, Playlist, Library, LibraryItem, LibraryChange
+
+USER_FIELDS = ['email', 'username', 'password', 'first_name', 'last_name', 'type']
+
+
+def read_users(path, file_format=None):
+    file_format = file_format or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    with open(path, newline='') as file:
+        if file_format == 'csv':
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def build_user(row):
+    # Passwords must already be hashed (any configured hasher); an empty one
+    # gives the user an unusable password.
+    password = row.get('password') or make_password(None)
+    if not password.startswith('!'):
+        identify_hasher(password)
+
+    user_type = row.get('type') or 'listener'
+    if user_type not in ('artist', 'listener'):
+        raise ValueError(f"unknown type {user_type!r}")
+
+    email = CustomUser.objects.normalize_email(row.get('email') or '')
+    if not email:
+        raise ValueError("email is required")
+
+    return CustomUser(
+        email=email,
+        username=row.get('username') or email.split('@')[0],
+        password=password,
+        first_name=row.get('first_name') or '',
+        last_name=row.get('last_name') or '',
+        type=user_type,
+    )
+
+
+def provision_chunk(users):
+    # Same rows as api.signals.create_current_playback plus the LibraryItem
+    # signals, written with one bulk INSERT per table.
+    with transaction.atomic():
+        existing = set(CustomUser.objects.filter(email__in=[user.email for user in users]).values_list('email', flat=True))
+        users = list({user.email: user for user in users if user.email not in existing}.values())
+        if not users:
+            return 0
+
+        users = CustomUser.objects.bulk_create(users)
+        CurrentPlayback.objects.bulk_create([CurrentPlayback(user=user) for user in users])
+        playlists = Playlist.objects.bulk_create([Playlist(user=user, name="Liked Songs") for user in users])
+        libraries = Library.objects.bulk_create([Library(user=user) for user in users])
+
+        playlist_type = ContentType.objects.get_for_model(Playlist)
+        items = LibraryItem.objects.bulk_create([
+            LibraryItem(library=library, content_type=playlist_type, object_id=playlist.id)
+            for library, playlist in zip(libraries, playlists)
+        ])
+        LibraryChange.log(
+            LibraryChange(library_id=item.library_id, action='add', item_id=item.id, content_type=playlist_type, object_id=item.object_id)
+            for item in items
+        )
+        Library.bump_versions(id__in=[library.id for library in libraries])
+        return len(users)
+
+
+def provision_users(rows, chunk_size=1000):
+    created = skipped = 0
+    errors = []
+    rows = iter(enumerate(rows, start=1))
+    while chunk := list(islice(rows, chunk_size)):
+        users = []
+        for line, row in chunk:
+            try:
+                users.append(build_user(row))
+            except ValueError as e:
+                errors.append((line, str(e)))
+        count = provision_chunk(users) if users else 0
+        created += count
+        skipped += len(users) - count
+    return created, skipped, errors
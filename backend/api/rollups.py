@@ -0,0 +1,129 @@
+from datetime import datetime, time, timedelta
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Subquery, Sum, Value
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import SongPlayback, SongDailyPlays, ArtistDailyPlays, GenreDailyPlays, UserSongDailyPlays, ListeningProfile
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def _bump(model, lookup, new_listener=None):
+    # new_listener=None for rows without a distinct_listeners count.
+    changes = {'plays': F('plays') + 1}
+    created = {'plays': 1}
+    if new_listener is not None:
+        created['distinct_listeners'] = 1
+    if new_listener:
+        changes['distinct_listeners'] = F('distinct_listeners') + 1
+
+    if model.objects.filter(**lookup).update(**changes):
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.create(**created, **lookup)
+    except IntegrityError:
+        # Another request created the row for this day in the meantime.
+        model.objects.filter(**lookup).update(**changes)
+
+
+def plays_total(**lookup):
+    # Total plays of the songs matching `lookup` (usually an OuterRef), as a
+    # correlated subquery: each row sums its own SongDailyPlays through the
+    # index instead of the outer query joining and grouping every daily row.
+    return Subquery(
+        SongDailyPlays.objects.filter(**lookup).order_by().annotate(group=Value(1)).values('group').annotate(total=Sum('plays')).values('total')
+    )
+
+
+def record_playback(playback):
+    song = playback.song
+    artist_id = song.album.artist_id
+    day = timezone.localdate(playback.played_at)
+    start, end = _day_bounds(day)
+
+    earlier_today = SongPlayback.objects.filter(
+        user_id=playback.user_id,
+        played_at__gte=start,
+        played_at__lt=end,
+    ).exclude(id=playback.id)
+
+    _bump(SongDailyPlays, {'song_id': song.id, 'day': day},
+          not earlier_today.filter(song_id=song.id).exists())
+    _bump(ArtistDailyPlays, {'artist_id': artist_id, 'day': day},
+          not earlier_today.filter(song__album__artist_id=artist_id).exists())
+    _bump(GenreDailyPlays, {'genre': song.genre, 'day': day},
+          not earlier_today.filter(song__genre=song.genre).exists())
+
+
+def rebuild_daily_rollups(since=None):
+    playbacks = SongPlayback.objects.all()
+    song_rollups = SongDailyPlays.objects.all()
+    artist_rollups = ArtistDailyPlays.objects.all()
+    genre_rollups = GenreDailyPlays.objects.all()
+
+    if since:
+        playbacks = playbacks.filter(played_at__gte=_day_bounds(since)[0])
+        song_rollups = song_rollups.filter(day__gte=since)
+        artist_rollups = artist_rollups.filter(day__gte=since)
+        genre_rollups = genre_rollups.filter(day__gte=since)
+
+    playbacks = playbacks.annotate(day=TruncDate('played_at')).order_by()
+
+    with transaction.atomic():
+        song_rollups.delete()
+        artist_rollups.delete()
+        genre_rollups.delete()
+
+        _bulk_rollup(SongDailyPlays, 'song_id', playbacks.values('song_id', 'day'), 'song_id')
+        _bulk_rollup(ArtistDailyPlays, 'artist_id', playbacks.values('song__album__artist_id', 'day'), 'song__album__artist_id')
+        _bulk_rollup(GenreDailyPlays, 'genre', playbacks.values('song__genre', 'day'), 'song__genre')
+
+
+def _bulk_rollup(model, key_field, grouped, group_field):
+    rows = grouped.annotate(plays=Count('id'), listeners=Count('user', distinct=True)).iterator()
+    model.objects.bulk_create(
+        (model(**{key_field: row[group_field]}, day=row['day'], plays=row['plays'], distinct_listeners=row['listeners'])
+         for row in rows),
+        batch_size=1000,
+    )
+
+
+def record_listening(playback):
+    # One row per user, song and day: no profile row to lock, and plays
+    # older than the window stop counting at the next refresh.
+    _bump(UserSongDailyPlays, {
+        'user_id': playback.user_id, 'song_id': playback.song_id, 'day': timezone.localdate(playback.played_at),
+    })
+
+
+def rebuild_listening_profile(user_id):
+    since = ListeningProfile.window_start()
+    rows = SongPlayback.objects.filter(user_id=user_id, played_at__gte=_day_bounds(since)[0]).annotate(
+        day=TruncDate('played_at')
+    ).values('song_id', 'day').annotate(plays=Count('id')).order_by()
+
+    with transaction.atomic():
+        UserSongDailyPlays.objects.filter(user_id=user_id, day__gte=since).delete()
+        UserSongDailyPlays.objects.bulk_create(
+            (UserSongDailyPlays(user_id=user_id, song_id=row['song_id'], day=row['day'], plays=row['plays']) for row in rows),
+            batch_size=1000,
+        )
+        ListeningProfile.objects.get_or_create(user_id=user_id)[0].refresh()
+
+
+def rebuild_listening_profiles():
+    since = ListeningProfile.window_start()
+    UserSongDailyPlays.objects.filter(day__lt=since).delete()
+
+    active_ids = set(SongPlayback.objects.filter(played_at__gte=_day_bounds(since)[0]).values_list('user_id', flat=True).distinct())
+    profile_ids = set(ListeningProfile.objects.values_list('user_id', flat=True))
+
+    user_ids = active_ids | profile_ids
+    for user_id in user_ids:
+        rebuild_listening_profile(user_id)
+    return len(user_ids)
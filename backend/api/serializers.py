@@ -6,15 +6,33 @@ import datetime
 import os
 from datetime import timedelta
 from django.utils import timezone
-from django.db.models import Count, Sum, F
+from django.db.models import Count, Sum, F, Max, OuterRef
 from django.conf import settings
+from django.db import transaction
+from .blobs import attach_blob, store_blobs
+from .images import image_srcset
+from .membership import Membership
+from .rollups import plays_total
 from .utils import get_dominant_color, create_collage, get_image_url, upload_image, get_audio_url, upload_audio
-from .models import CustomUser, Album, Song, CurrentPlayback, SongPlayback, Playlist, PlaylistSong, Library, LibraryItem, PlaybackHistory
+from .models import CustomUser, Album, Song, CurrentPlayback, SongPlayback, SongDailyPlays, Playlist, PlaylistSong, Library, LibraryItem, LibraryChange, PlaybackHistory, MediaJob, SongAnalysis
 from django.contrib.contenttypes.models import ContentType
 from django.utils.text import slugify
+from django.urls import reverse
 
 
 BASE_URL = "http://127.0.0.1:8000"
+MAX_ALBUM_TRACKS = 50
+
+def songs_with_plays(playlist_songs):
+    # Moves a `song_total_plays` annotation on PlaylistSong rows onto the song
+    # so SongSerializer.get_plays does not query per song.
+    songs = []
+    for playlist_song in playlist_songs:
+        if hasattr(playlist_song, 'song_total_plays'):
+            playlist_song.song.total_plays = playlist_song.song_total_plays
+        songs.append(playlist_song.song)
+    return songs
+
 
 class SongSerializer(serializers.ModelSerializer):
     artist = serializers.PrimaryKeyRelatedField(read_only=True, source='album.artist.id')
@@ -34,8 +52,9 @@ class SongSerializer(serializers.ModelSerializer):
 
     @extend_schema_field(serializers.IntegerField)
     def get_plays(self, obj):
-        songs = SongPlayback.objects.filter(song=obj).count()
-        return songs
+        if hasattr(obj, 'total_plays'):
+            return obj.total_plays or 0
+        return SongDailyPlays.objects.filter(song=obj).aggregate(total=Sum('plays'))['total'] or 0
 
     def __init__(self, *args, **kwargs):
         nested = kwargs.pop('nested', False)
@@ -79,12 +98,15 @@ class SongSerializer(serializers.ModelSerializer):
             file_data = song.file
             filename = f"audio/{slugify(song.title)}_{song.id}{os.path.splitext(file_data.name)[1]}"
             try:
-                upload_audio(file_data, filename)
+                attach_blob(song, 'audio_blob', upload_audio(file_data, filename))
             except Exception as e:
                 raise serializers.ValidationError(f"Failed to upload song: {str(e)}")
             print('upload')
+            MediaJob.enqueue('hls', song)
+            MediaJob.enqueue('waveform', song)
         
-        song_duration = datetime.timedelta(seconds=round(audio.info.length))
+        # The header estimate; the waveform job replaces it with the decoded length.
+        song_duration = datetime.timedelta(seconds=audio.info.length)
         song.duration = song_duration
         song.save()
 
@@ -111,22 +133,31 @@ class SongSerializer(serializers.ModelSerializer):
             instance.featured_artists.set(featured_artists)
 
         if file:
-            instance.save(update_fields=['file'])
+            # Packaging and peaks of the old audio are dropped until the hls
+            # and waveform jobs process the new file (players fall back to
+            # the stream); the new waveform_version moves the waveform URL
+            # off the long-cached one.
+            instance.hls_manifest = ''
+            instance.waveform_version += 1
+            instance.save(update_fields=['file', 'hls_manifest', 'waveform_version'])
+            SongAnalysis.objects.filter(song=instance).delete()
 
             if os.path.exists(instance.file.path):
                 audio = MP3(instance.file.path)
-                song_duration = datetime.timedelta(seconds=round(audio.info.length))
-                instance.duration = song_duration
+                instance.set_duration(datetime.timedelta(seconds=audio.info.length))
 
         if instance.file:
             file_data = instance.file
             filename = f"audio/{slugify(instance.title)}_{instance.id}{os.path.splitext(file_data.name)[1]}"
             try:
-                upload_audio(file_data, filename)
+                attach_blob(instance, 'audio_blob', upload_audio(file_data, filename))
             except Exception as e:
                 raise serializers.ValidationError(f"Failed to upload song: {str(e)}")
             print('upload')
 
+        if file:
+            MediaJob.enqueue('hls', instance)
+            MediaJob.enqueue('waveform', instance)
 
         instance.save()
         return instance
@@ -146,12 +177,19 @@ class SongSerializer(serializers.ModelSerializer):
 
 
         if instance.album.image:
-            filename = f"albums/{slugify(instance.album.title)}_{instance.album.id}{os.path.splitext(instance.album.image.name)[1]}"
-            representation['image'] = get_image_url(filename)
+            representation['image'] = get_image_url(instance.album.image_name)
+            representation['image_srcset'] = image_srcset(instance.album)
 
         if instance.file:
-            filename = f"audio/{slugify(instance.title)}_{instance.id}{os.path.splitext(instance.file.name)[1]}"
-            representation['file'] = get_audio_url(filename)
+            representation['file'] = get_audio_url(instance.audio_name)
+            representation['stream'] = reverse('song-stream', args=[instance.id])
+            representation['waveform'] = reverse('song-waveform', args=[instance.id])
+            if instance.waveform_version:
+                representation['waveform'] += f'?v={instance.waveform_version}'
+            if request := self.context.get('request'):
+                representation['stream'] = request.build_absolute_uri(representation['stream'])
+                representation['waveform'] = request.build_absolute_uri(representation['waveform'])
+            representation['hls'] = get_audio_url(instance.hls_manifest) if instance.hls_manifest else None
 
 
         return representation
@@ -198,13 +236,14 @@ class AlbumSerializer(serializers.ModelSerializer):
         if self.library:
             return obj.songs.order_by('track_number').values_list('id', flat=True)
 
-        return SongSerializer(obj.songs.order_by('track_number'), many=True, nested=True, context=self.context, required=False).data
+        songs = obj.songs.annotate(total_plays=plays_total(song=OuterRef('pk'))).prefetch_related('featured_artists').order_by('track_number')
+        return SongSerializer(songs, many=True, nested=True, context=self.context, required=False).data
     
     def to_representation(self, instance):
         repr = super().to_representation(instance)
         if instance.image:
-            filename = f"albums/{slugify(instance.title)}_{instance.id}{os.path.splitext(instance.image.name)[1]}"
-            repr['image'] = get_image_url(filename)
+            repr['image'] = get_image_url(instance.image_name)
+            repr['image_srcset'] = image_srcset(instance)
         
         return repr
 
@@ -217,11 +256,9 @@ class AlbumSerializer(serializers.ModelSerializer):
 
     @extend_schema_field(serializers.IntegerField)
     def get_total_plays(self, obj):
-        def get_plays(obj):
-            song_plays = SongPlayback.objects.filter(song=obj).count()
-            return song_plays
-        
-        return sum(get_plays(song) for song in obj.songs.all())
+        if hasattr(obj, 'total_plays'):
+            return obj.total_plays or 0
+        return SongDailyPlays.objects.filter(song__album=obj).aggregate(total=Sum('plays'))['total'] or 0
 
 
     def create(self, validated_data):
@@ -275,12 +312,55 @@ class AlbumSerializer(serializers.ModelSerializer):
         #     return BASE_URL + obj.artist.image.url
         # return None
         if instance.artist.image:
-            filename = f"artists/{slugify(instance.artist.username)}_{instance.artist.id}{os.path.splitext(instance.artist.image.name)[1]}"
-            return  get_image_url(filename)
+            return get_image_url(instance.artist.image_name)
         return None
 
 
 
+class AlbumTracksSerializer(serializers.Serializer):
+    # Several tracks of one album in one request, uploaded concurrently.
+    # Titles come from the file names and track numbers continue after the
+    # album's last track.
+    files = serializers.ListField(child=serializers.FileField(), allow_empty=False, max_length=MAX_ALBUM_TRACKS)
+    genre = serializers.ChoiceField(choices=Song._meta.get_field('genre').choices, default='other')
+    is_indecent = serializers.BooleanField(default=False)
+
+    def validate_files(self, files):
+        for file in files:
+            try:
+                file.duration = datetime.timedelta(seconds=MP3(file).info.length)
+            except Exception:
+                raise serializers.ValidationError(f"{file.name} is not an MP3 file.")
+            file.seek(0)
+        return files
+
+    def create(self, validated_data):
+        album = self.context['album']
+        files = validated_data['files']
+
+        # Uploaded before the transaction opens so it never spans network
+        # I/O; blobs left unreferenced by a failure below are collected.
+        try:
+            blobs = store_blobs('audio', [(file, file.name) for file in files])
+        except Exception as e:
+            raise serializers.ValidationError(f"Failed to upload songs: {str(e)}")
+
+        with transaction.atomic():
+            last_track = Album.objects.select_for_update().get(pk=album.pk).songs.aggregate(last=Max('track_number'))['last'] or 0
+            songs = []
+            for track_number, (file, blob) in enumerate(zip(files, blobs), start=last_track + 1):
+                song = Song.objects.create(
+                    album=album, title=os.path.splitext(os.path.basename(file.name))[0], file=file,
+                    track_number=track_number, duration=file.duration, lyrics={},
+                    genre=validated_data['genre'], is_indecent=validated_data['is_indecent'],
+                )
+                attach_blob(song, 'audio_blob', blob)
+                MediaJob.enqueue('hls', song)
+                MediaJob.enqueue('waveform', song)
+                songs.append(song)
+        return songs
+
+
 
 
 class ArtistSerializer(serializers.ModelSerializer):
@@ -340,22 +420,19 @@ class ArtistSerializer(serializers.ModelSerializer):
     @extend_schema_field(serializers.ListField)
     def get_top_songs(self, obj):
         limit = 10
-        last_month = timezone.now() - timedelta(days=30)
+        last_month = timezone.localdate() - timedelta(days=30)
     
-        songs_ids = SongPlayback.objects.filter(
-            song__album__artist=obj,
-            played_at__gte=last_month
-        ).values(
-            'song'
+        songs = Song.objects.filter(
+            album__artist=obj,
+            daily_plays__day__gte=last_month
         ).annotate(
-            play_count=Count('id')
-        ).order_by('-play_count')[:limit]
-
-        songs = []
-        for song in songs_ids:
-            song = Song.objects.get(id=song['song'])
-            songs.append(song)
-
+            play_count=Sum('daily_plays__plays'),
+            total_plays=plays_total(song=OuterRef('pk'))
+        ).select_related(
+            'album__artist'
+        ).prefetch_related(
+            'featured_artists'
+        ).order_by('-play_count', 'id')[:limit]
 
         return SongSerializer(songs, many=True, nested=True, context=self.context).data
 
@@ -389,10 +466,7 @@ class ArtistSerializer(serializers.ModelSerializer):
 
         if request := self.context.get('request'):
             try:
-                if instance in request.user.followed_artists.all():
-                    representation['is_followed'] = True
-                else:
-                    representation['is_followed'] = False
+                representation['is_followed'] = Membership.for_request(request).contains('artist', instance.id)
 
                 if instance == request.user:
                     representation.pop('is_followed', None)
@@ -411,8 +485,8 @@ class ArtistSerializer(serializers.ModelSerializer):
 
 
         if instance.image:
-            filename = f"artists/{slugify(instance.username)}_{instance.id}{os.path.splitext(instance.image.name)[1]}"
-            representation['image'] = get_image_url(filename)
+            representation['image'] = get_image_url(instance.image_name)
+            representation['image_srcset'] = image_srcset(instance)
         
         
         
@@ -456,7 +530,8 @@ class PlaylistSerializer(serializers.ModelSerializer):
     # songs = serializers.PrimaryKeyRelatedField(queryset=Song.objects.all(), many=True, write_only=True, required=False)
     theme = serializers.SerializerMethodField()
     playlist_duration = serializers.SerializerMethodField()
-    songs_length = serializers.IntegerField(source='songs.count', read_only=True)
+    songs_length = serializers.IntegerField(source='songs_count', read_only=True)
+    songs = serializers.SerializerMethodField()
 
     class Meta:
         model = Playlist
@@ -476,18 +551,33 @@ class PlaylistSerializer(serializers.ModelSerializer):
 
     @extend_schema_field(serializers.DurationField)
     def get_playlist_duration(self, obj):
-        playlist_songs = PlaylistSong.objects.filter(playlist=obj).order_by('order')
-        songs = [playlist_song.song for playlist_song in playlist_songs]
-        total_time = datetime.timedelta(0)
-        for song in songs:
-            total_time += song.duration
-        return str(total_time)
+        return str(obj.total_duration)
+
+    @extend_schema_field(serializers.ListField)
+    def get_songs(self, obj):
+        # Large playlists should be read page by page from
+        # /playlists/{id}/tracks/; pass include_songs=false to skip this list.
+        request = self.context.get('request')
+        if request and request.query_params.get('include_songs', '').lower() == 'false':
+            return None
 
-    # @extend_schema_field(serializers.ListField)
-    # def get_songs(self, obj):
-    #     playlist_songs = PlaylistSong.objects.filter(playlist=obj).order_by('order')
-    #     songs = [playlist_song.song for playlist_song in playlist_songs]
-    #     return SongSerializer(songs, many=True, nested=True).data
+        order = request.query_params.get('songs_order') if request else None
+        if order in ['title', '-title']:
+            ordering = [order.replace('title', 'song__title'), 'order']
+        elif order == '-order':
+            ordering = ['-order']
+        else:
+            ordering = ['order']
+
+        playlist_songs = obj.playlist_songs.select_related(
+            'song__album__artist'
+        ).prefetch_related(
+            'song__featured_artists'
+        ).annotate(
+            song_total_plays=plays_total(song=OuterRef('song'))
+        ).order_by(*ordering)
+
+        return SongSerializer(songs_with_plays(playlist_songs), many=True, nested=True, playlist=True).data
 
     @extend_schema_field(serializers.CharField)
     def get_theme(self, obj):
@@ -496,35 +586,13 @@ class PlaylistSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        
-        playlist_songs = PlaylistSong.objects.filter(playlist=instance)
-        
-        
-        
-        request = self.context.get('request')
-        songs = instance.songs.all()
-        
-        order = request.query_params.get('songs_order') if request else None
-        
-        if order in ['order', '-order']:
-            playlist_songs = playlist_songs.order_by(order)
 
-        songs = [playlist_song.song for playlist_song in playlist_songs]
-
-        if order in ['title', '-title']:
-            songs = songs.order_by(order)
-    
-
-        print("order", order)
-
-        representation['songs'] = SongSerializer(songs, many=True, nested=True, playlist=True).data
-
-        if self.nested:
-            representation.pop('songs', None)
+        if representation.get('songs', []) is None:
+            representation.pop('songs')
 
         if instance.image:
-            filename = f"playlists/{slugify(instance.name)}_{instance.id}{os.path.splitext(instance.image.name)[1]}"
-            representation['image'] = get_image_url(filename)
+            representation['image'] = get_image_url(instance.image_name)
+            representation['image_srcset'] = image_srcset(instance)
 
         return representation
     
@@ -534,13 +602,7 @@ class PlaylistSerializer(serializers.ModelSerializer):
         playlist = Playlist.objects.create(**validated_data)
 
         if songs_order:
-            for idx, song_id in enumerate(songs_order):
-                playlist_song, created = PlaylistSong.objects.get_or_create(
-                    playlist=playlist,
-                    song=song_id,
-                    order=idx,
-                )
-                playlist_song.save()
+            playlist.replace_songs([song.id for song in songs_order])
 
         if playlist.has_image:
             return playlist
@@ -564,9 +626,10 @@ class PlaylistSerializer(serializers.ModelSerializer):
                 file_data = playlist.image
                 filename = f"playlists/{slugify(playlist.name)}_{playlist.id}{os.path.splitext(file_data.name)[1]}"
                 try:
-                    upload_image(file_data, filename)
+                    attach_blob(playlist, 'image_blob', upload_image(file_data, filename))
                 except Exception as e:
                     raise serializers.ValidationError(f"Failed to upload image: {str(e)}")
+                MediaJob.enqueue('images', playlist)
             playlist.save()
 
         return playlist
@@ -577,18 +640,7 @@ class PlaylistSerializer(serializers.ModelSerializer):
         instance = super().update(instance, validated_data)
 
         if songs_order:
-            existing_playlist_songs = PlaylistSong.objects.filter(playlist=instance)
-
-            for playlist_song in existing_playlist_songs:
-                    playlist_song.delete()
-
-            for idx, song_id in enumerate(songs_order):
-                playlist_song, created = PlaylistSong.objects.get_or_create(
-                    playlist=instance,
-                    song=song_id,
-                    order=idx,
-                )
-                playlist_song.save()
+            instance.replace_songs([song.id for song in songs_order])
 
 
         if instance.has_image:
@@ -613,9 +665,10 @@ class PlaylistSerializer(serializers.ModelSerializer):
                 file_data = instance.image
                 filename = f"playlists/{slugify(instance.name)}_{instance.id}{os.path.splitext(file_data.name)[1]}"
                 try:
-                    upload_image(file_data, filename)
+                    attach_blob(instance, 'image_blob', upload_image(file_data, filename))
                 except Exception as e:
                     raise serializers.ValidationError(f"Failed to upload image: {str(e)}")
+                MediaJob.enqueue('images', instance)
                 
             instance.save()
 
@@ -625,6 +678,111 @@ class PlaylistSerializer(serializers.ModelSerializer):
 
 
 
+class PlaylistTrackSerializer(serializers.ModelSerializer):
+    song = serializers.SerializerMethodField()
+
+    class Meta:
+        model = PlaylistSong
+        fields = ['id', 'order', 'added_at', 'song']
+
+    @extend_schema_field(serializers.DictField)
+    def get_song(self, obj):
+        return SongSerializer(songs_with_plays([obj])[0], nested=True, playlist=True, context=self.context).data
+
+
+
+
+def storage_image_url(instance):
+    if not instance.image:
+        return None
+    return get_image_url(instance.image_name)
+
+
+@extend_schema_field(serializers.DictField(child=serializers.URLField()))
+class ImageSrcsetField(serializers.ReadOnlyField):
+    def to_representation(self, value):
+        return image_srcset(value)
+
+
+class LibrarySongCardSerializer(serializers.ModelSerializer):
+    artist_username = serializers.CharField(source='album.artist.username', read_only=True)
+    image = serializers.SerializerMethodField()
+    image_srcset = ImageSrcsetField(source='album')
+
+    class Meta:
+        model = Song
+        fields = ['id', 'title', 'artist_username', 'album', 'image', 'image_srcset']
+
+    def get_image(self, obj):
+        return storage_image_url(obj.album)
+
+
+class LibraryAlbumCardSerializer(serializers.ModelSerializer):
+    artist_username = serializers.CharField(source='artist.username', read_only=True)
+    image = serializers.SerializerMethodField()
+    image_srcset = ImageSrcsetField(source='*')
+
+    class Meta:
+        model = Album
+        fields = ['id', 'title', 'album_type', 'artist_username', 'image', 'image_srcset']
+
+    def get_image(self, obj):
+        return storage_image_url(obj)
+
+
+class LibraryPlaylistCardSerializer(serializers.ModelSerializer):
+    title = serializers.CharField(source='name', read_only=True)
+    artist_username = serializers.CharField(source='user.username', read_only=True)
+    songs_length = serializers.IntegerField(source='songs_count', read_only=True)
+    image = serializers.SerializerMethodField()
+    image_srcset = ImageSrcsetField(source='*')
+
+    class Meta:
+        model = Playlist
+        fields = ['id', 'title', 'name', 'artist_username', 'songs_length', 'image', 'image_srcset']
+
+    def get_image(self, obj):
+        return storage_image_url(obj)
+
+
+class LibraryArtistCardSerializer(serializers.ModelSerializer):
+    title = serializers.CharField(source='username', read_only=True)
+    artist_username = serializers.CharField(source='username', read_only=True)
+    image = serializers.SerializerMethodField()
+    image_srcset = ImageSrcsetField(source='*')
+
+    class Meta:
+        model = CustomUser
+        fields = ['id', 'title', 'artist_username', 'type', 'image', 'image_srcset']
+
+    def get_image(self, obj):
+        return storage_image_url(obj)
+
+
+LIBRARY_CARDS = {
+    Song: (LibrarySongCardSerializer, ['album__artist']),
+    Album: (LibraryAlbumCardSerializer, ['artist']),
+    Playlist: (LibraryPlaylistCardSerializer, ['user']),
+    CustomUser: (LibraryArtistCardSerializer, []),
+}
+
+
+def resolve_library_objects(items):
+    # One id__in query per content type instead of one per item.
+    object_ids = {}
+    for item in items:
+        object_ids.setdefault(item.content_type, []).append(item.object_id)
+
+    objects = {}
+    for content_type, ids in object_ids.items():
+        model = content_type.model_class()
+        if model not in LIBRARY_CARDS:
+            continue
+        for object_id, library_object in model.objects.select_related(*LIBRARY_CARDS[model][1]).in_bulk(ids).items():
+            objects[(content_type.id, object_id)] = library_object
+    return objects
+
+
 class LibraryItemSerializer(serializers.ModelSerializer):
     content_type = serializers.CharField(source='content_type.model', read_only=True)
     library_obj = serializers.SerializerMethodField()
@@ -636,30 +794,59 @@ class LibraryItemSerializer(serializers.ModelSerializer):
 
     @extend_schema_field(serializers.DictField)
     def get_library_obj(self, obj):
-        content_type = obj.content_type.model_class()
-        if content_type:
-            try:
-                library_object = content_type.objects.get(id=obj.object_id)
-                if isinstance(library_object, Song):
-                    return SongSerializer(library_object, nested=True, context=self.context).data
-                elif isinstance(library_object, Playlist):
-                    return PlaylistSerializer(library_object, nested=True, context=self.context).data
-                elif isinstance(library_object, Album):
-                    return AlbumSerializer(library_object, library=True, context=self.context).data
-                elif isinstance(library_object, CustomUser):
-                    return ArtistSerializer(library_object, nested=True, context=self.context).data
-            except content_type.DoesNotExist:
-                return None
+        return library_card(obj, self.context)
+
+
+def library_card(obj, context):
+    objects = context.get('library_objects')
+    if objects is None:
+        objects = resolve_library_objects([obj])
+
+    library_object = objects.get((obj.content_type_id, obj.object_id))
+    if library_object is None:
         return None
+    return LIBRARY_CARDS[type(library_object)][0](library_object, context=context).data
 
 
 
 
 class LibrarySerializer(serializers.ModelSerializer):
-    items = LibraryItemSerializer(many=True, read_only=True)
+    cursor = serializers.SerializerMethodField()
+    items = serializers.SerializerMethodField()
     class Meta:
         model = Library
-        fields = ['id', 'user', 'items']
+        fields = ['id', 'user', 'cursor', 'items']
+
+    @extend_schema_field(serializers.IntegerField)
+    def get_cursor(self, obj):
+        # Read before the items so no change can fall between the two.
+        return obj.changes.aggregate(last=Max('seq'))['last'] or 0
+
+    @extend_schema_field(LibraryItemSerializer(many=True))
+    def get_items(self, obj):
+        items = list(obj.items.select_related('content_type'))
+        context = {**self.context, 'library_objects': resolve_library_objects(items)}
+        return LibraryItemSerializer(items, many=True, context=context).data
+
+
+class LibraryChangeSerializer(serializers.ModelSerializer):
+    content_type = serializers.CharField(source='content_type.model', read_only=True)
+    is_pinned = serializers.SerializerMethodField()
+    library_obj = serializers.SerializerMethodField()
+
+    class Meta:
+        model = LibraryChange
+        fields = ['id', 'seq', 'action', 'item_id', 'content_type', 'object_id', 'is_pinned', 'library_obj']
+
+    @extend_schema_field(serializers.BooleanField)
+    def get_is_pinned(self, obj):
+        return obj.item_id in self.context.get('pinned_item_ids', ())
+
+    @extend_schema_field(serializers.DictField)
+    def get_library_obj(self, obj):
+        if obj.action == 'remove':
+            return None
+        return library_card(obj, self.context)
 
 
 class PlaybackHistorySerializer(serializers.ModelSerializer):
@@ -693,7 +880,7 @@ class PlaybackHistorySerializer(serializers.ModelSerializer):
         if not content_type:
             raise serializers.ValidationError("Missing content_type")
 
-        return PlaybackHistory.objects.create(
+        return PlaybackHistory.record(
             user=self.context.get('request').user,
             content_type=content_type,
             object_id=validated_data['object_id']
@@ -1,6 +1,10 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from .models import CustomUser, CurrentPlayback, Playlist, Library, LibraryItem, Song, Album
+from .models import CustomUser, CurrentPlayback, Playlist, PlaylistSong, Library, LibraryItem, LibraryChange, ObjectChange, Song, Album, SongPlayback
+from .rollups import record_playback, record_listening
+from .cleanup import schedule_cleanup
+from .blobs import schedule_release
 from django.contrib.contenttypes.models import ContentType
 
 @receiver(post_save, sender=CustomUser)
@@ -14,17 +18,129 @@ def create_current_playback(sender, instance, created, **kwargs):
                                    object_id=playlist.id)
 
 
+@receiver(post_save, sender=SongPlayback)
+def update_play_rollups(sender, instance, created, **kwargs):
+    if created:
+        record_playback(instance)
+
+
+@receiver(post_save, sender=SongPlayback)
+def update_listening_profile(sender, instance, created, **kwargs):
+    if created:
+        record_listening(instance)
+
+
+def deletion_origin(origin):
+    return getattr(origin, 'model', type(origin))
+
+
+@receiver(pre_delete, sender=Song)
+@receiver(pre_delete, sender=Album)
+@receiver(pre_delete, sender=CustomUser)
+def update_playlist_counters(sender, instance, origin=None, **kwargs):
+    # Handled once for the album or artist whose delete cascades here.
+    if (sender is Song and deletion_origin(origin) is not Song) or (sender is Album and deletion_origin(origin) is CustomUser):
+        return
+
+    lookup = {Song: 'song', Album: 'song__album', CustomUser: 'song__album__artist'}[sender]
+    copies = PlaylistSong.objects.filter(**{lookup: instance}).values('playlist_id').annotate(
+        count=Count('id'), duration=Sum('song__duration')
+    ).order_by()
+    for row in copies:
+        Playlist.objects.filter(id=row['playlist_id']).update(
+            songs_count=F('songs_count') - row['count'],
+            total_duration=F('total_duration') - row['duration'],
+            version=F('version') + 1,
+        )
+
+
+@receiver(post_save, sender=Song)
+@receiver(post_delete, sender=Song)
+def bump_album_version(sender, instance, created=False, origin=None, **kwargs):
+    if kwargs['signal'] is post_delete and deletion_origin(origin) is not Song:
+        return
+    Album.bump_versions(pk=instance.album_id)
+    if kwargs['signal'] is post_save and not created:
+        Playlist.bump_versions(playlist_songs__song=instance)
+
+
+# Renditions written by the media worker; library cards do not show them.
+WORKER_FIELDS = {'hls_manifest', 'waveform_version', 'image_variants'}
+
+
+def worker_save(update_fields):
+    return update_fields is not None and set(update_fields) - {'version'} <= WORKER_FIELDS
+
+
+@receiver(post_save, sender=Song)
+@receiver(post_save, sender=Album)
+@receiver(post_save, sender=Playlist)
+def record_library_update(sender, instance, created, update_fields=None, **kwargs):
+    if not created and not worker_save(update_fields):
+        ObjectChange.record(sender, [instance.pk])
+
+
+@receiver(post_save, sender=Album)
+def bump_album_dependents(sender, instance, created, update_fields=None, **kwargs):
+    # Playlist tracks and song cards show the album's cover.
+    if created:
+        return
+    Playlist.bump_versions(playlist_songs__song__album=instance)
+    if not worker_save(update_fields):
+        ObjectChange.record(Song, instance.songs.values_list('id', flat=True))
+
+
+# Saved on every login; nothing renders them.
+UNRENDERED_USER_FIELDS = {'last_login', 'password'}
+
+
+@receiver(post_save, sender=CustomUser)
+def bump_user_dependents(sender, instance, created, update_fields=None, **kwargs):
+    # Albums, playlist tracks and library cards render the user's name and
+    # image as the artist, a featured artist or a playlist owner.
+    if created or (update_fields is not None and set(update_fields) <= UNRENDERED_USER_FIELDS):
+        return
+    Album.bump_versions(Q(artist=instance) | Q(songs__featured_artists=instance))
+    Playlist.bump_versions(Q(playlist_songs__song__album__artist=instance) | Q(playlist_songs__song__featured_artists=instance))
+    if worker_save(update_fields):
+        return
+    ObjectChange.record(CustomUser, [instance.pk])
+    ObjectChange.record(Album, Album.objects.filter(artist=instance).values_list('id', flat=True))
+    ObjectChange.record(Song, Song.objects.filter(album__artist=instance).values_list('id', flat=True))
+    ObjectChange.record(Playlist, Playlist.objects.filter(user=instance).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=LibraryItem)
+@receiver(post_delete, sender=LibraryItem)
+def bump_library_version(sender, instance, **kwargs):
+    Library.bump_versions(pk=instance.library_id)
+
+
+@receiver(post_save, sender=LibraryItem)
+def record_library_add(sender, instance, created, **kwargs):
+    if created:
+        LibraryChange.record(instance, 'add')
+
+
+@receiver(post_delete, sender=LibraryItem)
+def record_library_remove(sender, instance, origin=None, **kwargs):
+    # Items deleted along with their library have nobody left to sync to.
+    if deletion_origin(origin) in (Library, CustomUser):
+        return
+    LibraryChange.record(instance, 'remove')
+
+
 @receiver(post_delete, sender=Song)
 @receiver(post_delete, sender=Album)
 @receiver(post_delete, sender=CustomUser)
 @receiver(post_delete, sender=Playlist)
 def delete_related_library_item(sender, instance, **kwargs):
-    content_type = ContentType.objects.get_for_model(instance)
-    try:
-        library_item = LibraryItem.objects.get(
-            content_type=content_type,
-            object_id=instance.id
-        )
-        library_item.delete()
-    except LibraryItem.DoesNotExist:
-        pass
\ No newline at end of file
+    schedule_cleanup(instance)
+
+
+@receiver(post_delete, sender=Song)
+@receiver(post_delete, sender=Album)
+@receiver(post_delete, sender=CustomUser)
+@receiver(post_delete, sender=Playlist)
+def release_media_blobs(sender, instance, **kwargs):
+    schedule_release(instance)
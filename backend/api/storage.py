@@ -0,0 +1,194 @@
+import base64
+import contextlib
+import mimetypes
+import os
+import time
+from functools import lru_cache
+from urllib.parse import quote, urlencode
+import httpx
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.utils._os import safe_join
+
+# Supabase's resumable (TUS) endpoint takes chunks of exactly 6MB (the last
+# one may be shorter). Each chunk is streamed from the file in small blocks,
+# so an upload holds a few hundred KB regardless of the file size.
+TUS_CHUNK_SIZE = 6 * 1024 * 1024
+TUS_RETRIES = 3
+READ_BLOCK_SIZE = 256 * 1024
+SIGNED_URL_SALT = 'api.storage.signed-url'
+
+
+def _as_file(file):
+    # Accepts bytes, a path on disk or any Django File / file object.
+    if isinstance(file, (bytes, bytearray)):
+        return contextlib.nullcontext(ContentFile(bytes(file)))
+    if isinstance(file, (str, os.PathLike)):
+        return File(open(file, 'rb'))
+    return contextlib.nullcontext(file if isinstance(file, File) else File(file))
+
+
+def _read_range(file, offset, length, block_size=READ_BLOCK_SIZE):
+    file.seek(offset)
+    while length > 0:
+        block = file.read(min(block_size, length))
+        if not block:
+            return
+        length -= len(block)
+        yield block
+
+
+class SupabaseStorage:
+    def __init__(self, url, key):
+        self.url = url.rstrip('/')
+        self.key = key
+        self._client = None
+
+    @property
+    def client(self):
+        # Built on first use so importing the app does not need the service.
+        if self._client is None:
+            from supabase import create_client
+            self._client = create_client(self.url, self.key)
+        return self._client
+
+    def _headers(self):
+        return {'Authorization': f'Bearer {self.key}', 'apikey': self.key}
+
+    def put(self, bucket, name, file, upsert=False):
+        return self.stream_put(bucket, name, file, upsert)
+
+    def tus_headers(self):
+        return {**self._headers(), 'Tus-Resumable': '1.0.0'}
+
+    def tus_create_headers(self, bucket, name, size, upsert):
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        metadata = {'bucketName': bucket, 'objectName': name, 'contentType': content_type, 'cacheControl': '3600'}
+        return {
+            **self.tus_headers(),
+            'Upload-Length': str(size),
+            'Upload-Metadata': ','.join(f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in metadata.items()),
+            'x-upsert': 'true' if upsert else 'false',
+        }
+
+    def tus_patch_headers(self, offset, length):
+        return {
+            **self.tus_headers(), 'Upload-Offset': str(offset), 'Content-Length': str(length),
+            'Content-Type': 'application/offset+octet-stream',
+        }
+
+    def stream_put(self, bucket, name, file, upsert=False, chunk_size=TUS_CHUNK_SIZE, client=None):
+        headers = self.tus_headers()
+
+        with _as_file(file) as file, contextlib.ExitStack() as stack:
+            if client is None:
+                client = stack.enter_context(httpx.Client(timeout=httpx.Timeout(60.0, connect=10.0)))
+
+            size = file.size
+            response = client.post(f"{self.url}/storage/v1/upload/resumable", headers=self.tus_create_headers(bucket, name, size, upsert))
+            response.raise_for_status()
+            location = response.headers['Location']
+
+            offset = failures = 0
+            while offset < size:
+                length = min(chunk_size, size - offset)
+                try:
+                    response = client.patch(location, content=_read_range(file, offset, length), headers=self.tus_patch_headers(offset, length))
+                    response.raise_for_status()
+                    offset = int(response.headers['Upload-Offset'])
+                    failures = 0
+                except httpx.HTTPError:
+                    failures += 1
+                    if failures > TUS_RETRIES:
+                        raise
+                    # Resume from whatever the server kept.
+                    offset = int(client.head(location, headers=headers).headers['Upload-Offset'])
+
+        return f"{bucket}/{name}"
+
+    def public_url(self, bucket, name):
+        return f"{self.url}/storage/v1/object/public/{bucket}/{quote(name)}"
+
+    def signed_url(self, bucket, name, expires_in=3600):
+        return self.client.storage.from_(bucket).create_signed_url(name, expires_in)['signedURL']
+
+    def delete(self, bucket, names):
+        if names:
+            self.client.storage.from_(bucket).remove(list(names))
+
+    def exists(self, bucket, name):
+        return self.client.storage.from_(bucket).exists(name)
+
+
+class LocalStorage:
+    # Keeps objects under `root/<bucket>/<name>`; api.views.local_storage_object
+    # (the 'local-storage-object' URL, storage/<bucket>/<name>) serves them
+    # from `base_url`.
+    def __init__(self, root, base_url):
+        self.root = str(root)
+        self.base_url = base_url.rstrip('/') + '/'
+
+    def path(self, bucket, name):
+        return safe_join(self.root, bucket, name)
+
+    def put(self, bucket, name, file, upsert=False):
+        return self.stream_put(bucket, name, file, upsert)
+
+    def stream_put(self, bucket, name, file, upsert=False):
+        path = self.path(bucket, name)
+        if not upsert and os.path.exists(path):
+            raise FileExistsError(f"{bucket}/{name} already exists")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written next to the target and renamed, so readers never see a
+        # partial object.
+        partial = f"{path}.{os.getpid()}.part"
+        with _as_file(file) as file:
+            with open(partial, 'wb') as target:
+                for block in _read_range(file, 0, file.size):
+                    target.write(block)
+        os.replace(partial, path)
+        return f"{bucket}/{name}"
+
+    def public_url(self, bucket, name):
+        return f"{self.base_url}{bucket}/{quote(name)}"
+
+    def signed_url(self, bucket, name, expires_in=3600):
+        token = signing.dumps({'object': f"{bucket}/{name}", 'expires': int(time.time()) + expires_in}, salt=SIGNED_URL_SALT)
+        return f"{self.public_url(bucket, name)}?{urlencode({'token': token})}"
+
+    def verify_signature(self, bucket, name, token):
+        try:
+            payload = signing.loads(token, salt=SIGNED_URL_SALT)
+        except signing.BadSignature:
+            return False
+        return payload['object'] == f"{bucket}/{name}" and payload['expires'] >= time.time()
+
+    def delete(self, bucket, names):
+        for name in names:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(bucket, name))
+
+    def exists(self, bucket, name):
+        return os.path.isfile(self.path(bucket, name))
+
+    def open(self, bucket, name):
+        return open(self.path(bucket, name), 'rb')
+
+
+@lru_cache
+def _build_storage(backend, local_root, local_url, supabase_url, supabase_key):
+    if backend == 'local':
+        return LocalStorage(local_root, local_url)
+    if backend == 'supabase':
+        return SupabaseStorage(supabase_url, supabase_key)
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
+
+
+def get_storage():
+    return _build_storage(
+        settings.STORAGE_BACKEND, str(settings.STORAGE_LOCAL_ROOT), settings.STORAGE_LOCAL_URL,
+        settings.SUPABASE_URL, settings.SUPABASE_KEY,
+    )
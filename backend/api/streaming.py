@@ -0,0 +1,142 @@
+import mimetypes
+import mmap
+import os
+import re
+import secrets
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+STREAM_BLOCK_SIZE = 256 * 1024
+MAX_RANGES = 16
+RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(header, size):
+    # Returns a list of inclusive (start, end) pairs, None when the header
+    # should be ignored (malformed or too many ranges) and [] when no range
+    # is satisfiable.
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            # Suffix range: the last N bytes.
+            if int(last) == 0:
+                continue
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size:
+            ranges.append((start, end))
+    return ranges
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        # If-Range requires a strong comparison.
+        return not if_range.startswith('W/') and etag in parse_etags(if_range)
+    return parse_http_date_safe(if_range) == last_modified
+
+
+class RangeFile:
+    # Bounded view over an open file. Servers using wsgi.file_wrapper with
+    # sendfile (e.g. gunicorn) send Content-Length bytes from the current
+    # offset of fileno(), so a single range is copied by the kernel.
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def multipart_ranges(path, ranges, content_type, size, boundary):
+    def part_header(start, end):
+        return (
+            f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode()
+
+    closing = f"\r\n--{boundary}--\r\n".encode()
+    length = sum(len(part_header(start, end)) + end - start + 1 for start, end in ranges) + len(closing)
+
+    def body():
+        # Slicing the mapping copies one block at a time out of the page cache.
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in ranges:
+                yield part_header(start, end)
+                for offset in range(start, end + 1, STREAM_BLOCK_SIZE):
+                    yield data[offset:min(offset + STREAM_BLOCK_SIZE, end + 1)]
+            yield closing
+
+    return body(), length
+
+
+def ranged_file_response(request, path, content_type=None, cache_control='public, max-age=3600'):
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    etag = quote_etag(f"{stat.st_mtime_ns:x}-{size:x}")
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    def with_headers(response):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Accept-Ranges'] = 'bytes'
+        response['Cache-Control'] = cache_control
+        return response
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return with_headers(not_modified)
+
+    header = request.headers.get('Range')
+    ranges = parse_range_header(header, size) if header and request.method == 'GET' and if_range_matches(request, etag, last_modified) else None
+
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        return with_headers(response)
+
+    if not ranges:
+        return with_headers(FileResponse(open(path, 'rb'), content_type=content_type))
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = FileResponse(RangeFile(open(path, 'rb'), start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+        return with_headers(response)
+
+    boundary = secrets.token_hex(16)
+    body, length = multipart_ranges(path, ranges, content_type, size, boundary)
+    response = StreamingHttpResponse(body, status=206, content_type=f"multipart/byteranges; boundary={boundary}")
+    response['Content-Length'] = length
+    return with_headers(response)
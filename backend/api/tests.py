@@ -1,3 +1,1641 @@
-from django.test import TestCase
+import asyncio
+import base64
+import importlib
+import io
+import json
+import resource
+import threading
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import httpx
+from PIL import Image
+from django.apps import apps as django_apps
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import pre_delete
+from .models import CustomUser, Album, Song, SongPlayback, Playlist, PlaylistSong, Library, LibraryItem, LibraryChange, ObjectChange, PlaybackHistory, CurrentPlayback, SongDailyPlays, ArtistDailyPlays, GenreDailyPlays, UserSongDailyPlays, ListeningProfile, ChartSnapshot, MediaJob, SongAnalysis, MediaBlob
+from .provisioning import provision_users
+from .blobs import attach_blob, collect_garbage
+from .images import render_variants, store_variants
+from .media import run_job, save_analysis
+from .utils import get_top_songs_by_genre, upload_image, upload_audio
+from accounts.serializers import CustomUserSerializer
+from .serializers import ArtistSerializer
+from .charts import build_chart_snapshot, build_genre_charts
+from .async_storage import AsyncSupabaseStorage
+from .storage import READ_BLOCK_SIZE, SupabaseStorage, TUS_CHUNK_SIZE, get_storage
+from .waveform import analyze_audio
 
 # Create your tests here.
+class PlaylistBulkMutationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=artist)
+        cls.songs = Song.objects.bulk_create([
+            Song(title=f'Song {idx}', album=album, duration=timedelta(seconds=180), file=f'songs/{idx}.mp3', track_number=idx + 1)
+            for idx in range(1000)
+        ])
+        cls.song_ids = [song.id for song in cls.songs]
+
+    def setUp(self):
+        self.playlist = Playlist.objects.create(user=self.user, name='Bulk')
+
+    def count_queries(self, callback):
+        with CaptureQueriesContext(connection) as queries:
+            callback()
+        return len(queries)
+
+    def playlist_song_ids(self):
+        return list(self.playlist.playlist_songs.order_by('order').values_list('song_id', flat=True))
+
+    def test_add_query_count_does_not_depend_on_batch_size(self):
+        small = self.count_queries(lambda: self.playlist.add_songs(self.song_ids[:10]))
+        large = self.count_queries(lambda: self.playlist.add_songs(self.song_ids))
+
+        self.assertEqual(small, large)
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[:10] + self.song_ids)
+
+    def test_remove_query_count_does_not_depend_on_batch_size(self):
+        self.playlist.add_songs(self.song_ids)
+
+        small = self.count_queries(lambda: self.playlist.remove_songs(self.song_ids[:10]))
+        large = self.count_queries(lambda: self.playlist.remove_songs(self.song_ids[10:]))
+
+        self.assertEqual(small, large)
+        self.assertEqual(self.playlist_song_ids(), [])
+
+    def test_replace_query_count_does_not_depend_on_batch_size(self):
+        small = self.count_queries(lambda: self.playlist.replace_songs(self.song_ids[:10]))
+        large = self.count_queries(lambda: self.playlist.replace_songs(self.song_ids[::-1]))
+
+        self.assertEqual(small, large)
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[::-1])
+
+    def test_add_skip_existing_and_dedupe(self):
+        self.playlist.add_songs(self.song_ids[:3])
+        self.playlist.add_songs(self.song_ids[:5], skip_existing=True)
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[:5])
+
+        self.playlist.add_songs(self.song_ids[:2])
+        self.playlist.dedupe_songs()
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[:5])
+
+    def test_unknown_song_ids_are_ignored(self):
+        self.playlist.add_songs([self.song_ids[0], 0, -1])
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[:1])
+
+
+class PlaylistCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        cls.fan = CustomUser.objects.create_user(email='fan@example.com', password='password123', username='fan')
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=artist)
+        cls.songs = [
+            Song.objects.create(title=f'Song {idx}', album=album, duration=timedelta(seconds=100 + idx), file=f'songs/{idx}.mp3', track_number=idx + 1)
+            for idx in range(4)
+        ]
+
+    def setUp(self):
+        self.playlist = Playlist.objects.create(user=self.user, name='Counted')
+
+    def counters(self):
+        self.playlist.refresh_from_db()
+        return self.playlist.songs_count, self.playlist.total_duration, self.playlist.savings
+
+    def actual(self):
+        songs = [track.song for track in self.playlist.playlist_songs.select_related('song')]
+        return len(songs), sum((song.duration for song in songs), timedelta(0))
+
+    def test_every_mutation_moves_the_counters_and_version(self):
+        ids = [song.id for song in self.songs]
+        for mutate in [
+            lambda: self.playlist.add_songs(ids + ids[:2]),
+            lambda: self.playlist.remove_songs(ids[3:]),
+            lambda: self.playlist.dedupe_songs(),
+            lambda: self.playlist.replace_songs(ids[::-1]),
+            lambda: self.playlist.move_songs(0, from_position=3),
+            lambda: self.songs[0].set_duration(timedelta(seconds=200)),
+        ]:
+            version = self.playlist.version
+            mutate()
+            self.assertEqual(self.counters()[:2], self.actual())
+            self.assertGreater(self.playlist.version, version)
+
+    def test_reconcile_fixes_drift(self):
+        self.playlist.add_songs([song.id for song in self.songs])
+        LibraryItem.objects.create(library=self.fan.library, content_type=ContentType.objects.get_for_model(Playlist), object_id=self.playlist.id)
+        # Edits that bypass the model methods.
+        PlaylistSong.objects.filter(playlist=self.playlist, song=self.songs[0])._raw_delete(PlaylistSong.objects.db)
+        Song.objects.filter(id=self.songs[1].id).update(duration=timedelta(seconds=300))
+        drifted = self.counters()
+
+        out = StringIO()
+        call_command('reconcile_playlist_counters', '--dry-run', stdout=out)
+        self.assertIn('1 playlists drifted (dry run', out.getvalue())
+        self.assertEqual(self.counters(), drifted)
+
+        call_command('reconcile_playlist_counters', stdout=StringIO())
+        self.assertEqual(self.counters(), (3, timedelta(seconds=300 + 102 + 103), 1))
+
+        out = StringIO()
+        call_command('reconcile_playlist_counters', stdout=out)
+        self.assertIn('0 playlists drifted', out.getvalue())
+
+
+class PlaylistMoveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=artist)
+        cls.song_ids = [song.id for song in Song.objects.bulk_create([
+            Song(title=f'Song {idx}', album=album, duration=timedelta(seconds=180), file=f'songs/{idx}.mp3', track_number=idx + 1)
+            for idx in range(10)
+        ])]
+
+    def setUp(self):
+        self.playlist = Playlist.objects.create(user=self.user, name='Move')
+        self.playlist.add_songs(self.song_ids)
+
+    def playlist_orders(self):
+        return dict(self.playlist.playlist_songs.values_list('song_id', 'order'))
+
+    def playlist_song_ids(self):
+        return list(self.playlist.playlist_songs.order_by('order').values_list('song_id', flat=True))
+
+    def test_move_range_only_updates_moved_rows(self):
+        before = self.playlist_orders()
+        self.playlist.move_songs(6, from_position=1, count=2)
+        after = self.playlist_orders()
+
+        ids = self.song_ids
+        self.assertEqual(self.playlist_song_ids(), [ids[0]] + ids[3:8] + ids[1:3] + ids[8:])
+        self.assertEqual({song_id for song_id in after if after[song_id] != before[song_id]}, set(ids[1:3]))
+
+    def test_move_by_song_ids_to_front(self):
+        ids = self.song_ids
+        self.playlist.move_songs(0, song_ids=[ids[9], ids[5]])
+        self.assertEqual(self.playlist_song_ids(), [ids[5], ids[9]] + ids[:5] + ids[6:9])
+
+    def test_move_rejects_positions_outside_the_playlist(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        before = self.playlist_song_ids()
+        for params, message in [
+            ({'from_position': 10, 'to_position': 0}, 'from_position must be between 0 and 9'),
+            ({'from_position': 8, 'count': 3, 'to_position': 0}, 'from_position must be between 0 and 7'),
+            ({'from_position': -1, 'to_position': 0}, 'from_position must be between 0 and 9'),
+            ({'from_position': 0, 'count': 0, 'to_position': 0}, 'count must be at least 1'),
+            ({'from_position': 0, 'count': 2, 'to_position': 9}, 'to_position must be between 0 and 8'),
+            ({'from_position': 0, 'to_position': -1}, 'to_position must be between 0 and 9'),
+            ({'song_ids': self.song_ids[:3], 'to_position': 8}, 'to_position must be between 0 and 7'),
+        ]:
+            response = self.client.post('/api/modify/playlist/', {'playlist_id': self.playlist.id, 'action': 'move', **params}, format='json')
+            self.assertEqual(response.status_code, 400, params)
+            self.assertTrue(response.json()['error'].startswith(message), response.json())
+        self.assertEqual(self.playlist_song_ids(), before)
+
+        response = self.client.post('/api/modify/playlist/', {'playlist_id': self.playlist.id, 'action': 'move', 'from_position': 0, 'to_position': 9}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.playlist_song_ids(), before[1:] + before[:1])
+
+    def test_free_orders_split_the_gap_at_a_position(self):
+        gap = PlaylistSong.ORDER_GAP
+        self.assertEqual(self.playlist.free_orders(0, 3), [gap // 4, gap // 2, 3 * gap // 4])
+        self.assertEqual(self.playlist.free_orders(4, 3), [4 * gap + gap // 4, 4 * gap + gap // 2, 4 * gap + 3 * gap // 4])
+        self.assertEqual(self.playlist.free_orders(10, 2), [11 * gap, 12 * gap])
+        # Without the excluded rows, position 1 falls between the first and fourth.
+        excluded = list(self.playlist.playlist_songs.filter(song_id__in=self.song_ids[1:3]).values_list('id', flat=True))
+        self.assertEqual(self.playlist.free_orders(1, exclude_ids=excluded), [gap + 3 * gap // 2])
+
+    def test_insert_between_neighbours_only_writes_the_new_row(self):
+        before = self.playlist_orders()
+        song = Song.objects.create(title='Inserted', album=Album.objects.get(), duration=timedelta(seconds=60), file='songs/inserted.mp3', track_number=11)
+
+        inserted = self.playlist.insert_song(song, 3)
+        after = self.playlist_orders()
+        self.assertEqual(inserted.order, (before[self.song_ids[2]] + before[self.song_ids[3]]) // 2)
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[:3] + [song.id] + self.song_ids[3:])
+        self.assertEqual({song_id: order for song_id, order in after.items() if song_id != song.id}, before)
+
+    def test_insert_into_an_exhausted_gap_respaces_the_neighbourhood(self):
+        # Rows 4 and 5 are adjacent, so nothing fits between them.
+        PlaylistSong.objects.filter(playlist=self.playlist, song_id=self.song_ids[5]).update(order=self.playlist_orders()[self.song_ids[4]] + 1)
+        song = Song.objects.create(title='Inserted', album=Album.objects.get(), duration=timedelta(seconds=60), file='songs/inserted.mp3', track_number=11)
+
+        self.playlist.insert_song(song, 5)
+        orders = sorted(self.playlist_orders().values())
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[:5] + [song.id] + self.song_ids[5:])
+        self.assertEqual(len(set(orders)), 11)
+        self.assertGreaterEqual(min(high - low for low, high in zip(orders, orders[1:])), PlaylistSong.ORDER_GAP // 8)
+
+    def test_gap_migration_spreads_dense_orders_and_compacts_them_back(self):
+        migration = importlib.import_module('api.migrations.0018_playlistsong_gap_order')
+        for idx, song_id in enumerate(reversed(self.song_ids)):
+            PlaylistSong.objects.filter(playlist=self.playlist, song_id=song_id).update(order=idx)
+
+        migration.spread_orders(django_apps, None)
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[::-1])
+        self.assertEqual(sorted(self.playlist_orders().values()), [(idx + 1) * migration.ORDER_GAP for idx in range(10)])
+
+        migration.compact_orders(django_apps, None)
+        self.assertEqual(self.playlist_song_ids(), self.song_ids[::-1])
+        self.assertEqual(sorted(self.playlist_orders().values()), list(range(10)))
+
+    def test_repeated_moves_respace_when_gap_is_exhausted(self):
+        for _ in range(30):
+            self.playlist.move_songs(1, from_position=9)
+
+        self.assertEqual(len(set(self.playlist_orders().values())), 10)
+        self.assertEqual(sorted(self.playlist_song_ids()), sorted(self.song_ids))
+
+
+class PlaylistTracksTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        cls.other = CustomUser.objects.create_user(email='other@example.com', password='password123', username='other')
+        albums = [
+            Album.objects.create(title=f'Album {name}', artist=CustomUser.objects.create_user(email=f'{name}@example.com', password='password123', username=name, type='artist'))
+            for name in ['beta', 'alpha']
+        ]
+        # Repeated titles, artists and added_at values, so every ordering
+        # key has ties the cursor must break by id.
+        cls.song_ids = [song.id for song in Song.objects.bulk_create([
+            Song(title=f'Song {idx % 4}', album=albums[idx % 2], duration=timedelta(seconds=180), file=f'songs/{idx}.mp3', track_number=idx + 1)
+            for idx in range(11)
+        ])]
+        cls.playlist = Playlist.objects.create(user=cls.user, name='Private', is_public=False)
+        cls.playlist.add_songs(cls.song_ids)
+        added = timezone.now()
+        for idx, track in enumerate(cls.playlist.playlist_songs.order_by('order')):
+            track.added_at = added - timedelta(days=idx % 3)
+            track.save(update_fields=['added_at'])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/playlists/{self.playlist.id}/tracks/'
+
+    def walk(self, query):
+        ids = []
+        response = self.client.get(f'{self.url}?page_size=3&{query}')
+        while True:
+            self.assertEqual(response.status_code, 200)
+            ids += [track['id'] for track in response.data['results']]
+            if not response.data['next']:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_every_ordering_key_pages_through_ties_without_gaps_or_repeats(self):
+        keys = {
+            'position': lambda track: track.order,
+            'title': lambda track: track.song.title,
+            'artist': lambda track: track.song.album.artist.username,
+            'added': lambda track: track.added_at,
+        }
+        tracks = list(self.playlist.playlist_songs.select_related('song__album__artist'))
+        for ordering, key in keys.items():
+            expected = [track.id for track in sorted(tracks, key=lambda track: (key(track), track.id))]
+            self.assertEqual(self.walk(f'ordering={ordering}'), expected, ordering)
+            self.assertEqual(self.walk(f'ordering=-{ordering}'), expected[::-1], ordering)
+
+    def test_cursor_is_stable_when_the_playlist_changes_between_pages(self):
+        response = self.client.get(f'{self.url}?page_size=4')
+        seen = [track['id'] for track in response.data['results']]
+        # Removing a track already read and appending a new one must not
+        # shift the next page.
+        self.playlist.remove_songs([self.song_ids[0]])
+        self.playlist.add_songs([self.song_ids[0]])
+
+        response = self.client.get(response.data['next'])
+        rest = [track['id'] for track in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            rest += [track['id'] for track in response.data['results']]
+
+        remaining = list(self.playlist.playlist_songs.order_by('order').values_list('id', flat=True))
+        self.assertEqual(seen[1:] + rest, remaining)
+
+    def test_private_playlist_is_only_visible_to_its_owner(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+        self.client.force_authenticate(self.other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        Playlist.objects.filter(id=self.playlist.id).update(is_public=True)
+        self.assertEqual(len(self.client.get(self.url).data['results']), 11)
+
+    def test_new_plays_change_the_etag(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        song_id = response.data['results'][0]['song']['id']
+        SongPlayback.objects.create(user=self.other, song_id=song_id)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['song']['plays'], 1)
+
+    def test_mutation_returns_metadata_and_a_tracks_link(self):
+        response = self.client.post('/api/modify/playlist/', {'playlist_id': self.playlist.id, 'action': 'remove', 'song_ids': [self.song_ids[0]]}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        playlist = response.data['playlist']
+        self.assertNotIn('songs', playlist)
+        self.assertEqual(playlist['songs_length'], 10)
+        self.assertEqual(playlist['tracks'], f'http://testserver{self.url}')
+
+
+class PlayRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.listeners = [
+            CustomUser.objects.create_user(email=f'listener{idx}@example.com', password='password123', username=f'listener{idx}')
+            for idx in range(2)
+        ]
+        cls.artists = [
+            CustomUser.objects.create_user(email=f'artist{idx}@example.com', password='password123', username=f'artist{idx}', type='artist')
+            for idx in range(2)
+        ]
+        albums = [Album.objects.create(title=f'Album {idx}', artist=artist) for idx, artist in enumerate(cls.artists)]
+        cls.rock = [
+            Song.objects.create(title=f'Rock {idx}', album=albums[0], duration=timedelta(seconds=180), file=f'songs/rock{idx}.mp3', track_number=idx + 1, genre='rock')
+            for idx in range(2)
+        ]
+        cls.pop = Song.objects.create(title='Pop', album=albums[1], duration=timedelta(seconds=120), file='songs/pop.mp3', track_number=1, genre='pop')
+
+    def play(self, user, song, days_ago=0):
+        with mock.patch.object(timezone, 'now', return_value=timezone.now() - timedelta(days=days_ago)):
+            return SongPlayback.objects.create(user=user, song=song)
+
+    def play_everything(self):
+        first, second = self.listeners
+        self.play(first, self.rock[0], days_ago=1)
+        self.play(first, self.rock[0])
+        self.play(first, self.rock[0])
+        self.play(first, self.rock[1])
+        self.play(second, self.rock[0])
+        self.play(second, self.pop)
+
+    def rollups(self):
+        return {
+            'songs': sorted(SongDailyPlays.objects.values_list('song_id', 'day', 'plays', 'distinct_listeners')),
+            'artists': sorted(ArtistDailyPlays.objects.values_list('artist_id', 'day', 'plays', 'distinct_listeners')),
+            'genres': sorted(GenreDailyPlays.objects.values_list('genre', 'day', 'plays', 'distinct_listeners')),
+        }
+
+    def test_playbacks_roll_up_per_day_with_distinct_listeners(self):
+        self.play_everything()
+        today = timezone.localdate()
+        yesterday = today - timedelta(days=1)
+
+        self.assertEqual(self.rollups(), {
+            'songs': sorted([
+                (self.rock[0].id, yesterday, 1, 1), (self.rock[0].id, today, 3, 2),
+                (self.rock[1].id, today, 1, 1), (self.pop.id, today, 1, 1),
+            ]),
+            'artists': sorted([
+                (self.artists[0].id, yesterday, 1, 1), (self.artists[0].id, today, 4, 2), (self.artists[1].id, today, 1, 1),
+            ]),
+            'genres': sorted([('rock', yesterday, 1, 1), ('rock', today, 4, 2), ('pop', today, 1, 1)]),
+        })
+
+    def test_rebuild_matches_the_incremental_counts(self):
+        self.play_everything()
+        incremental = self.rollups()
+
+        call_command('rebuild_play_rollups', stdout=StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+        # --days only replaces the rows in its window.
+        SongDailyPlays.objects.update(plays=99)
+        call_command('rebuild_play_rollups', '--days', '0', stdout=StringIO())
+        yesterday = timezone.localdate() - timedelta(days=1)
+        self.assertEqual(
+            self.rollups()['songs'],
+            sorted((song, day, 99 if day == yesterday else plays, listeners) for song, day, plays, listeners in incremental['songs']),
+        )
+
+
+    def test_song_plays_are_read_from_the_daily_rollups(self):
+        self.play_everything()
+        # The rollups stay; a raw playback count would now read zero.
+        SongPlayback.objects.all().delete()
+
+        response = self.client.get('/api/songs/')
+        self.assertEqual({song['id']: song['plays'] for song in response.json()}, {self.rock[0].id: 4, self.rock[1].id: 1, self.pop.id: 1})
+
+        with self.assertNumQueries(2):
+            top_songs = ArtistSerializer().get_top_songs(self.artists[0])
+        self.assertEqual([(song['id'], song['plays']) for song in top_songs], [(self.rock[0].id, 4), (self.rock[1].id, 1)])
+
+    def test_listening_profile_only_counts_the_window(self):
+        listener = self.listeners[0]
+        for _ in range(3):
+            self.play(listener, self.rock[0], days_ago=ListeningProfile.WINDOW_DAYS + 5)
+        self.play(listener, self.rock[1])
+        self.play(listener, self.pop)
+        self.play(listener, self.pop, days_ago=1)
+        # Playbacks only bump the daily rows; the profile is stored by the refresh.
+        self.assertFalse(ListeningProfile.objects.filter(user=listener).exists())
+
+        call_command('refresh_listening_profiles', stdout=StringIO())
+        profile = ListeningProfile.objects.get(user=listener)
+        self.assertEqual(profile.top_song_ids, [self.pop.id, self.rock[1].id])
+        self.assertEqual(profile.top_artist_ids, [self.artists[1].id, self.artists[0].id])
+        self.assertEqual(profile.top_genres, ['pop', 'rock'])
+        self.assertEqual(profile.total_seconds, 2 * 120 + 180)
+
+    def test_refresh_rebuilds_the_window_and_drops_older_days(self):
+        listener = self.listeners[0]
+        self.play(listener, self.rock[0], days_ago=ListeningProfile.WINDOW_DAYS + 5)
+        self.play(listener, self.rock[0])
+        self.play(listener, self.pop, days_ago=2)
+        rows = lambda: sorted(UserSongDailyPlays.objects.filter(user=listener).values_list('song_id', 'day', 'plays'))
+        in_window = [row for row in rows() if row[1] >= ListeningProfile.window_start()]
+        self.assertEqual(len(rows()), 3)
+
+        UserSongDailyPlays.objects.filter(user=listener, song=self.pop).update(plays=7)
+        call_command('refresh_listening_profiles', stdout=StringIO())
+        self.assertEqual(rows(), in_window)
+
+    def test_profile_serializer_reads_the_stored_stats(self):
+        listener = self.listeners[0]
+        self.play(listener, self.pop)
+        self.play(listener, self.rock[0])
+        self.play(listener, self.rock[0])
+        call_command('refresh_listening_profiles', stdout=StringIO())
+        user = CustomUser.objects.select_related('listening_profile').get(pk=listener.pk)
+
+        with self.assertNumQueries(0):
+            data = {field: CustomUserSerializer().fields[field].to_representation(user) for field in ('top_genres', 'total_minutes')}
+        self.assertEqual(data, {'top_genres': ['Rock', 'Pop'], 'total_minutes': (2 * 180 + 120) // 60})
+
+
+class ChartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=artist)
+        today = timezone.localdate()
+        cls.songs = {}
+        for idx, (genre, recent, old) in enumerate([('rock', 5, 0), ('rock', 3, 100), ('rock', 8, 0), ('pop', 2, 0)]):
+            song = Song.objects.create(title=f'Song {idx}', album=album, duration=timedelta(seconds=180), file=f'songs/{idx}.mp3', track_number=idx + 1, genre=genre)
+            SongDailyPlays.objects.create(song=song, day=today, plays=recent)
+            # Outside the 30-day window.
+            SongDailyPlays.objects.create(song=song, day=today - timedelta(days=40), plays=old)
+            cls.songs[song.title] = song
+
+    def test_ranking_keeps_the_top_n_per_genre_and_breaks_ties_by_id(self):
+        album = self.songs['Song 0'].album
+        tied = [
+            Song.objects.create(title=f'Tied {idx}', album=album, duration=timedelta(seconds=180), file=f'songs/tied{idx}.mp3', track_number=10 + idx, genre='rock')
+            for idx in range(3)
+        ]
+        for song in tied:
+            SongDailyPlays.objects.create(song=song, day=timezone.localdate(), plays=5)
+
+        ranking = {}
+        for song in get_top_songs_by_genre(3):
+            ranking.setdefault(song.get_genre_display(), []).append((song.id, song.play_count, song.rank))
+        # Four songs share 5 plays for the last two places: the lowest ids win.
+        self.assertEqual(ranking, {
+            'Rock': [(self.songs['Song 2'].id, 8, 1), (self.songs['Song 0'].id, 5, 2), (tied[0].id, 5, 3)],
+            'Pop': [(self.songs['Song 3'].id, 2, 1)],
+        })
+        self.assertEqual([song.id for song in get_top_songs_by_genre(1, genre='rock')], [self.songs['Song 2'].id])
+
+    def test_snapshot_ranks_and_loads_songs_in_one_query(self):
+        # Ranked songs with album and artist, then their featured artists.
+        with self.assertNumQueries(2):
+            charts = build_genre_charts()
+        self.assertEqual([song['title'] for song in charts[1]['songs']], ['Song 2', 'Song 0', 'Song 1'])
+
+    def test_missing_snapshot_serves_no_charts_without_building_one(self):
+        response = self.client.get('/api/top-songs/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+        self.assertFalse(ChartSnapshot.objects.exists())
+
+        build_chart_snapshot()
+        self.assertEqual([chart['genre'] for chart in self.client.get('/api/top-songs/').json()], ['Pop', 'Rock'])
+
+    def test_genre_chart_counts_the_window_and_links_absolute_urls(self):
+        artist = self.songs['Song 0'].album.artist
+        artist.image = 'artists/artist.png'
+        artist.save()
+        snapshot = build_chart_snapshot()
+        self.assertFalse(snapshot.data[0]['cover'].startswith('http'))
+        self.assertEqual(self.client.get('/api/top-songs/').json()[0]['cover'], 'http://testserver' + artist.image.url)
+
+        response = self.client.get('/api/top-songs/Rock/')
+        self.assertEqual(response.status_code, 200)
+
+        [chart] = response.json()
+        self.assertEqual([(song['title'], song['plays']) for song in chart['songs']], [('Song 2', 8), ('Song 0', 5), ('Song 1', 3)])
+        song = chart['songs'][0]
+        self.assertEqual(song['stream'], f"http://testserver/api/songs/{self.songs['Song 2'].id}/stream/")
+        self.assertTrue(song['waveform'].startswith('http://testserver/'))
+
+        self.assertEqual([song['title'] for song in self.client.get('/api/top-songs/Pop/').json()[0]['songs']], ['Song 3'])
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        cls.album = Album.objects.create(title='Album', artist=artist)
+        cls.song = Song.objects.create(title='Song', album=cls.album, duration=timedelta(seconds=180), file='songs/0.mp3', track_number=1)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_album_detail_answers_304_with_one_query(self):
+        etag = self.client.get(f'/api/albums/{self.album.id}/')['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/albums/{self.album.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.song.title = 'Renamed'
+        self.song.save()
+        response = self.client.get(f'/api/albums/{self.album.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_playlist_mutations_change_etag(self):
+        playlist = Playlist.objects.create(user=self.user, name='Mine')
+        etags = {self.client.get(f'/api/user-playlists/{playlist.id}/')['ETag']}
+
+        for mutate in [
+            lambda: playlist.add_songs([self.song.id]),
+            lambda: playlist.move_songs(0, from_position=0),
+            lambda: playlist.remove_songs([self.song.id]),
+        ]:
+            mutate()
+            response = self.client.get(f'/api/user-playlists/{playlist.id}/', HTTP_IF_NONE_MATCH=', '.join(etags))
+            self.assertEqual(response.status_code, 200)
+            etags.add(response['ETag'])
+
+        list_etag = self.client.get('/api/user-playlists/')['ETag']
+        self.assertEqual(self.client.get('/api/user-playlists/', HTTP_IF_NONE_MATCH=list_etag).status_code, 304)
+
+    def test_rendered_rows_of_other_models_change_etags(self):
+        playlist = Playlist.objects.create(user=self.user, name='Mine')
+        playlist.add_songs([self.song.id])
+        urls = [f'/api/albums/{self.album.id}/', '/api/albums/', f'/api/user-playlists/{playlist.id}/']
+
+        def assert_changed(mutate):
+            etags = {url: self.client.get(url)['ETag'] for url in urls}
+            self.assertEqual(self.client.get(urls[0], HTTP_IF_NONE_MATCH=etags[urls[0]]).status_code, 304)
+            mutate()
+            for url in urls:
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code, 200, url)
+
+        artist = self.album.artist
+
+        def rename_artist():
+            artist.username = 'renamed'
+            artist.save()
+
+        assert_changed(rename_artist)
+        assert_changed(lambda: SongPlayback.objects.create(user=self.user, song=self.song))
+        self.assertEqual(self.client.get(urls[0]).data['artist_username'], 'renamed')
+
+        # Logging in saves last_login only, which nothing renders.
+        etag = self.client.get(urls[0])['ETag']
+        artist.last_login = timezone.now()
+        artist.save(update_fields=['last_login'])
+        self.assertEqual(self.client.get(urls[0], HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_saves_by_other_users_change_the_playlist_etag(self):
+        playlist = Playlist.objects.create(user=self.user, name='Mine', is_public=True)
+        url = f'/api/user-playlists/{playlist.id}/?include_songs=false'
+        fan = APIClient()
+        fan.force_authenticate(CustomUser.objects.create_user(email='fan@example.com', password='password123', username='fan'))
+
+        for action, savings in [('add', 1), ('remove', 0)]:
+            etag = self.client.get(url)['ETag']
+            fan.post('/api/modify/library/', {'action': action, 'id': playlist.id, 'object_type': 'playlist'}, format='json')
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['savings'], savings)
+
+    def test_library_etag_follows_library_items(self):
+        etag = self.client.get('/api/library/')['ETag']
+        self.assertEqual(self.client.get('/api/library/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.post('/api/modify/library/', {'action': 'add', 'id': self.album.id, 'object_type': 'album'}, format='json')
+        self.assertEqual(self.client.get('/api/library/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class LibraryMembershipTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        cls.artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        cls.album = Album.objects.create(title='Album', artist=cls.artist)
+        cls.songs = Song.objects.bulk_create([
+            Song(title=f'Song {idx}', album=cls.album, duration=timedelta(seconds=180), file=f'songs/{idx}.mp3', track_number=idx + 1)
+            for idx in range(3)
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def contains(self, **ids):
+        return self.client.post('/api/library/contains/', ids, format='json')
+
+    def test_membership_follows_mutations(self):
+        liked = Playlist.objects.get(user=self.user, name='Liked Songs')
+        song_ids = [song.id for song in self.songs]
+        self.assertEqual(self.contains(song=song_ids, album=[self.album.id], artist=[self.artist.id]).data, {
+            'song': [False, False, False], 'album': [False], 'artist': [False],
+        })
+
+        liked.add_songs(song_ids[1:])
+        self.client.post('/api/modify/library/', {'action': 'add', 'id': self.album.id, 'object_type': 'album'}, format='json')
+        self.client.post('/api/toggle-follow/', {'user_id': self.artist.id}, format='json')
+
+        self.assertEqual(self.contains(song=song_ids, album=[self.album.id], artist=[self.artist.id], playlist=[liked.id]).data, {
+            'song': [False, True, True], 'album': [True], 'artist': [True], 'playlist': [True],
+        })
+
+        liked.remove_songs(song_ids[1:2])
+        self.assertEqual(self.contains(song=song_ids).data, {'song': [False, False, True]})
+
+    def test_rejects_more_than_limit(self):
+        self.assertEqual(self.contains(song=list(range(1001))).status_code, 400)
+        self.assertEqual(self.contains(song=['x']).status_code, 400)
+
+
+class LibraryReadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        cls.artists = [
+            CustomUser.objects.create_user(email=f'artist{idx}@example.com', password='password123', username=f'artist{idx}', type='artist')
+            for idx in range(3)
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def fill_library(self, count):
+        for idx in range(count):
+            artist = self.artists[idx % len(self.artists)]
+            album = Album.objects.create(title=f'Album {idx}', artist=artist)
+            song = Song.objects.create(title=f'Song {idx}', album=album, duration=timedelta(seconds=180), file=f'songs/{idx}.mp3', track_number=1)
+            playlist = Playlist.objects.create(user=artist, name=f'Playlist {idx}', is_public=True)
+            playlist.add_songs([song.id])
+            for object_type, object_id in [('album', album.id), ('song', song.id), ('playlist', playlist.id)]:
+                self.client.post('/api/modify/library/', {'action': 'add', 'id': object_id, 'object_type': object_type}, format='json')
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/library/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data['items']
+
+    def test_query_budget_does_not_depend_on_library_size(self):
+        self.fill_library(2)
+        for artist in self.artists:
+            self.user.follow(artist)
+        small, items = self.count_queries()
+        self.assertEqual(len(items), 2 * 3 + 3 + 1)
+
+        self.fill_library(30)
+        large, items = self.count_queries()
+        self.assertEqual(len(items), 32 * 3 + 3 + 1)
+        self.assertEqual(small, large)
+
+        cards = {(item['content_type'], item['library_obj']['title']) for item in items}
+        self.assertIn(('playlist', 'Liked Songs'), cards)
+        self.assertIn(('customuser', 'artist0'), cards)
+        self.assertIn(('album', 'Album 29'), cards)
+
+
+class LibraryChangesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        cls.albums = [Album.objects.create(title=f'Album {idx}', artist=artist) for idx in range(3)]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def modify(self, action, album):
+        self.client.post('/api/modify/library/', {'action': action, 'id': album.id, 'object_type': 'album'}, format='json')
+
+    def test_changes_since_cursor(self):
+        cursor = self.client.get('/api/library/').data['cursor']
+        self.modify('add', self.albums[0])
+        self.modify('add', self.albums[1])
+        self.modify('pin', self.albums[1])
+        self.modify('remove', self.albums[0])
+
+        response = self.client.get('/api/library/changes/', {'since': cursor})
+        changes = {change['object_id']: change for change in response.data['changes']}
+        self.assertEqual(changes[self.albums[0].id]['action'], 'remove')
+        self.assertIsNone(changes[self.albums[0].id]['library_obj'])
+        self.assertEqual(changes[self.albums[1].id]['action'], 'pin')
+        self.assertTrue(changes[self.albums[1].id]['is_pinned'])
+
+        cursor = response.data['cursor']
+        self.assertEqual(self.client.get('/api/library/changes/', {'since': cursor}).data['changes'], [])
+        self.modify('add', self.albums[2])
+        self.assertEqual(
+            [change['object_id'] for change in self.client.get('/api/library/changes/', {'since': cursor}).data['changes']],
+            [self.albums[2].id],
+        )
+
+
+    def test_failed_library_delete_does_not_silence_removals(self):
+        def fail(sender, **kwargs):
+            raise RuntimeError('delete failed')
+
+        library = Library.objects.get(user=self.user)
+        self.modify('add', self.albums[0])
+        pre_delete.connect(fail, sender=Library)
+        try:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                library.delete()
+        finally:
+            pre_delete.disconnect(fail, sender=Library)
+
+        self.modify('remove', self.albums[0])
+        self.assertEqual(library.changes.filter(action='remove', object_id=self.albums[0].id).count(), 1)
+
+        # Deleting the library for real logs nothing against it.
+        library.delete()
+        self.assertFalse(LibraryChange.objects.filter(library_id=library.id).exists())
+
+class LibraryChangeOrderingTests(TransactionTestCase):
+    def test_interleaved_transactions_commit_in_cursor_order(self):
+        user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        albums = [Album.objects.create(title=f'Album {idx}', artist=artist) for idx in range(2)]
+        library = Library.objects.get(user=user)
+        album_type = ContentType.objects.get_for_model(Album)
+        client = APIClient()
+        client.force_authenticate(user)
+        cursor = client.get('/api/library/').data['cursor']
+
+        logged, release = threading.Event(), threading.Event()
+
+        def slow_add():
+            # Logs its change, then commits only after the other one tried to.
+            try:
+                with transaction.atomic():
+                    LibraryItem.objects.create(library=library, content_type=album_type, object_id=albums[0].id)
+                    logged.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        def fast_add():
+            try:
+                LibraryItem.objects.create(library=library, content_type=album_type, object_id=albums[1].id)
+            finally:
+                connection.close()
+
+        slow = threading.Thread(target=slow_add)
+        slow.start()
+        self.assertTrue(logged.wait(5))
+        fast = threading.Thread(target=fast_add)
+        fast.start()
+        fast.join(0.5)
+        # The later change waits for the earlier one instead of committing ahead of it.
+        self.assertTrue(fast.is_alive())
+        self.assertEqual(client.get('/api/library/changes/', {'since': cursor}).data['changes'], [])
+
+        release.set()
+        slow.join(5)
+        fast.join(5)
+        changes = client.get('/api/library/changes/', {'since': cursor}).data['changes']
+        self.assertEqual([change['object_id'] for change in changes], [albums[0].id, albums[1].id])
+        self.assertEqual([change['seq'] for change in changes], [cursor + 1, cursor + 2])
+
+
+class LibraryUpdateTests(TransactionTestCase):
+    # Updates are pulled from committed transactions only, so these run
+    # outside a test transaction.
+    def test_updates_are_recorded_once_and_pulled_by_each_library(self):
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=artist)
+        album_type = ContentType.objects.get_for_model(Album)
+        listeners = [
+            CustomUser.objects.create_user(email=f'listener{idx}@example.com', password='password123', username=f'listener{idx}')
+            for idx in range(5)
+        ]
+        for listener in listeners:
+            LibraryItem.objects.create(library=listener.library, content_type=album_type, object_id=album.id)
+        client = APIClient()
+        client.force_authenticate(listeners[0])
+        cursor = client.get('/api/library/').data['cursor']
+        etag = client.get('/api/library/')['ETag']
+        logged = LibraryChange.objects.count()
+
+        album.title = 'Renamed'
+        album.save()
+        # One row for the album, nothing per library.
+        self.assertEqual(ObjectChange.objects.filter(content_type=album_type, object_id=album.id).count(), 1)
+        self.assertEqual(LibraryChange.objects.count(), logged)
+
+        self.assertEqual(client.get('/api/library/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        changes = client.get('/api/library/changes/', {'since': cursor}).data['changes']
+        self.assertEqual([(change['action'], change['library_obj']['title']) for change in changes], [('update', 'Renamed')])
+        self.assertEqual(LibraryChange.objects.count(), logged + 1)
+        cursor = client.get('/api/library/changes/', {'since': cursor}).data['cursor']
+
+        # Renditions from the media worker are not card changes.
+        album.image_variants = {'64': 'albums/cover_64.webp'}
+        album.save(update_fields=['image_variants'])
+        self.assertEqual(client.get('/api/library/changes/', {'since': cursor}).data['changes'], [])
+
+
+class FollowTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        cls.artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+
+    def counts(self):
+        self.user.refresh_from_db()
+        self.artist.refresh_from_db()
+        return self.user.following_count, self.artist.followers_count
+
+    def test_toggle_updates_counts_and_library(self):
+        self.assertTrue(self.user.follow(self.artist))
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertTrue(self.user.library.items.filter(object_id=self.artist.id, content_type__model='customuser').exists())
+
+        self.assertFalse(self.user.follow(self.artist))
+        self.assertEqual(self.counts(), (0, 0))
+        self.assertFalse(self.user.library.items.filter(object_id=self.artist.id, content_type__model='customuser').exists())
+
+        with self.assertRaises(ValueError):
+            self.user.follow(self.user)
+
+    def test_backfill_command_fixes_drift(self):
+        self.user.followed_artists.add(self.artist)
+        self.assertEqual(self.counts(), (0, 0))
+
+        call_command('backfill_follow_counts', stdout=StringIO())
+        self.assertEqual(self.counts(), (1, 1))
+
+
+class PlaybackHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        cls.artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album_type = ContentType.objects.get_for_model(Album)
+        playlist_type = ContentType.objects.get_for_model(Playlist)
+        today = timezone.now().date()
+        for idx in range(30):
+            album = Album.objects.create(title=f'Album {idx}', artist=cls.artist)
+            for number in range(2):
+                song = Song.objects.create(title=f'Song {idx}.{number}', album=album, duration=timedelta(seconds=180), file=f'songs/{idx}_{number}.mp3', track_number=number + 1)
+                SongDailyPlays.objects.create(song=song, day=today, plays=idx + 1)
+            PlaybackHistory.record(cls.user, album_type, album.id)
+        for idx in range(20):
+            playlist = Playlist.objects.create(user=cls.user, name=f'Playlist {idx}')
+            PlaybackHistory.record(cls.user, playlist_type, playlist.id)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_recently_played_is_a_paginated_envelope_in_constant_queries(self):
+        # count, page, playlists, albums and their songs, however many entries.
+        ContentType.objects.get_for_models(Album, Playlist, CustomUser)
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/playback-history/?limit=50')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'count', 'next', 'previous', 'results'})
+        self.assertEqual(response.data['count'], 50)
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(len(response.data['results']), 50)
+
+        albums = {entry['content_object']['title']: entry['content_object'] for entry in response.data['results'] if entry['content_type'] == 'album'}
+        self.assertEqual(len(albums), 30)
+        self.assertEqual(albums['Album 4']['total_plays'], 10)
+
+        response = self.client.get('/api/playback-history/')
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNotNone(response.data['next'])
+
+
+class CatalogDeleteCleanupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.listeners = [
+            CustomUser.objects.create_user(email=f'listener{idx}@example.com', password='password123', username=f'listener{idx}')
+            for idx in range(3)
+        ]
+        cls.artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        cls.albums = [Album.objects.create(title=f'Album {idx}', artist=cls.artist) for idx in range(5)]
+        cls.songs = [
+            Song.objects.create(title=f'Song {idx}', album=album, duration=timedelta(seconds=180), file=f'songs/{idx}.mp3', track_number=idx + 1)
+            for album in cls.albums for idx in range(4)
+        ]
+
+    def save_everything(self):
+        album_type = ContentType.objects.get_for_model(Album)
+        song_type = ContentType.objects.get_for_model(Song)
+        for listener in self.listeners:
+            LibraryItem.objects.bulk_create(
+                [LibraryItem(library=listener.library, content_type=album_type, object_id=album.id) for album in self.albums]
+                + [LibraryItem(library=listener.library, content_type=song_type, object_id=song.id) for song in self.songs]
+            )
+            listener.follow(self.artist)
+            PlaybackHistory.record(listener, album_type, self.albums[0].id)
+
+    def saved_catalog(self):
+        return LibraryItem.objects.filter(content_type__model__in=['album', 'song', 'customuser']).count()
+
+    def test_artist_delete_cleans_up_every_library_in_bulk(self):
+        self.save_everything()
+        self.assertEqual(self.saved_catalog(), 3 * (5 + 20 + 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.artist.delete()
+
+        self.assertEqual(self.saved_catalog(), 0)
+        self.assertFalse(PlaybackHistory.objects.exists())
+        self.assertEqual(LibraryChange.objects.filter(action='remove').count(), 3 * (5 + 20 + 1))
+
+    def test_sweeper_removes_orphans(self):
+        self.save_everything()
+        # Bypasses the delete signals.
+        Song.objects.filter(album=self.albums[0])._raw_delete(Song.objects.db)
+        Album.objects.filter(id=self.albums[0].id)._raw_delete(Album.objects.db)
+
+        call_command('sweep_orphaned_library_items', batch_size=2, stdout=StringIO())
+        self.assertEqual(self.saved_catalog(), 3 * (4 + 16 + 1))
+        self.assertFalse(PlaybackHistory.objects.exists())
+
+
+class ProvisionUsersTests(TestCase):
+    def state(self, user):
+        library = user.library
+        return {
+            'playback': CurrentPlayback.objects.filter(user=user).count(),
+            'playlists': list(user.playlists.values_list('name', 'songs_count', 'version')),
+            'library_version': library.version,
+            'items': list(library.items.values_list('content_type__model', 'object_id')),
+            'changes': list(library.changes.values_list('action', 'object_id')),
+        }
+
+    def test_bulk_path_matches_signal_path(self):
+        reference = CustomUser.objects.create_user(email='signal@example.com', password='password123', username='signal')
+        hashed = make_password('password123')
+
+        created, skipped, errors = provision_users([
+            {'email': 'bulk0@example.com', 'username': 'bulk0', 'password': hashed},
+            {'email': 'bulk1@example.com', 'password': '', 'type': 'artist'},
+            {'email': 'signal@example.com', 'password': hashed},
+            {'email': 'bad@example.com', 'password': 'plaintext'},
+        ], chunk_size=2)
+        self.assertEqual((created, skipped, [line for line, _ in errors]), (2, 1, [4]))
+
+        bulk = CustomUser.objects.get(email='bulk0@example.com')
+        expected = self.state(CustomUser.objects.get(id=reference.id))
+        actual = self.state(bulk)
+        for key in ['playback', 'playlists', 'library_version']:
+            self.assertEqual(actual[key], expected[key])
+        self.assertEqual([model for model, _ in actual['items']], [model for model, _ in expected['items']])
+        self.assertEqual([action for action, _ in actual['changes']], [action for action, _ in expected['changes']])
+        self.assertTrue(bulk.check_password('password123'))
+        self.assertFalse(CustomUser.objects.get(email='bulk1@example.com').has_usable_password())
+
+
+class ResumableUploadTests(SimpleTestCase):
+    def tus_server(self, fail_every=None):
+        state = {'offset': 0, 'patches': 0, 'largest_chunk': 0}
+
+        def handler(request):
+            if request.method == 'POST':
+                state['length'] = int(request.headers['Upload-Length'])
+                return httpx.Response(201, headers={'Location': 'https://storage.test/upload/1'})
+            if request.method == 'HEAD':
+                return httpx.Response(200, headers={'Upload-Offset': str(state['offset'])})
+
+            state['patches'] += 1
+            self.assertEqual(int(request.headers['Upload-Offset']), state['offset'])
+            if fail_every and state['patches'] % fail_every == 0:
+                return httpx.Response(502)
+            received = sum(len(block) for block in request.stream)
+            self.assertEqual(received, int(request.headers['Content-Length']))
+            state['largest_chunk'] = max(state['largest_chunk'], received)
+            state['offset'] += received
+            return httpx.Response(204, headers={'Upload-Offset': str(state['offset'])})
+
+        # Unlike httpx.MockTransport this does not buffer request bodies.
+        class StreamingTransport(httpx.BaseTransport):
+            def handle_request(self, request):
+                return handler(request)
+
+        return state, httpx.Client(transport=StreamingTransport())
+
+    def test_500mb_upload_keeps_memory_bounded(self):
+        size = 500 * 1024 * 1024
+        state, client = self.tus_server()
+        with tempfile.NamedTemporaryFile() as file:
+            file.truncate(size)
+            # ru_maxrss is the peak RSS in KiB; reading the whole file would add ~500MB.
+            peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            SupabaseStorage('https://storage.test', 'key').stream_put('audio', 'big.flac', file.name, client=client)
+            peak_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before) * 1024
+
+        self.assertEqual(state['offset'], size)
+        self.assertEqual(state['largest_chunk'], TUS_CHUNK_SIZE)
+        self.assertLess(peak_growth, 2 * TUS_CHUNK_SIZE)
+
+    def test_resumes_from_server_offset_after_failures(self):
+        state, client = self.tus_server(fail_every=3)
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(b'x' * (5 * 1024 + 7))
+            file.flush()
+            SupabaseStorage('https://storage.test', 'key').stream_put('images', 'cover.png', file.name, chunk_size=1024, client=client)
+
+        self.assertEqual(state['offset'], state['length'])
+
+
+class AsyncStorageTests(SimpleTestCase):
+    def storage(self, handler, concurrency=4):
+        return AsyncSupabaseStorage('https://storage.test', 'key', concurrency, backoff=0, transport=httpx.MockTransport(handler))
+
+    def test_upload_many_bounds_concurrency_and_retries(self):
+        state = {'in_flight': 0, 'peak': 0, 'attempts': 0, 'offsets': {}}
+
+        async def handler(request):
+            if request.method == 'POST':
+                state['attempts'] += 1
+                if state['attempts'] % 3 == 1:
+                    return httpx.Response(503)
+                name = base64.b64decode(dict(pair.split(' ') for pair in request.headers['Upload-Metadata'].split(','))['objectName']).decode()
+                return httpx.Response(201, headers={'Location': f'https://storage.test/upload/{name}'})
+            state['in_flight'] += 1
+            state['peak'] = max(state['peak'], state['in_flight'])
+            await asyncio.sleep(0.01)
+            state['in_flight'] -= 1
+            name = request.url.path.split('/upload/')[1]
+            state['offsets'][name] = int(request.headers['Upload-Offset']) + len(request.content)
+            return httpx.Response(204, headers={'Upload-Offset': str(state['offsets'][name])})
+
+        async def upload():
+            storage = self.storage(handler)
+            try:
+                return await storage.upload_many('audio', [(f'track_{idx}.mp3', b'x' * (100 + idx)) for idx in range(12)])
+            finally:
+                await storage.aclose()
+
+        self.assertEqual(asyncio.run(upload()), [f'audio/track_{idx}.mp3' for idx in range(12)])
+        self.assertEqual(state['offsets'], {f'track_{idx}.mp3': 100 + idx for idx in range(12)})
+        self.assertEqual(state['peak'], 4)
+
+    def test_slow_file_reads_do_not_block_the_loop(self):
+        class SlowFile(io.BytesIO):
+            def read(self, size=-1):
+                time.sleep(0.2)
+                return super().read(size)
+
+        def handler(request):
+            if request.method == 'POST':
+                return httpx.Response(201, headers={'Location': 'https://storage.test/upload/slow.mp3'})
+            return httpx.Response(204, headers={'Upload-Offset': str(int(request.headers['Upload-Offset']) + len(request.content))})
+
+        async def run():
+            storage = self.storage(handler)
+            upload = asyncio.ensure_future(storage.put('audio', 'slow.mp3', SlowFile(b'x' * (3 * READ_BLOCK_SIZE))))
+            # The longest the loop went without running this ticker.
+            longest, last = 0, time.monotonic()
+            while not upload.done():
+                await asyncio.sleep(0.01)
+                now = time.monotonic()
+                longest, last = max(longest, now - last), now
+            await storage.aclose()
+            return upload.result(), longest
+
+        name, longest = asyncio.run(run())
+        self.assertEqual(name, 'audio/slow.mp3')
+        self.assertLess(longest, 0.1)
+
+    def test_url_many_and_delete_many_batch_names(self):
+        requests = []
+
+        def handler(request):
+            requests.append((request.method, request.url.path, json.loads(request.content)))
+            if request.method == 'POST':
+                return httpx.Response(200, json=[
+                    {'path': path, 'error': None, 'signedURL': f'/object/sign/audio/{path}?token=t'}
+                    for path in json.loads(request.content)['paths']
+                ])
+            return httpx.Response(200, json=[])
+
+        async def run():
+            storage = self.storage(handler)
+            try:
+                urls = await storage.url_many('audio', ['a.mp3', 'b.mp3'], signed=True, expires_in=60)
+                await storage.delete_many('audio', [f'{idx}.mp3' for idx in range(1500)])
+                return urls
+            finally:
+                await storage.aclose()
+
+        self.assertEqual(asyncio.run(run()), [
+            'https://storage.test/storage/v1/object/sign/audio/a.mp3?token=t',
+            'https://storage.test/storage/v1/object/sign/audio/b.mp3?token=t',
+        ])
+        self.assertEqual(requests[0], ('POST', '/storage/v1/object/sign/audio', {'expiresIn': 60, 'paths': ['a.mp3', 'b.mp3']}))
+        deletes = [body['prefixes'] for method, path, body in requests if method == 'DELETE']
+        self.assertEqual(sorted(len(names) for names in deletes), [500, 1000])
+
+
+class LocalStorageTests(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings = override_settings(STORAGE_BACKEND='local', STORAGE_LOCAL_ROOT=root.name, STORAGE_LOCAL_URL='http://testserver/api/storage/')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.storage = get_storage()
+        self.client = APIClient()
+
+    def get(self, url):
+        return self.client.get(url.removeprefix('http://testserver'))
+
+    def test_put_serve_and_delete(self):
+        self.storage.put('images', 'covers/a b.png', b'png-bytes')
+        self.assertTrue(self.storage.exists('images', 'covers/a b.png'))
+        with self.assertRaises(FileExistsError):
+            self.storage.put('images', 'covers/a b.png', b'other')
+
+        response = self.get(self.storage.public_url('images', 'covers/a b.png'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'png-bytes')
+
+        self.storage.delete('images', ['covers/a b.png'])
+        self.assertFalse(self.storage.exists('images', 'covers/a b.png'))
+        self.assertEqual(self.get(self.storage.public_url('images', 'covers/a b.png')).status_code, 404)
+
+    def test_stream_put_from_path(self):
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(b'x' * (3 * 256 * 1024 + 5))
+            file.flush()
+            self.storage.stream_put('audio', 'song.flac', file.name)
+        with self.storage.open('audio', 'song.flac') as stored:
+            self.assertEqual(len(stored.read()), 3 * 256 * 1024 + 5)
+
+    def test_private_buckets_need_a_valid_signature(self):
+        self.storage.put('private', 'stems.zip', b'zip')
+        self.assertEqual(self.get(self.storage.public_url('private', 'stems.zip')).status_code, 404)
+        self.assertEqual(self.get(self.storage.signed_url('private', 'stems.zip')).status_code, 200)
+        self.assertEqual(self.get(self.storage.signed_url('private', 'stems.zip', expires_in=-1)).status_code, 404)
+
+
+class SongStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=artist)
+        cls.song = Song.objects.create(title='Song', album=album, duration=timedelta(seconds=180), file='songs/song.mp3', track_number=1)
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings = override_settings(STORAGE_BACKEND='local', STORAGE_LOCAL_ROOT=root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.audio = bytes(range(256)) * 4096
+        get_storage().put('audio', self.song.audio_name, self.audio)
+        self.url = f'/api/songs/{self.song.id}/stream/'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_single_range(self):
+        response, body = self.get(Range='bytes=1000-1999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 1000-1999/{len(self.audio)}')
+        self.assertEqual(body, self.audio[1000:2000])
+
+        response, body = self.get(Range='bytes=-10')
+        self.assertEqual(body, self.audio[-10:])
+
+    def test_multiple_ranges(self):
+        response, body = self.get(Range='bytes=0-9, 500-509')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b'Content-Range: bytes 500-509/', body)
+        self.assertIn(self.audio[500:510], body)
+
+    def test_unsatisfiable_and_conditional_requests(self):
+        response, _ = self.get(Range=f'bytes={len(self.audio)}-')
+        self.assertEqual(response.status_code, 416)
+
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.audio)
+        etag = response['ETag']
+
+        self.assertEqual(self.get(**{'If-None-Match': etag})[0].status_code, 304)
+        self.assertEqual(self.get(Range='bytes=0-9', **{'If-Range': etag})[0].status_code, 206)
+        # A stale If-Range validator gets the whole, current file.
+        self.assertEqual(self.get(Range='bytes=0-9', **{'If-Range': '"stale"'})[0].status_code, 200)
+
+
+FAKE_FFMPEG = f'''#!{sys.executable}
+import sys
+args = sys.argv[1:]
+segments = args[args.index('-hls_segment_filename') + 1]
+for idx in range(3):
+    open(segments % idx, 'wb').write(b'segment')
+open(args[-1], 'w').write('#EXTM3U\\n')
+'''
+
+
+class MediaJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=artist)
+        cls.song = Song.objects.create(title='Song', album=album, duration=timedelta(seconds=180), file='songs/song.mp3', track_number=1)
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        ffmpeg = os.path.join(root.name, 'ffmpeg')
+        with open(ffmpeg, 'w') as file:
+            file.write(FAKE_FFMPEG)
+        os.chmod(ffmpeg, 0o755)
+
+        settings = override_settings(
+            STORAGE_BACKEND='local', STORAGE_LOCAL_ROOT=os.path.join(root.name, 'storage'), FFMPEG_BINARY=ffmpeg, HLS_BITRATES=[96, 192],
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.root = root.name
+        get_storage().put('audio', self.song.audio_name, b'mp3')
+
+    def test_claim_and_retry(self):
+        job = MediaJob.enqueue('hls', self.song)
+        self.assertEqual(MediaJob.enqueue('hls', self.song), job)
+
+        claimed, = MediaJob.claim(limit=5)
+        self.assertEqual((claimed.id, claimed.status, claimed.attempts), (job.id, 'running', 1))
+        self.assertEqual(MediaJob.claim(limit=5), [])
+
+        self.assertTrue(claimed.fail('boom'))
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, 'pending')
+        self.assertGreater(claimed.run_after, claimed.updated_at)
+
+        MediaJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        claimed, = MediaJob.claim()
+        claimed.attempts = MediaJob.MAX_ATTEMPTS
+        self.assertTrue(claimed.fail('boom'))
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, 'failed')
+
+    def test_expired_lease_cannot_overwrite_the_new_owner(self):
+        MediaJob.enqueue('hls', self.song)
+        first, = MediaJob.claim()
+        self.assertTrue(first.renew())
+
+        # The lease runs out and a second worker takes the job over.
+        MediaJob.objects.filter(pk=first.pk).update(run_after=timezone.now())
+        second, = MediaJob.claim()
+        self.assertFalse(first.renew())
+        self.assertFalse(first.fail('boom'))
+        self.assertEqual(run_job(first), 'lost')
+
+        self.assertEqual(run_job(second), 'done')
+        self.assertFalse(first.finish())
+        second.refresh_from_db()
+        self.assertEqual((second.status, second.attempts), ('done', 2))
+
+    def test_worker_packages_hls(self):
+        MediaJob.enqueue('hls', self.song)
+        call_command('run_media_worker', '--once', stdout=StringIO(), stderr=StringIO())
+
+        self.song.refresh_from_db()
+        self.assertEqual(self.song.hls_manifest, f'hls/{self.song.id}/master.m3u8')
+        self.assertEqual(MediaJob.objects.get().status, 'done')
+        storage = get_storage()
+        for name in ['master.m3u8', '96k/index.m3u8', '192k/segment_00002.ts']:
+            self.assertTrue(storage.exists('audio', f'hls/{self.song.id}/{name}'), name)
+        with storage.open('audio', self.song.hls_manifest) as file:
+            self.assertIn(b'192k/index.m3u8', file.read())
+
+        response = self.client.get(f'/api/songs/{self.song.id}/')
+        self.assertTrue(response.json()['hls'].endswith(f'/audio/hls/{self.song.id}/master.m3u8'))
+
+    def test_replacing_the_file_drops_the_old_packaging(self):
+        MediaJob.enqueue('hls', self.song)
+        call_command('run_media_worker', '--once', stdout=StringIO(), stderr=StringIO())
+        self.assertTrue(APIClient().get(f'/api/songs/{self.song.id}/').json()['hls'])
+
+        frames = b'\xff\xfb\x90\x64' + b'\x00' * 413
+        with override_settings(MEDIA_ROOT=os.path.join(self.root, 'media')):
+            response = APIClient().patch(f'/api/songs/{self.song.id}/', {'file': ContentFile(frames * 40, name='new.mp3')}, format='multipart')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIsNone(response.json()['hls'])
+        self.assertTrue(response.json()['waveform'].endswith('?v=1'))
+        self.assertTrue(MediaJob.objects.filter(kind='hls', status='pending').exists())
+
+    def test_failed_ffmpeg_is_retried(self):
+        MediaJob.enqueue('hls', self.song)
+        with override_settings(FFMPEG_BINARY=os.path.join(tempfile.gettempdir(), 'missing-ffmpeg')):
+            call_command('run_media_worker', '--once', stdout=StringIO(), stderr=StringIO())
+
+        job = MediaJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertIn('FileNotFoundError', job.last_error)
+
+
+FAKE_DECODER = f'''#!{sys.executable}
+import struct, sys
+samples = [(idx % 512) * 64 - 16384 for idx in range(2 * 11025)]
+sys.stdout.buffer.write(struct.pack('<%dh' % len(samples), *samples))
+sys.stderr.write('Integrated loudness:\\n    I:         -14.2 LUFS\\n')
+'''
+
+
+class WaveformTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        album = Album.objects.create(title='Album', artist=cls.user)
+        cls.song = Song.objects.create(title='Song', album=album, duration=timedelta(seconds=180), file='songs/song.mp3', track_number=1)
+
+    def test_analyze_audio(self):
+        with tempfile.TemporaryDirectory() as root:
+            decoder = os.path.join(root, 'ffmpeg')
+            with open(decoder, 'w') as file:
+                file.write(FAKE_DECODER)
+            os.chmod(decoder, 0o755)
+            with override_settings(FFMPEG_BINARY=decoder):
+                result = analyze_audio('song.mp3')
+
+        self.assertEqual(result['duration'], timedelta(seconds=2))
+        self.assertEqual(result['loudness'], -14.2)
+        # 22050 samples: 86 full blocks of 256 and a short tail.
+        self.assertEqual(result['points'], 87)
+        self.assertEqual(len(result['peaks']), 2 * 87)
+        # Block 0 ramps from -16384 to -64, block 1 from 0 to 16320.
+        self.assertEqual(list(memoryview(result['peaks']).cast('b')[:4]), [-64, -1, 0, 63])
+
+    def test_save_analysis_moves_playlist_durations(self):
+        playlist = Playlist.objects.create(user=self.user, name='Mix')
+        playlist.add_songs([self.song.id, self.song.id])
+
+        save_analysis(self.song, {'peaks': b'\x00\x01' * 4, 'points': 4, 'loudness': -9.5, 'duration': timedelta(seconds=181.5)})
+
+        playlist.refresh_from_db()
+        self.assertEqual(playlist.total_duration, timedelta(seconds=363))
+        self.assertEqual(Song.objects.get(pk=self.song.pk).duration, timedelta(seconds=181.5))
+
+        url = self.client.get(f'/api/songs/{self.song.id}/').json()['waveform']
+        self.assertTrue(url.endswith(f'/api/songs/{self.song.id}/waveform/?v=1'))
+        response = self.client.get(url)
+        self.assertEqual(response.json(), {'points': 4, 'peaks': 'AAEAAQABAAE=', 'loudness': -9.5, 'duration': 181.5})
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': response['ETag']}).status_code, 304)
+
+        # A new analysis moves the URL; the old one is only revalidated.
+        save_analysis(self.song, {'peaks': b'\x00\x02' * 4, 'points': 4, 'loudness': -9.0, 'duration': timedelta(seconds=181.5)})
+        self.assertTrue(self.client.get(f'/api/songs/{self.song.id}/').json()['waveform'].endswith('?v=2'))
+        response = self.client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings = override_settings(
+            MEDIA_ROOT=root.name, STORAGE_BACKEND='local', STORAGE_LOCAL_ROOT=os.path.join(root.name, 'storage'),
+            STORAGE_LOCAL_URL='http://testserver/api/storage/',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        os.makedirs(os.path.join(root.name, 'albums'))
+        Image.new('RGB', (300, 200), (200, 30, 30)).save(os.path.join(root.name, 'albums', 'cover.png'))
+        artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+        self.album = Album.objects.create(title='Cover Story', artist=artist, image='albums/cover.png')
+
+    def test_worker_builds_webp_variants(self):
+        MediaJob.enqueue('images', self.album)
+        call_command('run_media_worker', '--once', stdout=StringIO(), stderr=StringIO())
+
+        self.album.refresh_from_db()
+        # 320 and 640 would upscale the 300px source.
+        self.assertEqual(self.album.image_variants, {
+            '64': f'albums/cover-story_{self.album.id}_64.webp', '160': f'albums/cover-story_{self.album.id}_160.webp',
+        })
+        with get_storage().open('images', self.album.image_variants['160']) as file, Image.open(file) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (160, 107)))
+
+        response = self.client.get(f'/api/albums/{self.album.id}/')
+        self.assertEqual(response.json()['image_srcset'], {
+            size: f'http://testserver/api/storage/images/{name}' for size, name in self.album.image_variants.items()
+        })
+
+    def test_playlist_collage_rebuild_queues_variants(self):
+        song = Song.objects.create(title='Song', album=self.album, duration=timedelta(seconds=180), file='songs/song.mp3', track_number=1)
+        user = CustomUser.objects.create_user(email='listener@example.com', password='password123', username='listener')
+        playlist = Playlist.objects.create(user=user, name='Mix')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.post('/api/modify/playlist/', {'playlist_id': playlist.id, 'song_ids': [song.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        job = MediaJob.objects.get(kind='images')
+        self.assertEqual((job.object_id, job.status), (playlist.id, 'pending'))
+
+        call_command('run_media_worker', '--once', stdout=StringIO(), stderr=StringIO())
+        playlist.refresh_from_db()
+        self.assertIsNotNone(playlist.image_blob_id)
+        self.assertEqual(sorted(playlist.image_variants, key=int), ['64', '160', '320', '640'])
+        self.assertTrue(all(get_storage().exists('images', name) for name in playlist.image_variants.values()))
+
+
+class MediaBlobTests(TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        settings = override_settings(
+            STORAGE_BACKEND='local', STORAGE_LOCAL_ROOT=root.name, FFMPEG_BINARY=os.path.join(root.name, 'missing-ffmpeg'),
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.root = root.name
+        self.artist = CustomUser.objects.create_user(email='artist@example.com', password='password123', username='artist', type='artist')
+
+    def stored_files(self):
+        return sorted(os.path.relpath(os.path.join(path, name), self.root) for path, _, names in os.walk(self.root) for name in names)
+
+    def test_duplicate_uploads_share_one_blob(self):
+        albums = [Album.objects.create(title=f'Album {idx}', artist=self.artist, image='albums/cover.png') for idx in range(3)]
+        for album in albums[:2]:
+            attach_blob(album, 'image_blob', upload_image(ContentFile(b'same cover'), 'cover.png'))
+        attach_blob(albums[2], 'image_blob', upload_image(ContentFile(b'other cover'), 'cover.png'))
+
+        shared = MediaBlob.objects.get(pk=albums[0].image_blob_id)
+        self.assertEqual(albums[1].image_name, shared.key)
+        self.assertEqual(shared.ref_count, 2)
+        self.assertEqual(len(self.stored_files()), 2)
+
+        # Replacing one image and deleting the other album releases the blob.
+        attach_blob(albums[0], 'image_blob', upload_image(ContentFile(b'other cover'), 'cover.png'))
+        with self.captureOnCommitCallbacks(execute=True):
+            albums[1].delete()
+        shared.refresh_from_db()
+        self.assertEqual(shared.ref_count, 0)
+        self.assertEqual(MediaBlob.objects.get(pk=albums[2].image_blob_id).ref_count, 2)
+
+        shared.add_derived([shared.key.replace('.png', '_64.webp')])
+        get_storage().put('images', shared.key.replace('.png', '_64.webp'), b'webp')
+        self.assertEqual(collect_garbage(grace=timedelta(days=1)), [])
+        self.assertEqual([blob.key for blob in collect_garbage(grace=timedelta(0))], [shared.key])
+        self.assertEqual(self.stored_files(), [f'images/{albums[2].image_blob_id}'])
+
+    def test_deleting_a_cascade_releases_its_blobs_in_one_update(self):
+        albums = [Album.objects.create(title=f'Album {idx}', artist=self.artist, image='albums/cover.png') for idx in range(3)]
+        for idx, album in enumerate(albums):
+            attach_blob(album, 'image_blob', upload_image(ContentFile(b'same cover' if idx else b'other cover'), 'cover.png'))
+        attach_blob(self.artist, 'image_blob', upload_image(ContentFile(b'other cover'), 'cover.png'))
+        shared, other = albums[1].image_blob_id, albums[0].image_blob_id
+
+        # A rolled-back delete keeps its references.
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                albums[1].delete()
+                transaction.set_rollback(True)
+        self.assertEqual(MediaBlob.objects.get(pk=shared).ref_count, 2)
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.artist.delete()
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith(f'UPDATE "{MediaBlob._meta.db_table}"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(dict(MediaBlob.objects.values_list('key', 'ref_count')), {shared: 0, other: 0})
+
+    def test_replacing_a_file_drops_references_to_the_old_derived_objects(self):
+        def cover(color):
+            buffer = io.BytesIO()
+            Image.new('RGB', (200, 200), color).save(buffer, 'PNG')
+            return buffer.getvalue()
+
+        album = Album.objects.create(title='Album', artist=self.artist, image='albums/cover.png')
+        song = Song.objects.create(title='Song', album=album, duration=timedelta(seconds=180), file='songs/song.mp3', track_number=1)
+        attach_blob(album, 'image_blob', upload_image(ContentFile(cover('red')), 'cover.png'))
+        store_variants(album, render_variants(io.BytesIO(cover('red'))))
+        attach_blob(song, 'audio_blob', upload_audio(ContentFile(b'first master'), 'song.mp3'))
+        # What package_hls leaves behind.
+        manifest = f'hls/{song.audio_blob.sha256}/master.m3u8'
+        get_storage().put('audio', manifest, b'#EXTM3U')
+        song.audio_blob.add_derived([manifest])
+        song.hls_manifest = manifest
+        song.save(update_fields=['hls_manifest'])
+
+        def rendered():
+            album.refresh_from_db()
+            song.refresh_from_db()
+            return [('images', name) for name in album.image_variants.values()] + ([('audio', song.hls_manifest)] if song.hls_manifest else [])
+
+        self.assertEqual(len(rendered()), 3)
+        attach_blob(album, 'image_blob', upload_image(ContentFile(cover('blue')), 'cover.png'))
+        attach_blob(song, 'audio_blob', upload_audio(ContentFile(b'second master'), 'song.mp3'))
+        self.assertEqual(len(collect_garbage(grace=timedelta(0))), 2)
+
+        self.assertEqual(rendered(), [])
+        store_variants(album, render_variants(io.BytesIO(cover('blue'))))
+        collect_garbage(grace=timedelta(0))
+        self.assertEqual(len(rendered()), 2)
+        self.assertTrue(all(get_storage().exists(bucket, name) for bucket, name in rendered()))
+
+    def test_songs_with_the_same_audio_are_analysed_once(self):
+        album = Album.objects.create(title='Album', artist=self.artist)
+        songs = [
+            Song.objects.create(title=f'Song {idx}', album=album, duration=timedelta(seconds=180), file='songs/song.mp3', track_number=idx + 1)
+            for idx in range(2)
+        ]
+        for song in songs:
+            attach_blob(song, 'audio_blob', upload_audio(ContentFile(b'master'), 'song.mp3'))
+        self.assertEqual(songs[0].audio_name, songs[1].audio_name)
+        save_analysis(songs[0], {'peaks': b'\x00\x01', 'points': 1, 'loudness': -8.0, 'duration': timedelta(seconds=179.5)})
+
+        # ffmpeg is missing, so only reusing the first analysis can succeed.
+        MediaJob.enqueue('waveform', songs[1])
+        call_command('run_media_worker', '--once', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(MediaJob.objects.get().status, 'done')
+        self.assertEqual(SongAnalysis.objects.get(song=songs[1]).loudness, -8.0)
+        self.assertEqual(Song.objects.get(pk=songs[1].pk).duration, timedelta(seconds=179.5))
+
+    def test_album_tracks_upload_in_one_request(self):
+        album = Album.objects.create(title='Album', artist=self.artist)
+        Song.objects.create(title='Intro', album=album, duration=timedelta(seconds=60), file='songs/intro.mp3', track_number=1)
+        frames = b'\xff\xfb\x90\x64' + b'\x00' * 413
+        files = [
+            ContentFile(frames * 40, name='First.mp3'),
+            ContentFile(frames * 80, name='Second.mp3'),
+            ContentFile(frames * 40, name='First (remaster).mp3'),
+        ]
+
+        url = f'/api/albums/{album.id}/tracks/'
+        client = APIClient()
+        self.assertEqual(client.post(url, {'files': files[:1]}, format='multipart').status_code, 401)
+        client.force_authenticate(CustomUser.objects.create_user(email='other@example.com', password='password123', username='other', type='artist'))
+        self.assertEqual(client.post(url, {'files': files[:1]}, format='multipart').status_code, 403)
+        self.assertFalse(MediaBlob.objects.exists())
+
+        client.force_authenticate(self.artist)
+        for file in files:
+            file.seek(0)
+        with override_settings(MEDIA_ROOT=os.path.join(self.root, 'media')):
+            response = client.post(url, {'files': files, 'genre': 'rock'}, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual([(song['title'], song['track_number']) for song in response.json()], [
+            ('First', 2), ('Second', 3), ('First (remaster)', 4),
+        ])
+
+        songs = list(album.songs.filter(track_number__gt=1).order_by('track_number'))
+        self.assertEqual(songs[0].audio_blob_id, songs[2].audio_blob_id)
+        self.assertEqual(MediaBlob.objects.get(pk=songs[0].audio_blob_id).ref_count, 2)
+        self.assertEqual(len([name for name in self.stored_files() if name.startswith('audio/')]), 2)
+        self.assertEqual(MediaJob.objects.filter(kind='hls').count(), 3)
+
+        response = client.post(url, {'files': [ContentFile(b'not audio', name='x.mp3')]}, format='multipart')
+        self.assertEqual(response.status_code, 400)
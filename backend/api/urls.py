@@ -16,9 +16,15 @@ urlpatterns = [
     path('user-history/', views.UserPlaybackHistoryAPIView.as_view(), name='user-history'),
     path('top-songs/', views.TopSongsAPIView.as_view(), name='top-songs'),
     path('top-songs/<str:genre>/', views.TopSongsAPIView.as_view(), name='top-songs'),
+    path('songs/<int:song_id>/stream/', views.stream_song, name='song-stream'),
+    path('songs/<int:song_id>/waveform/', views.song_waveform, name='song-waveform'),
+    path('playlists/<int:playlist_id>/tracks/', views.PlaylistTracksAPIView.as_view(), name='playlist-tracks'),
     path('modify/playlist/', views.ModifyPlaylistAPIView.as_view(), name='modify-playlist'),
     path('library/', views.LibraryAPIView.as_view(), name='library'),
+    path('library/changes/', views.LibraryChangesAPIView.as_view(), name='library-changes'),
+    path('library/contains/', views.LibraryMembershipAPIView.as_view(), name='library-contains'),
     path('modify/library/', views.ModifyLibraryAPIView.as_view(), name='modify-library'),
     path('toggle-follow/', views.ToggleFollowAPIView.as_view(), name='toggle-follow'),
+    path('storage/<str:bucket>/<path:name>', views.local_storage_object, name='local-storage-object'),
     path('test/', views.testIMG, name='test-img'),
 ]
@@ -2,11 +2,13 @@ from PIL import Image
 from collections import Counter
 from datetime import timedelta
 from django.utils import timezone
-from django.db.models import Count
-from .models import SongPlayback, Song
+from django.db.models import F, Sum, Window
+from django.db.models.functions import RowNumber
+from .models import Song
 from django.conf import settings
 import os
-from .supabase_client import supabase
+from .blobs import store_blob
+from .storage import get_storage
 
 def rgb_to_hex(rgb):
     return '#{:02x}{:02x}{:02x}'.format(*rgb)
@@ -30,37 +32,27 @@ def get_dominant_color(image_path, color_format='RGB'):
 
     return rgb_to_hex(most_common)
 
-def get_top_songs_last_month(limit=10, genre=None):
-    genre_dict = {v: k for k, v in Song._meta.get_field('genre').choices}
-
-    last_month = timezone.now() - timedelta(days=30)
-    
+def get_top_songs_by_genre(limit=10, days=30, genre=None):
+    # The top `limit` songs of each genre by plays in the last `days`, as
+    # Song rows with their album and artist, ranked in one query; each
+    # carries `play_count` and `rank`.
+    since = timezone.localdate() - timedelta(days=days)
 
+    songs = Song.objects.filter(daily_plays__day__gte=since)
     if genre:
-        songs = SongPlayback.objects.filter(
-            played_at__gte=last_month,
-            song__genre=genre_dict[genre]
-        ).values(
-            'song__id', 'song__title', 'song__genre'
-        ).annotate(
-            play_count=Count('id')
-        ).order_by('song__genre', '-play_count')[:limit]
-    else:
-        songs = SongPlayback.objects.filter(
-            played_at__gte=last_month
-        ).values(
-            'song__id', 'song__title', 'song__genre'
-        ).annotate(
-            play_count=Count('id')
-        ).order_by('song__genre', '-play_count')[:limit]
-
-    genre_dict = dict(Song._meta.get_field('genre').choices)
-    results = []
-    for item in songs:
-        item['genre_label'] = genre_dict.get(item['song__genre'], item['song__genre'])
-        results.append(item)
-
-    return results
+        songs = songs.filter(genre=genre)
+
+    return songs.annotate(
+        play_count=Sum('daily_plays__plays')
+    ).annotate(
+        rank=Window(
+            RowNumber(),
+            partition_by=F('genre'),
+            order_by=[F('play_count').desc(), F('id').asc()],
+        )
+    ).filter(
+        rank__lte=limit
+    ).select_related('album__artist').prefetch_related('featured_artists').order_by('genre', 'rank')
 
 
 def create_collage(images, output_path, size=(800, 800)):
@@ -94,21 +86,16 @@ def create_collage(images, output_path, size=(800, 800)):
 
 
 def upload_image(file, filename):
-    file_data = file.read()
-    response = supabase.storage.from_('images').upload(filename, file_data)
-    return response
+    # Returns the MediaBlob holding the bytes; see api.blobs.attach_blob.
+    return store_blob('images', file, filename)
 
 def get_image_url(filename):
-    public_url = supabase.storage.from_('images').get_public_url(filename)
-    return public_url
+    return get_storage().public_url('images', filename)
 
 
 
 def upload_audio(file, filename):
-    file_data = file.read()
-    response = supabase.storage.from_('audio').upload(filename, file_data)
-    return response
+    return store_blob('audio', file, filename)
 
 def get_audio_url(filename):
-    public_url = supabase.storage.from_('audio').get_public_url(filename)
-    return public_url
\ No newline at end of file
+    return get_storage().public_url('audio', filename)
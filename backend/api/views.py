@@ -1,35 +1,50 @@
 from rest_framework import filters, viewsets, status, generics
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination
+from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination, CursorPagination
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 
-from django.db.models import Q, F
+from django.db.models import Q, F, Sum, Count, Max, OuterRef
 from django_filters.rest_framework import DjangoFilterBackend
 from django.contrib.postgres.search import TrigramSimilarity
 from django.db.models.functions import Greatest
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes.prefetch import GenericPrefetch
 from django.utils import timezone
-from django.shortcuts import render
+from django.shortcuts import render, get_object_or_404
+from django.http import Http404, HttpResponseNotModified, JsonResponse
+from django.views.decorators.http import require_GET
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 
 
 from .filters import ArtistFilter, AlbumFilter, SongFilter
-from .utils import get_top_songs_last_month, create_collage, get_image_url, upload_image
-from .models import CustomUser, Album, PlaylistSong, Song, CurrentPlayback, SongPlayback, Playlist, LibraryItem, Library, PlaybackHistory
-
-from .serializers import (ArtistSerializer, AlbumSerializer, SongSerializer, 
+from .blobs import attach_blob
+from .charts import with_absolute_urls
+from .media import song_audio_path
+from .rollups import plays_total
+from .membership import Membership, MAX_MEMBERSHIP_IDS
+from .storage import LocalStorage, get_storage
+from .streaming import ranged_file_response
+from .utils import create_collage, get_image_url, upload_image
+from .models import CustomUser, Album, PlaylistSong, Song, CurrentPlayback, SongPlayback, SongDailyPlays, Playlist, LibraryItem, LibraryChange, Library, PlaybackHistory, ChartSnapshot, SongAnalysis, MediaJob
+
+from .serializers import (ArtistSerializer, AlbumSerializer, AlbumTracksSerializer, SongSerializer, 
                           CurrentPlaybackSerializer, PlaybackActionSerializer, UserPlaybackHistorySerializer, 
-                          PlaylistSerializer,
-                          LibraryItemSerializer, LibrarySerializer,
+                          PlaylistSerializer, PlaylistTrackSerializer,
+                          LibraryItemSerializer, LibrarySerializer, LibraryChangeSerializer, resolve_library_objects,
                           PlaybackHistorySerializer
                           )
 
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from django.utils.text import slugify
+from django.urls import reverse
 
 
-from collections import defaultdict
+import base64
+import hashlib
 import os
 
 
@@ -42,12 +57,129 @@ def testIMG(request):
     if request.method == 'POST':
         image_file = request.FILES['image']
         filename = image_file.name
-        upload_image(image_file, filename)
-        image_url = get_image_url(filename)
+        image_url = get_image_url(upload_image(image_file, filename).key)
         return render(request, 'result.html', {'image_url': image_url})
     return render(request, 'upload.html')
 
+@require_GET
+def local_storage_object(request, bucket, name):
+    # Plain Django view so serving bytes skips DRF's authentication and
+    # rendering.
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        raise Http404()
+    public = bucket in settings.STORAGE_PUBLIC_BUCKETS
+    if not public and not storage.verify_signature(bucket, name, request.GET.get('token', '')):
+        raise Http404()
+    if not storage.exists(bucket, name):
+        raise Http404()
+    return ranged_file_response(request, storage.path(bucket, name), cache_control='public, max-age=3600' if public else 'private, max-age=3600')
+
+
+@require_GET
+def stream_song(request, song_id):
+    # Seekable audio for the player: Range (single and multipart), If-Range
+    # and ETag revalidation without reading the whole file.
+    song = get_object_or_404(Song.objects.only('id', 'title', 'file'), pk=song_id)
+    path = song_audio_path(song)
+    if path is None:
+        raise Http404()
+    return ranged_file_response(request, path, cache_control=f'public, max-age={SONG_STREAM_MAX_AGE}')
+
+@require_GET
+def song_waveform(request, song_id):
+    # Interleaved int8 (min, max) pairs, base64 encoded. Serializers link
+    # ?v=<waveform_version>, which every new analysis changes, so only that
+    # URL is cached for long; anything else is revalidated by ETag.
+    analysis = get_object_or_404(SongAnalysis.objects.select_related('song').only(
+        'peaks', 'points', 'loudness', 'song__duration', 'song__waveform_version',
+    ), song_id=song_id)
+    version = analysis.song.waveform_version
+    etag = quote_etag(f"{song_id}-v{version}")
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({
+            'points': analysis.points,
+            'peaks': base64.b64encode(analysis.peaks).decode(),
+            'loudness': analysis.loudness,
+            'duration': analysis.song.duration.total_seconds(),
+        })
+    response['ETag'] = etag
+    if request.GET.get('v') == str(version):
+        patch_cache_control(response, public=True, max_age=WAVEFORM_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+    return response
+
 BASE_URL = 'http://127.0.0.1:8000'
+CHARTS_MAX_AGE = 300
+SONG_STREAM_MAX_AGE = 24 * 60 * 60
+WAVEFORM_MAX_AGE = 7 * 24 * 60 * 60
+MAX_PLAYLIST_BATCH = 10000
+LIBRARY_CHANGES_PAGE = 500
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    return bool(if_none_match) and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*')
+
+
+def conditional_response(request, etag, render, private=False):
+    # `render` is only called when the client's copy is stale.
+    etag = quote_etag(etag)
+    response = Response(status=status.HTTP_304_NOT_MODIFIED) if etag_matches(request, etag) else render()
+    response['ETag'] = etag
+    patch_cache_control(response, no_cache=True, **({'private': True} if private else {}))
+    return response
+
+
+class VersionETagMixin:
+    # Answers If-None-Match from the `version` column (see api.models.Versioned)
+    # before the object or page is serialized. Rows the body renders that do
+    # not bump `version` (e.g. play counts) go in through etag_stamps().
+    etag_prefix = None
+    etag_private = False
+
+    def etag_stamps(self):
+        # {name: per-row expression} folded into the tag in the same query.
+        return {}
+
+    def retrieve(self, request, *args, **kwargs):
+        object_id = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+        stamps = self.etag_stamps()
+        row = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: object_id}
+        ).annotate(**stamps).values_list('version', *stamps).first()
+        if row is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        # The query string picks what is rendered (e.g. include_songs).
+        digest = hashlib.sha1(f"{request.get_full_path()}|{row[1:]}".encode()).hexdigest()[:16]
+        return conditional_response(
+            request, f"{self.etag_prefix}-{object_id}-v{row[0]}-{digest}",
+            lambda: super(VersionETagMixin, self).retrieve(request, *args, **kwargs),
+            private=self.etag_private,
+        )
+
+    def list(self, request, *args, **kwargs):
+        # count + sum(version) + max(id) changes whenever a row in the
+        # filtered set is added, removed or bumped.
+        stamps = self.etag_stamps()
+        stats = self.filter_queryset(self.get_queryset()).order_by().annotate(**stamps).aggregate(
+            count=Count('pk'), versions=Sum('version'), last=Max('pk'),
+            **{f'{name}_total': Sum(name) for name in stamps},
+        )
+        digest = hashlib.sha1(
+            f"{request.get_full_path()}|{'|'.join(str(value) for value in stats.values())}".encode()
+        ).hexdigest()
+
+        return conditional_response(
+            request, f"{self.etag_prefix}-list-{digest}",
+            lambda: super(VersionETagMixin, self).list(request, *args, **kwargs),
+            private=self.etag_private,
+        )
+
 
 @extend_schema(
     parameters=[
@@ -84,14 +216,16 @@ class ArtistViewSet(viewsets.ModelViewSet):
             file_data = instance.image
             filename = f"artists/{slugify(instance.username)}_{instance.id}{os.path.splitext(file_data.name)[1]}"
             try:
-                upload_image(file_data, filename)
+                attach_blob(instance, 'image_blob', upload_image(file_data, filename))
+                MediaJob.enqueue('images', instance)
             except Exception as e:
                 print(f"Upload failed: {e}")
 
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-class AlbumViewSet(viewsets.ModelViewSet):
+class AlbumViewSet(VersionETagMixin, viewsets.ModelViewSet):
     queryset = Album.objects.prefetch_related('artist', 'songs')
+    etag_prefix = 'album'
     serializer_class = AlbumSerializer
     permission_classes = [AllowAny,]
     filterset_class = AlbumFilter
@@ -103,6 +237,10 @@ class AlbumViewSet(viewsets.ModelViewSet):
     search_fields = ['title', 'artist__username', 'release_date']
     ordering_fields = ['title', 'artist__username', 'release_date']
 
+    def etag_stamps(self):
+        # total_plays and every nested song's plays.
+        return {'plays': plays_total(song__album=OuterRef('pk'))}
+
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -115,7 +253,8 @@ class AlbumViewSet(viewsets.ModelViewSet):
             filename = f"albums/{slugify(instance.title)}_{instance.id}{os.path.splitext(file_data.name)[1]}"
             # filename = f"albums/{instance.title}{instance.id}"
             try:
-                upload_image(file_data, filename)
+                attach_blob(instance, 'image_blob', upload_image(file_data, filename))
+                MediaJob.enqueue('images', instance)
             except Exception as e:
                 print(f"Upload failed: {e}")
 
@@ -133,14 +272,26 @@ class AlbumViewSet(viewsets.ModelViewSet):
             file_data = instance.image
             filename = f"albums/{slugify(instance.title)}_{instance.id}{os.path.splitext(file_data.name)[1]}"
             try:
-                upload_image(file_data, filename)
+                attach_blob(instance, 'image_blob', upload_image(file_data, filename))
+                MediaJob.enqueue('images', instance)
             except Exception as e:
                 print(f"Upload failed: {e}")
 
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @extend_schema(request=AlbumTracksSerializer, responses=SongSerializer(many=True))
+    @action(detail=True, methods=['post'], url_path='tracks', permission_classes=[IsAuthenticated])
+    def tracks(self, request, pk=None):
+        album = self.get_object()
+        if album.artist_id != request.user.id:
+            return Response({"error": "Only the album's artist can add tracks"}, status=403)
+        serializer = AlbumTracksSerializer(data=request.data, context={'album': album})
+        serializer.is_valid(raise_exception=True)
+        songs = serializer.save()
+        return Response(SongSerializer(songs, many=True, context={'request': request}).data, status=status.HTTP_201_CREATED)
     
 class SongViewSet(viewsets.ModelViewSet):
-    queryset = Song.objects.all()
+    queryset = Song.objects.annotate(total_plays=plays_total(song=OuterRef('pk'))).prefetch_related('featured_artists')
     serializer_class = SongSerializer
     permission_classes = [AllowAny,]
     filterset_class = SongFilter
@@ -178,6 +329,7 @@ class SearchView(APIView):
         #     Q(album__artist__name__icontains=query)
         # )
         songs = Song.objects.annotate(
+            total_plays=plays_total(song=OuterRef('pk')),
             similarity=Greatest(
                 TrigramSimilarity('title', query),
                 TrigramSimilarity('title', query.lower()),
@@ -388,45 +540,30 @@ class TopSongsAPIView(APIView):
         }
     )
     def get(self, request, genre=None):
-        top_songs = list(get_top_songs_last_month(10, genre))
-        result = defaultdict(list)
-
-        for entry in top_songs:
-            genre_label = entry['genre_label']
-            result[genre_label].append({
-                'song': entry['song__id'],
-                'play_count': entry['play_count']
-            })
-
-        grouped_result = dict(result)
-        print('Grouped Result: ', grouped_result)
-
-
-        data = []
-        for genre_items, value in grouped_result.items():
-            songs_data = []
-            for song in value:
-                song_obj = SongSerializer(Song.objects.get(id=song['song']), context={'request': request}).data
-                song_obj.pop('lyrics')
-                song_obj.pop('genre')
-
-                # song_obj.pop('plays')
-
-                songs_data.append(song_obj)
-
-            detail_data = {}
-            
-            detail_data['genre'] = genre_items
-            detail_data['cover'] = BASE_URL + CustomUser.objects.get(id=songs_data[0]['artist']).get_image_url if songs_data[0]['artist'] else ""
-            if genre:
-                detail_data['songs'] = songs_data
-            data.append(detail_data)
+        try:
+            snapshot = ChartSnapshot.objects.only('id', 'etag').latest('created_at')
+        except ChartSnapshot.DoesNotExist:
+            # Nothing built yet (fresh deploy, build_charts not run): ranking
+            # is too heavy for a request, so serve no charts until it has.
+            return Response([])
+
+        etag = quote_etag(f"{snapshot.etag}-{slugify(genre)}" if genre else snapshot.etag)
+        if etag_matches(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif genre:
+            response = Response(with_absolute_urls([chart for chart in snapshot.data if chart['genre'] == genre], request))
+        else:
+            response = Response(with_absolute_urls([{'genre': chart['genre'], 'cover': chart['cover']} for chart in snapshot.data], request))
 
-        return Response(data)
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=CHARTS_MAX_AGE)
+        return response
     
 
-class UserPlaylistViewSet(viewsets.ModelViewSet):
+class UserPlaylistViewSet(VersionETagMixin, viewsets.ModelViewSet):
     queryset = Playlist.objects.all()
+    etag_prefix = 'playlist'
+    etag_private = True
     serializer_class = PlaylistSerializer
     permission_classes = [IsAuthenticated,]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
@@ -452,7 +589,11 @@ class UserPlaylistViewSet(viewsets.ModelViewSet):
         #     return Playlist.objects.filter(user=user)
         # except:
         return Playlist.objects.filter(user=user)
-        
+
+    def etag_stamps(self):
+        if self.request.query_params.get('include_songs', '').lower() == 'false':
+            return {}
+        return {'plays': plays_total(song__playlist_songs__playlist=OuterRef('pk'))}
     
     def create(self, request):
         serializer = PlaylistSerializer(data=request.data)
@@ -476,13 +617,18 @@ class ModifyPlaylistAPIView(APIView):
     @extend_schema(
         parameters=[
             OpenApiParameter('playlist_id', type=int, description='ID of the playlist to modify'),
-            OpenApiParameter('song_ids', type=int, description='Comma-separated list of song IDs to add or remove'),
-            OpenApiParameter('action', type=str, description='Action to perform (add or remove)')
+            OpenApiParameter('song_ids', type=int, description='List (or comma-separated string) of song IDs to add, remove or replace the playlist with'),
+            OpenApiParameter('action', type=str, description='Action to perform (add, remove, replace, dedupe or move)'),
+            OpenApiParameter('dedupe', type=bool, description='For add: skip songs already in the playlist'),
+            OpenApiParameter('from_position', type=int, description='For move: position of the first track to move (or pass song_ids)'),
+            OpenApiParameter('count', type=int, description='For move: number of consecutive tracks to move (default 1)'),
+            OpenApiParameter('to_position', type=int, description='For move: position the first moved track ends up at'),
         ],
         request=None,
         responses={
             200: {
                 'status': {'type': 'string'},
+                'playlist': {'type': 'object'},
             },
         }
     )
@@ -495,40 +641,50 @@ class ModifyPlaylistAPIView(APIView):
         action = request.data.get('action', 'add')
 
 
-        if action == 'add':
-            playlist_song_length = PlaylistSong.objects.filter(playlist=playlist).count()
-            for idx, song_id in enumerate(song_ids):
-                playlist_song, created = PlaylistSong.objects.get_or_create(
-                    playlist=playlist,
-                    song_id=song_id,
-                    order=idx+playlist_song_length,
-                )
-                playlist_song.save()
-
-
-        elif action == 'remove':
-            for song_id in song_ids:
-                try:
-                    song = PlaylistSong.objects.get(playlist=playlist, song_id=song_id)
-                    removed_order = song.order
-                    song.delete()
+        if isinstance(song_ids, str):
+            song_ids = song_ids.split(',')
+        try:
+            song_ids = [int(song_id) for song_id in song_ids]
+        except (TypeError, ValueError):
+            return Response({"error": "song_ids must be a list of integers"}, status=400)
 
-                    PlaylistSong.objects.filter(
-                        playlist=playlist,
-                        order__gt=removed_order
-                    ).update(order=F('order') - 1)
+        if len(song_ids) > MAX_PLAYLIST_BATCH:
+            return Response({"error": f"At most {MAX_PLAYLIST_BATCH} song_ids per request"}, status=400)
 
-                except PlaylistSong.DoesNotExist:
-                    continue
+        previous_images = playlist.collage_images()
 
+        if action == 'add':
+            playlist.add_songs(song_ids, skip_existing=str(request.data.get('dedupe', '')).lower() in ('1', 'true'))
+        elif action == 'remove':
+            playlist.remove_songs(song_ids)
+        elif action == 'replace':
+            playlist.replace_songs(song_ids)
+        elif action == 'dedupe':
+            playlist.dedupe_songs()
+        elif action == 'move':
+            to_position = request.data.get('to_position', None)
+            from_position = request.data.get('from_position', None)
+            if to_position is None or (from_position is None and not song_ids):
+                return Response({"error": "move requires to_position and either from_position or song_ids"}, status=400)
+            try:
+                to_position = int(to_position)
+                from_position = None if from_position is None else int(from_position)
+                count = int(request.data.get('count', 1))
+            except (TypeError, ValueError):
+                return Response({"error": "to_position, from_position and count must be integers"}, status=400)
+            try:
+                playlist.move_songs(to_position, from_position=from_position, count=count, song_ids=song_ids)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=400)
+        else:
+            return Response({"error": "action must be 'add', 'remove', 'replace', 'dedupe' or 'move'"}, status=400)
 
 
-        images = []
-        for song in playlist.songs.all():
-            if song.album.image:
-                images.append(song.album.image.name)
+        # The collage only shows the first four covers, so skip the rebuild
+        # when those did not change.
+        images = playlist.collage_images()
 
-        if images:
+        if images and images != previous_images and not playlist.has_image:
             os.makedirs(os.path.join(settings.MEDIA_ROOT, 'playlists'), exist_ok=True)
 
             relative_path = os.path.join('playlists', f'playlist{playlist.id}.png')
@@ -539,24 +695,162 @@ class ModifyPlaylistAPIView(APIView):
             playlist.image = relative_path
             playlist.save()
 
-        return Response({"status": "success", "playlist": PlaylistSerializer(playlist, context={}).data})
+            filename = f"playlists/{slugify(playlist.name)}_{playlist.id}.png"
+            try:
+                attach_blob(playlist, 'image_blob', upload_image(playlist.image, filename))
+            except Exception as e:
+                print(f"Upload failed: {e}")
+            MediaJob.enqueue('images', playlist)
+
+        # Metadata only: the track list is read page by page from `tracks`.
+        data = PlaylistSerializer(playlist, nested=True, context={'request': request}).data
+        data['tracks'] = request.build_absolute_uri(reverse('playlist-tracks', args=[playlist.id]))
+        return Response({"status": "success", "playlist": data})
     
 
 
 
+class PlaylistTracksPagination(CursorPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering_fields = {
+        'position': 'order',
+        'title': 'sort_title',
+        'artist': 'sort_artist',
+        'added': 'added_at',
+    }
+
+    def get_ordering(self, request, queryset, view):
+        ordering = request.query_params.get('ordering', 'position')
+        descending = ordering.startswith('-')
+        field = self.ordering_fields.get(ordering.lstrip('-'), 'order')
+        return (('-' if descending else '') + field, '-id' if descending else 'id')
+
+
+@extend_schema(
+    parameters=[
+        OpenApiParameter('ordering', type=str, description='position, title, artist or added (prefix with - for descending)'),
+        OpenApiParameter('page_size', type=int, description='Tracks per page (max 200)'),
+        OpenApiParameter('cursor', type=str, description='Cursor returned in next/previous'),
+    ]
+)
+class PlaylistTracksAPIView(generics.ListAPIView):
+    serializer_class = PlaylistTrackSerializer
+    permission_classes = [AllowAny,]
+    pagination_class = PlaylistTracksPagination
+
+    def visible_playlists(self):
+        user = self.request.user
+        visible = Q(is_public=True) | Q(user=user) if user.is_authenticated else Q(is_public=True)
+        return Playlist.objects.filter(visible)
+
+    def list(self, request, *args, **kwargs):
+        # Per-song plays are rendered too and move without a version bump.
+        row = self.visible_playlists().filter(id=self.kwargs['playlist_id']).annotate(
+            plays=plays_total(song__playlist_songs__playlist=OuterRef('pk'))
+        ).values_list('version', 'plays').first()
+        if row is None:
+            return super().list(request, *args, **kwargs)
+
+        version, plays = row
+        digest = hashlib.sha1(f"{request.get_full_path()}|{plays}".encode()).hexdigest()
+        return conditional_response(
+            request, f"playlist-{self.kwargs['playlist_id']}-v{version}-{digest}",
+            lambda: super(PlaylistTracksAPIView, self).list(request, *args, **kwargs),
+            private=request.user.is_authenticated,
+        )
+
+    def get_queryset(self):
+        playlist = get_object_or_404(self.visible_playlists(), id=self.kwargs['playlist_id'])
+
+        return PlaylistSong.objects.filter(playlist=playlist).select_related(
+            'song__album__artist'
+        ).prefetch_related(
+            'song__featured_artists'
+        ).annotate(
+            sort_title=F('song__title'),
+            sort_artist=F('song__album__artist__username'),
+            song_total_plays=plays_total(song=OuterRef('song')),
+        )
+
+
+
+
 class LibraryAPIView(APIView):
     permission_classes = [IsAuthenticated,]
 
     def get(self, request):
-        library = Library.objects.get(user=request.user)
-        serializer = LibrarySerializer(library, context={'request': request})
-        return Response(serializer.data)
+        library_id = Library.objects.filter(user=request.user).values_list('id', flat=True).get()
+        LibraryChange.pull_updates(library_id)
+        version = Library.objects.filter(id=library_id).values_list('version', flat=True).get()
+
+        def render():
+            library = Library.objects.get(id=library_id)
+            serializer = LibrarySerializer(library, context={'request': request})
+            return Response(serializer.data)
+
+        return conditional_response(request, f"library-{library_id}-v{version}", render, private=True)
+
+
+@extend_schema(
+    parameters=[
+        OpenApiParameter('since', type=int, description='cursor from /library/ or the previous /library/changes/ response'),
+    ],
+    responses={
+        200: {
+            'type': 'object',
+            'properties': {
+                'cursor': {'type': 'integer'},
+                'has_more': {'type': 'boolean'},
+                'changes': {'type': 'array', 'items': {'type': 'object'}},
+            },
+        },
+    },
+)
+class LibraryChangesAPIView(APIView):
+    permission_classes = [IsAuthenticated,]
+
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+        except ValueError:
+            return Response({"error": "since must be an integer"}, status=400)
+
+        library_id = Library.objects.filter(user=request.user).values_list('id', flat=True).get()
+        LibraryChange.pull_updates(library_id)
+        changes = list(
+            LibraryChange.objects.filter(library_id=library_id, seq__gt=since).select_related('content_type')[:LIBRARY_CHANGES_PAGE + 1]
+        )
+        has_more = len(changes) > LIBRARY_CHANGES_PAGE
+        changes = changes[:LIBRARY_CHANGES_PAGE]
+
+        # Only the latest change of each item matters; the ones that are not
+        # removals carry the item's current card and pin state.
+        latest = {}
+        for change in changes:
+            latest.pop(change.item_id, None)
+            latest[change.item_id] = change
+        kept = [change for change in latest.values() if change.action != 'remove']
+
+        context = {
+            'request': request,
+            'library_objects': resolve_library_objects(kept),
+            'pinned_item_ids': set(LibraryItem.objects.filter(
+                id__in=[change.item_id for change in kept], is_pinned=True
+            ).values_list('id', flat=True)),
+        }
+        return Response({
+            'cursor': changes[-1].seq if changes else since,
+            'has_more': has_more,
+            'changes': LibraryChangeSerializer(list(latest.values()), many=True, context=context).data,
+        })
 
 
 
 @extend_schema(
     parameters=[
-        OpenApiParameter('action', type=str, description="Action to perform ('add' or 'remove')"),
+        OpenApiParameter('action', type=str, description="Action to perform ('add', 'remove', 'pin' or 'unpin')"),
         OpenApiParameter('object_type', type=str, description="Type of object ('song', 'album', 'customuser')"),
         OpenApiParameter('id', type=int, description="ID of the object to add or remove"),
     ],
@@ -596,25 +890,62 @@ class ModifyLibraryAPIView(APIView):
                 object_id=obj_id
             )
             library_item.save()
-            if object_type == 'playlist':
-                playlist = library_item.content_object
-                playlist.savings += 1
-                playlist.save()
+            if object_type == 'playlist' and created:
+                Playlist.change_savings(obj_id, 1)
 
 
+        elif action in ('pin', 'unpin'):
+            library_item = LibraryItem.objects.filter(
+                library=library, object_id=obj_id, content_type=ContentType.objects.get_for_model(model)
+            ).first()
+            if library_item and library_item.is_pinned != (action == 'pin'):
+                LibraryItem.objects.filter(id=library_item.id).update(is_pinned=action == 'pin')
+                LibraryChange.record(library_item, action)
+                Library.bump_versions(pk=library.id)
+
         elif action == 'remove':
             try:
                 song = LibraryItem.objects.get(library=library, object_id=obj_id, content_type=ContentType.objects.get_for_model(model))
-                if object_type == 'playlist':
-                    playlist = song.content_object
-                    playlist.savings -= 1
                 song.delete()
+                if object_type == 'playlist':
+                    Playlist.change_savings(obj_id, -1)
             except LibraryItem.DoesNotExist:
                 print('LibraryItem does not exist, id: ', obj_id)
                 pass
 
         return Response({"status": "success"})
-    
+
+
+@extend_schema(
+    request={
+        'application/json': {
+            'type': 'object',
+            'properties': {kind: {'type': 'array', 'items': {'type': 'integer'}} for kind in Membership.KINDS},
+        }
+    },
+    responses={
+        200: {
+            'type': 'object',
+            'properties': {kind: {'type': 'array', 'items': {'type': 'boolean'}} for kind in Membership.KINDS},
+        },
+    },
+    description=f"Whether each id is saved by the user: songs in Liked Songs, albums and playlists in the library, followed artists. At most {MAX_MEMBERSHIP_IDS} ids per request.",
+)
+class LibraryMembershipAPIView(APIView):
+    permission_classes = [IsAuthenticated,]
+
+    def post(self, request):
+        try:
+            ids = {kind: [int(object_id) for object_id in request.data.get(kind, [])] for kind in Membership.KINDS}
+        except (TypeError, ValueError):
+            return Response({"error": f"{', '.join(Membership.KINDS)} must be lists of integers"}, status=400)
+
+        if sum(len(object_ids) for object_ids in ids.values()) > MAX_MEMBERSHIP_IDS:
+            return Response({"error": f"At most {MAX_MEMBERSHIP_IDS} ids per request"}, status=400)
+
+        membership = Membership.for_request(request)
+        return Response({kind: membership.lookup(kind, object_ids) for kind, object_ids in ids.items() if kind in request.data})
+
 
 
 @extend_schema(
@@ -642,19 +973,32 @@ class ToggleFollowAPIView(APIView):
         except CustomUser.DoesNotExist:
             return Response({"error": "Artist not found"}, status=404)
 
-        request.user.follow(artist)
-        if artist in request.user.followed_artists.all():
-            return Response({"status": "Following"})
-        else:
-            return Response({"status": "Unfollowed"})
+        try:
+            following = request.user.follow(artist)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
+        return Response({"status": "Following" if following else "Unfollowed"})
         
 
 
+class RecentlyPlayedPagination(LimitOffsetPagination):
+    default_limit = 10
+    max_limit = PlaybackHistory.RECENTLY_PLAYED_LIMIT
+
+
 class PlaybackHistoryViewSet(viewsets.ModelViewSet):
     queryset = PlaybackHistory.objects.all()
     serializer_class = PlaybackHistorySerializer
     permission_classes = [IsAuthenticated,]
+    pagination_class = RecentlyPlayedPagination
 
     def get_queryset(self):
         user = self.request.user
-        return PlaybackHistory.objects.filter(user=user)
\ No newline at end of file
+        return PlaybackHistory.objects.filter(user=user).select_related('content_type').prefetch_related(
+            GenericPrefetch('content_object', [
+                Album.objects.select_related('artist').prefetch_related('songs').annotate(total_plays=plays_total(song__album=OuterRef('pk'))),
+                Playlist.objects.all(),
+                CustomUser.objects.all(),
+            ])
+        )
\ No newline at end of file
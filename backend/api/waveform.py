@@ -0,0 +1,68 @@
+import re
+import subprocess
+import tempfile
+from datetime import timedelta
+import numpy as np
+from django.conf import settings
+
+WAVEFORM_SAMPLE_RATE = 11025
+WAVEFORM_BLOCK = 256
+WAVEFORM_POINTS = 1000
+READ_SIZE = WAVEFORM_BLOCK * 2 * 512
+INTEGRATED_LOUDNESS = re.compile(rb'I:\s+(-?[\d.]+|-inf) LUFS')
+
+
+def analyze_audio(path, points=WAVEFORM_POINTS):
+    # Decodes the file once with ffmpeg: the ebur128 filter measures the
+    # integrated loudness while the mono 16-bit PCM it passes through is
+    # reduced to per-block min/max as it streams in.
+    with tempfile.TemporaryFile() as log:
+        process = subprocess.Popen([
+            settings.FFMPEG_BINARY, '-nostdin', '-hide_banner', '-nostats', '-loglevel', 'info', '-i', path, '-map', '0:a:0',
+            '-af', f'ebur128=framelog=quiet,aresample={WAVEFORM_SAMPLE_RATE},aformat=sample_fmts=s16:channel_layouts=mono',
+            '-f', 's16le', 'pipe:1',
+        ], stdout=subprocess.PIPE, stderr=log)
+
+        mins, maxs = [], []
+        samples = 0
+        pending = b''
+        with process.stdout:
+            while chunk := process.stdout.read(READ_SIZE):
+                pending += chunk
+                usable = len(pending) - len(pending) % (WAVEFORM_BLOCK * 2)
+                if usable:
+                    blocks = np.frombuffer(pending[:usable], dtype='<i2').reshape(-1, WAVEFORM_BLOCK)
+                    mins.append(blocks.min(axis=1))
+                    maxs.append(blocks.max(axis=1))
+                    samples += blocks.size
+                    pending = pending[usable:]
+        tail = np.frombuffer(pending[:len(pending) - len(pending) % 2], dtype='<i2')
+        if tail.size:
+            mins.append(tail.min(keepdims=True))
+            maxs.append(tail.max(keepdims=True))
+            samples += tail.size
+
+        if process.wait() != 0:
+            log.seek(0)
+            raise RuntimeError(log.read().decode(errors='replace')[-1000:])
+        log.seek(0)
+        loudness = INTEGRATED_LOUDNESS.findall(log.read())
+
+    return {
+        'peaks': downsample_peaks(mins, maxs, points),
+        'points': min(points, sum(len(block) for block in mins)),
+        'loudness': float(loudness[-1]) if loudness and loudness[-1] != b'-inf' else None,
+        'duration': timedelta(seconds=samples / WAVEFORM_SAMPLE_RATE),
+    }
+
+
+def downsample_peaks(mins, maxs, points):
+    # Interleaved (min, max) int8 pairs; 8-bit resolution is plenty for a
+    # waveform a few hundred pixels tall.
+    if not mins:
+        return b''
+    mins, maxs = np.concatenate(mins), np.concatenate(maxs)
+    edges = np.linspace(0, len(mins), min(points, len(mins)) + 1).astype(np.intp)[:-1]
+    low = np.minimum.reduceat(mins, edges) >> 8
+    high = np.maximum.reduceat(maxs, edges) >> 8
+    return np.column_stack([low, high]).astype(np.int8).tobytes()
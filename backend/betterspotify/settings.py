@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -140,6 +140,21 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# 'supabase' or 'local'; the local backend keeps objects on disk and serves
+# them from api/storage/ so the media path can run without Supabase.
+STORAGE_BACKEND = config('STORAGE_BACKEND', default='supabase')
+STORAGE_LOCAL_ROOT = config('STORAGE_LOCAL_ROOT', default=str(MEDIA_ROOT / 'storage'))
+STORAGE_LOCAL_URL = config('STORAGE_LOCAL_URL', default='http://127.0.0.1:8000/api/storage/')
+STORAGE_PUBLIC_BUCKETS = ['images', 'audio']
+# Uploads and deletes in flight at once per process (api.async_storage).
+STORAGE_CONCURRENCY = config('STORAGE_CONCURRENCY', default=8, cast=int)
+SUPABASE_URL = config('DB_URL', default='')
+SUPABASE_KEY = config('DB_KEY', default='')
+
+FFMPEG_BINARY = config('FFMPEG_BINARY', default='ffmpeg')
+HLS_SEGMENT_SECONDS = 6
+HLS_BITRATES = config('HLS_BITRATES', default='96,192', cast=Csv(int))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 